@@ -7,8 +7,9 @@ import os
 # Điều này giúp Python tìm thấy các module trong `webapp`
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-from webapp.core.database_setup import Base
-from webapp.core.database_utils import engine
+from webapp.core.database_setup import Base, upgrade_schema
+from webapp.core.database_utils import engine, get_db_session
+from webapp.core.case_rollup import rebuild_case_rollup
 
 def initialize_database():
     """
@@ -22,10 +23,19 @@ def initialize_database():
     # Base.metadata.drop_all(bind=engine)
     # print("Đã xóa các bảng cũ (nếu có).")
 
-    # Tạo tất cả các bảng mới dựa trên các Model
-    Base.metadata.create_all(bind=engine)
+    # Tạo tất cả các bảng mới dựa trên các Model và thêm các cột mới vào bảng đã có (vd. ca_benh.lo_import_id)
+    upgrade_schema(engine)
     
     print("Đã tạo thành công tất cả các bảng.")
+
+    # Dựng bảng tổng hợp ca bệnh dùng cho báo cáo (an toàn khi chạy lại: dựng lại từ ca_benh)
+    db = get_db_session()
+    try:
+        so_dong = rebuild_case_rollup(db)
+        db.commit()
+        print(f"Đã dựng bảng tổng hợp ca bệnh ({so_dong} dòng).")
+    finally:
+        db.close()
     print("Cơ sở dữ liệu đã sẵn sàng để sử dụng!")
 
 if __name__ == "__main__":
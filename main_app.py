@@ -1,6 +1,7 @@
 # file: main_app.py
 
 import webview
+import multiprocessing
 import socket
 from threading import Thread
 from waitress import serve # Sử dụng waitress cho server ổn định hơn
@@ -30,6 +31,9 @@ def run_flask(app, port):
     serve(app, host='127.0.0.1', port=port)
 
 if __name__ == '__main__':
+    # 0. Bắt buộc khi đóng gói (PyInstaller): tiến trình con đọc file import chạy lại chính file thực thi này
+    multiprocessing.freeze_support()
+
     # 1. Khởi động server Flask trong một luồng (thread) riêng
     #    Điều này giúp server chạy ngầm mà không chặn cửa sổ ứng dụng.
     flask_thread = Thread(target=run_flask, args=(flask_app, port))
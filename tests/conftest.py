@@ -0,0 +1,104 @@
+# file: tests/conftest.py
+
+import os
+import sys
+import tempfile
+from datetime import date, datetime
+
+import pytest
+
+# CSDL thử: SQLite tạm cho mỗi lần chạy, hoặc TEST_DATABASE_URL (vd. một CSDL PostgreSQL trống dành riêng cho test).
+# Phải đặt trước khi import webapp: database_utils tạo engine ngay khi được import.
+_TEST_DIR = tempfile.mkdtemp(prefix='cdc_test_')
+os.environ['DATABASE_URL'] = os.getenv('TEST_DATABASE_URL') or 'sqlite:///' + os.path.join(_TEST_DIR, 'test.sqlite')
+os.environ['REPORT_PRERENDER_ENABLED'] = '0'
+os.environ['REPORT_STORE_SWEEP_SECONDS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openpyxl import Workbook
+from sqlalchemy import text
+
+from webapp.core import place_names
+from webapp.core.case_rollup import rebuild_case_rollup
+from webapp.core.data_importer import COLUMN_MAP
+from webapp.core.database_setup import Base, CaBenh, DonViHanhChinh, add_missing_columns
+from webapp.core.database_utils import engine, get_db_session
+
+ROLLUP_COLUMNS = ("xa_id, coalesce(dia_chi_ap, ''), coalesce(chan_doan_chinh, ''), coalesce(phan_do_benh, ''), "
+                  "ngay_khoi_phat, ngay_import, is_death, is_under_15, so_ca")
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _schema():
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+
+
+@pytest.fixture
+def db():
+    """Session trên CSDL đã xóa sạch dữ liệu của test trước."""
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    # Chỉ mục tên đơn vị được giữ theo phiên bản danh mục, mà phiên bản về 0 sau khi xóa dữ liệu
+    place_names._cached_index.update(version=None, index=None)
+    session = get_db_session()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def units(db):
+    """Tỉnh -> 2 khu vực -> 3 xã (mỗi xã 2 ấp). Trả về {tên: đơn vị}."""
+    tinh = DonViHanhChinh(ten_don_vi='Tỉnh Thử', cap_don_vi='Tỉnh')
+    kv_a = DonViHanhChinh(ten_don_vi='Khu vực A', cap_don_vi='Khu vực', parent=tinh)
+    kv_b = DonViHanhChinh(ten_don_vi='Khu vực B', cap_don_vi='Khu vực', parent=tinh)
+    created = {'tinh': tinh, 'kv_a': kv_a, 'kv_b': kv_b}
+    for key, name, parent in (('my_hoa', 'Mỹ Hòa', kv_a), ('to_chau', 'Tô Châu', kv_a), ('binh_duc', 'Bình Đức', kv_b)):
+        xa = DonViHanhChinh(ten_don_vi=name, cap_don_vi='Xã', parent=parent)
+        for ap in ('Ấp 1', 'Ấp 2'):
+            DonViHanhChinh(ten_don_vi=ap, cap_don_vi='Ấp', parent=xa)
+        created[key] = xa
+    db.add(tinh)
+    db.commit()
+    return created
+
+
+def make_case(xa, ma_so: str, ngay_khoi_phat, chan_doan: str = 'Sốt xuất huyết Dengue', **fields) -> CaBenh:
+    values = dict(
+        ma_so_benh_nhan=ma_so, ho_ten=f'Bệnh nhân {ma_so}', ngay_sinh=date(1990, 1, 1), gioi_tinh='Nam',
+        dia_chi_ap='Ấp 1', ngay_khoi_phat=ngay_khoi_phat, chan_doan_chinh=chan_doan,
+        tinh_trang_hien_nay='Điều trị ngoại trú', ngay_import=ngay_khoi_phat, xa_id=xa.id,
+    )
+    values.update(fields)
+    return CaBenh(**values)
+
+
+def write_import_workbook(path, rows: list, extra_sheets: dict = None) -> str:
+    """
+    File import với đúng tiêu đề cột của data_importer.COLUMN_MAP; mỗi dòng là dict theo tên cột trong CSDL.
+    `extra_sheets`: {tên sheet: các dòng} cho workbook nhiều sheet.
+    """
+    workbook = Workbook()
+    for index, sheet_rows in enumerate([rows] + list((extra_sheets or {}).values())):
+        sheet = workbook.active if index == 0 else workbook.create_sheet(list(extra_sheets)[index - 1])
+        sheet.append(list(COLUMN_MAP.keys()))
+        for row in sheet_rows:
+            values = {'ngay_sinh': datetime(1990, 1, 1), 'gioi_tinh': 'Nam', 'dia_chi_ap': 'Ấp 1',
+                      'chan_doan_chinh': 'Sốt xuất huyết Dengue', 'tinh_trang_hien_nay': 'Điều trị ngoại trú'}
+            values.update(row)
+            sheet.append([values.get(col) for col in COLUMN_MAP.values()])
+    workbook.save(path)
+    return str(path)
+
+
+def rollup_rows(db_session) -> list:
+    return sorted((tuple(row) for row in db_session.execute(text(f"SELECT {ROLLUP_COLUMNS} FROM tong_hop_ca_benh"))), key=str)
+
+
+def rebuilt_rollup_rows(db_session) -> list:
+    """Bảng tổng hợp dựng lại từ đầu từ ca_benh (không lưu lại), để so với bảng được cập nhật dần."""
+    rebuild_case_rollup(db_session)
+    rows = rollup_rows(db_session)
+    db_session.rollback()
+    return rows
@@ -0,0 +1,36 @@
+# file: tests/test_case_export.py
+
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import make_case
+from webapp.core.admin_utils import get_cases_by_user_scope, iter_cases_for_export
+
+
+@pytest.fixture
+def cases(db, units):
+    """53 ca: nhiều ca trùng ngày khởi phát (so khóa phải dùng cả id) và 6 ca chưa có ngày khởi phát."""
+    xa_keys = ['my_hoa', 'to_chau', 'binh_duc']
+    for index in range(53):
+        onset = None if index % 9 == 0 else date(2024, 3, 1) + timedelta(days=index % 4)
+        db.add(make_case(units[xa_keys[index % 3]], f'E{index}', onset, ngay_import=date(2024, 3, 10)))
+    db.commit()
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, 7, 53, 100])
+def test_export_returns_every_case_once_in_list_order(db, units, cases, batch_size):
+    exported = [row.id for row in iter_cases_for_export(units['tinh'], {}, batch_size=batch_size)]
+    listed, total = get_cases_by_user_scope(units['tinh'], {}, page=1, per_page=100, db_session=db)
+    assert total == 53
+    assert len(exported) == len(set(exported)) == 53
+    assert exported == [case.id for case in listed]
+
+
+def test_export_applies_scope_and_filters(db, units, cases):
+    exported = list(iter_cases_for_export(units['kv_a'], {'start_date': date(2024, 3, 2)}, batch_size=4))
+    listed, total = get_cases_by_user_scope(units['kv_a'], {'start_date': date(2024, 3, 2)}, page=1, per_page=100, db_session=db)
+    assert [row.id for row in exported] == [case.id for case in listed]
+    assert len(exported) == total > 0
+    assert {row.ten_xa for row in exported} <= {'Mỹ Hòa', 'Tô Châu'}
+    assert all(row.ngay_khoi_phat >= date(2024, 3, 2) for row in exported)
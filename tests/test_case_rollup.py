@@ -0,0 +1,112 @@
+# file: tests/test_case_rollup.py
+
+import random
+from datetime import date, timedelta
+from io import BytesIO
+
+import pytest
+from openpyxl import load_workbook
+
+from conftest import make_case, rebuilt_rollup_rows, rollup_rows
+from webapp.core import case_rollup
+from webapp.core.admin_utils import add_new_case, delete_case, update_case
+from webapp.core.case_rollup import ensure_case_rollup, is_case_rollup_ready, rebuild_case_rollup
+from webapp.core.database_setup import CaBenh
+from webapp.core.report_generator import (
+    generate_benh_truyen_nhiem_report, generate_benh_truyen_nhiem_report_monthly, generate_custom_btn_report,
+    generate_sxh_report, generate_sxh_report_monthly
+)
+from webapp.core.week_calendar import WeekCalendar
+
+DISEASES = [
+    ('Sốt xuất huyết Dengue', ['Sốt xuất huyết Dengue', 'Sốt xuất huyết Dengue có dấu hiệu cảnh báo', 'Sốt xuất huyết Dengue nặng']),
+    ('Tay - chân - miệng', ['Độ 1', 'Độ 2a', 'Độ 3']),
+    ('Sởi', [None]),
+    ('Tiêu chảy', [None]),
+]
+
+
+@pytest.fixture
+def cases(db, units):
+    """Ca bệnh ngẫu nhiên (cố định theo seed) từ đầu 2023 đến giữa 2024, có ca tử vong, trẻ em và ca nhập muộn."""
+    rng = random.Random(7)
+    for index in range(400):
+        disease, levels = rng.choice(DISEASES)
+        onset = date(2023, 1, 1) + timedelta(days=rng.randrange(540))
+        db.add(make_case(
+            units[rng.choice(['my_hoa', 'to_chau', 'binh_duc'])], f'R{index}', onset, disease,
+            phan_do_benh=rng.choice(levels), dia_chi_ap=rng.choice(['Ấp 1', 'Ấp 2']),
+            ngay_sinh=rng.choice([date(1980, 6, 1), date(2015, 3, 20), None]),
+            tinh_trang_hien_nay=rng.choice(['Tử vong', 'Ra viện', 'Điều trị nội trú']),
+            ngay_import=onset + timedelta(days=rng.choice([0, 1, 3, 12, 30])),
+        ))
+    db.commit()
+
+
+def _cell_values(render) -> dict:
+    output = BytesIO()
+    render(output)
+    workbook = load_workbook(BytesIO(output.getvalue()))
+    return {sheet.title: [[cell.value for cell in row] for row in sheet.iter_rows()] for sheet in workbook}
+
+
+REPORTS = {
+    'btn_tuan': lambda db, unit, out: generate_benh_truyen_nhiem_report(db, WeekCalendar(2024), 20, unit, out),
+    'sxh_tuan': lambda db, unit, out: generate_sxh_report(db, WeekCalendar(2024), 20, unit, out),
+    'btn_thang': lambda db, unit, out: generate_benh_truyen_nhiem_report_monthly(db, 2024, 5, unit, out),
+    'sxh_thang': lambda db, unit, out: generate_sxh_report_monthly(db, 2024, 5, unit, out),
+}
+
+
+@pytest.mark.parametrize('report', sorted(REPORTS))
+@pytest.mark.parametrize('unit_key', ['tinh', 'kv_a', 'my_hoa'])
+def test_rollup_reports_match_case_table_reports(db, units, cases, monkeypatch, report, unit_key):
+    rebuild_case_rollup(db)
+    db.commit()
+    unit = units[unit_key]
+    from_rollup = _cell_values(lambda out: REPORTS[report](db, unit, out))
+    monkeypatch.setattr(case_rollup, 'REPORT_USE_ROLLUP', False)
+    from_cases = _cell_values(lambda out: REPORTS[report](db, unit, out))
+    assert from_rollup == from_cases
+
+
+def test_rollup_custom_report_matches_case_table_report(db, units, cases, monkeypatch, tmp_path):
+    rebuild_case_rollup(db)
+    db.commit()
+
+    def render(path):
+        generate_custom_btn_report(db, units['tinh'], date(2023, 11, 15), date(2024, 2, 10),
+                                   [units['kv_a'].id, units['kv_b'].id], str(path))
+        workbook = load_workbook(path)
+        return {sheet.title: [[cell.value for cell in row] for row in sheet.iter_rows()] for sheet in workbook}
+
+    from_rollup = render(tmp_path / 'rollup.xlsx')
+    monkeypatch.setattr(case_rollup, 'REPORT_USE_ROLLUP', False)
+    assert from_rollup == render(tmp_path / 'ca_benh.xlsx')
+
+
+def test_case_edits_keep_rollup_equal_to_rebuild(db, units, cases):
+    rebuild_case_rollup(db)
+    db.commit()
+    moved = db.query(CaBenh).filter_by(ma_so_benh_nhan='R1').one()
+    assert update_case(moved.id, {'xa_id': units['binh_duc'].id, 'ngay_khoi_phat': date(2024, 5, 14),
+                                  'tinh_trang_hien_nay': 'Tử vong'}, db_session=db)['success']
+    assert delete_case(db.query(CaBenh).filter_by(ma_so_benh_nhan='R2').one().id, db_session=db)['success']
+    assert add_new_case({'ma_so_benh_nhan': 'MOI1', 'ho_ten': 'Ca mới', 'ngay_khoi_phat': date(2024, 5, 15),
+                         'chan_doan_chinh': 'Sởi', 'xa_id': units['to_chau'].id, 'ngay_import': date(2024, 5, 20)},
+                        db_session=db)['success']
+    assert rollup_rows(db) == rebuilt_rollup_rows(db)
+
+
+def test_rollup_is_built_once_when_missing(db, units, cases):
+    assert not is_case_rollup_ready(db)
+    assert ensure_case_rollup(db) == len(rebuilt_rollup_rows(db))
+    assert is_case_rollup_ready(db) and rollup_rows(db) == rebuilt_rollup_rows(db)
+    assert ensure_case_rollup(db) is None
+
+
+def test_rebuild_includes_cases_not_yet_flushed(db, units):
+    db.add(make_case(units['my_hoa'], 'P1', date(2024, 5, 3)))
+    assert rebuild_case_rollup(db) == 1
+    db.commit()
+    assert len(rollup_rows(db)) == 1
@@ -0,0 +1,99 @@
+# file: tests/test_data_importer.py
+
+from datetime import date, datetime
+
+from conftest import make_case, rebuilt_rollup_rows, rollup_rows, write_import_workbook
+from webapp.core import data_importer
+from webapp.core.case_rollup import rebuild_case_rollup
+from webapp.core.data_importer import import_data_from_excel, import_data_from_excel_chunked
+from webapp.core.database_setup import CaBenh
+
+
+def _row(ma_so, day: int, **fields) -> dict:
+    return dict(dict(ma_so_benh_nhan=ma_so, ho_ten=f'Người {ma_so}', ten_xa='Mỹ Hòa', ngay_khoi_phat=datetime(2024, 5, day)), **fields)
+
+
+def test_blank_values_are_stored_the_same_on_every_database(db, units, tmp_path):
+    """Chạy trên CSDL của TEST_DATABASE_URL nếu có (PostgreSQL đi nhánh COPY), ngược lại trên SQLite."""
+    path = write_import_workbook(tmp_path / 'a.xlsx', [
+        _row('A1', 1, dia_chi_chi_tiet='  '),
+        _row('   ', 2),
+        _row('A3', 3, ho_ten='   ', phan_do_benh=None, dia_chi_ap=None),
+    ])
+    result = import_data_from_excel(path)
+    assert result['success'] and result['inserted'] == 2 and result['skipped'] == 0
+
+    stored = {case.ma_so_benh_nhan: case for case in db.query(CaBenh)}
+    assert set(stored) == {'A1', 'A3'}
+    assert stored['A1'].dia_chi_chi_tiet == '  '
+    assert stored['A3'].ho_ten is None
+    assert stored['A3'].phan_do_benh is None and stored['A3'].dia_chi_ap is None
+
+
+def _chunk_test_rows() -> list:
+    """12 dòng (3 phần 4 dòng): trùng giữa các phần, một xã sai, một dòng thiếu ngày khởi phát, một ca đã có (A2)."""
+    rows = [_row(f'A{i}', 1 + i) for i in range(12)]
+    rows[5] = dict(rows[1], ho_ten='Bản trùng')
+    rows[9] = dict(rows[6], ho_ten='Bản trùng')
+    rows[3]['ten_xa'] = 'Vĩnh Thạnh'
+    rows[7]['ngay_khoi_phat'] = None
+    return rows
+
+
+def _seed_existing(db, units):
+    db.query(CaBenh).delete()
+    db.add(make_case(units['my_hoa'], 'A2', date(2024, 5, 3)))
+    rebuild_case_rollup(db)
+    db.commit()
+
+
+def _stored(db) -> list:
+    db.expire_all()
+    return sorted((case.ma_so_benh_nhan, case.ho_ten, case.ngay_khoi_phat, case.xa_id) for case in db.query(CaBenh))
+
+
+def _summary(result: dict) -> tuple:
+    return result['success'], result['inserted'], result['skipped'], [(error['row'], error['error']) for error in result['errors']]
+
+
+def test_chunked_import_matches_single_pass_import(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _chunk_test_rows())
+    _seed_existing(db, units)
+    single = _summary(import_data_from_excel(path))
+    single_rows = _stored(db)
+
+    _seed_existing(db, units)
+    assert _summary(import_data_from_excel_chunked(path, chunk_size=4)) == single
+    assert _stored(db) == single_rows
+    assert single[1:3] == (7, 2)
+    assert rollup_rows(db) == rebuilt_rollup_rows(db)
+
+
+def test_chunked_import_keeps_committed_chunks_after_crash(db, units, tmp_path, monkeypatch):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _chunk_test_rows())
+    _seed_existing(db, units)
+    expected = _summary(import_data_from_excel(path))[1:3]
+    expected_rows = _stored(db)
+    _seed_existing(db, units)
+
+    calls = []
+
+    def crash_in_second_chunk(db_session, df, *args):
+        calls.append(len(df))
+        keys = insert_cases(db_session, df, *args)
+        if len(calls) == 2:
+            raise RuntimeError('mất kết nối')
+        return keys
+
+    insert_cases = data_importer._insert_cases
+    monkeypatch.setattr(data_importer, '_insert_cases', crash_in_second_chunk)
+    crashed = import_data_from_excel_chunked(path, chunk_size=4)
+    assert not crashed['success'] and 'Đã lưu 2 ca mới' in crashed['message']
+    # Chỉ phần đầu được giữ (A0, A1 mới và A2 đã có); phần đang ghi khi lỗi được hoàn tác cả bảng tổng hợp
+    assert [row[0] for row in _stored(db)] == ['A0', 'A1', 'A2']
+    assert rollup_rows(db) == rebuilt_rollup_rows(db)
+
+    monkeypatch.setattr(data_importer, '_insert_cases', insert_cases)
+    resumed = import_data_from_excel_chunked(path, chunk_size=4)
+    assert resumed['success'] and resumed['inserted'] == expected[0] - 2
+    assert _stored(db) == expected_rows
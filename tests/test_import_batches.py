@@ -0,0 +1,143 @@
+# file: tests/test_import_batches.py
+
+import shutil
+from datetime import date, datetime
+
+from conftest import make_case, rebuilt_rollup_rows, rollup_rows, write_import_workbook
+from webapp.core.admin_utils import add_new_don_vi
+from webapp.core.case_rollup import rebuild_case_rollup
+from webapp.core.data_version import get_data_version
+from webapp.core.database_setup import CaBenh, LoImport
+from webapp.core.import_batches import rollback_import_batch
+from webapp.core.import_jobs import _run_import_job
+
+
+def _rows(prefix: str, count: int, ten_xa: str = 'Mỹ Hòa', **fields) -> list:
+    return [dict(ma_so_benh_nhan=f'{prefix}{i}', ho_ten=f'Người {prefix}{i}', ten_xa=ten_xa,
+                 ngay_khoi_phat=datetime(2024, 5, 1 + i), **fields) for i in range(count)]
+
+
+def _upload(path: str, tmp_path, **options) -> dict:
+    """Chạy một lượt import như công việc nền (công việc xóa file tải lên nên dùng bản sao)."""
+    upload = tmp_path / f"upload_{datetime.now():%H%M%S%f}.xlsx"
+    shutil.copy(path, upload)
+    reports = tmp_path / 'reports'
+    reports.mkdir(exist_ok=True)
+    return _run_import_job(str(upload), display_name='ca_benh.xlsx', owner_id=1, report_folder=str(reports), **options)
+
+
+def test_reupload_of_clean_file_is_skipped(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 3))
+    first = _upload(path, tmp_path)
+    assert first['success'] and first['inserted'] == 3
+
+    second = _upload(path, tmp_path)
+    assert second.get('already_imported') and second['lo_import_id'] == first['lo_import_id']
+    assert db.query(LoImport).count() == 1
+
+
+def test_force_reads_the_file_again(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 3))
+    _upload(path, tmp_path)
+
+    forced = _upload(path, tmp_path, force=True)
+    assert not forced.get('already_imported')
+    assert forced['inserted'] == 0 and forced['skipped'] == 3
+    assert db.query(LoImport).count() == 2 and db.query(CaBenh).count() == 3
+
+
+def test_update_mode_runs_after_insert_mode_import(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 3, tinh_trang_hien_nay='Ra viện'))
+    _upload(path, tmp_path)
+    case = db.query(CaBenh).filter_by(ma_so_benh_nhan='A0').one()
+    case.tinh_trang_hien_nay = 'Điều trị nội trú'
+    db.commit()
+
+    updated = _upload(path, tmp_path, update_existing=True)
+    assert not updated.get('already_imported')
+    assert updated['updated'] == 1
+    db.expire_all()
+    assert case.tinh_trang_hien_nay == 'Ra viện'
+    assert db.query(LoImport).filter(LoImport.cap_nhat_ca_da_co.is_(True)).count() == 1
+
+
+def test_reupload_after_rejected_rows_imports_them(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 2) + _rows('B', 1, ten_xa='Vĩnh Thạnh'))
+    first = _upload(path, tmp_path)
+    assert first['inserted'] == 2 and len(first['errors']) == 1
+
+    # Sau khi bổ sung xã còn thiếu vào danh mục, tải lại đúng file đó phải đọc lại file
+    assert add_new_don_vi('Vĩnh Thạnh', 'Xã', units['kv_b'].id)['success']
+    second = _upload(path, tmp_path)
+    assert not second.get('already_imported')
+    assert second['inserted'] == 1 and not second['errors']
+    assert db.query(CaBenh).count() == 3
+
+
+def test_rollback_removes_only_the_batch_and_refreshes_rollup(db, units, tmp_path):
+    db.add(make_case(units['my_hoa'], 'TAY1', datetime(2024, 5, 1).date()))
+    rebuild_case_rollup(db)
+    db.commit()
+    path_a = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 3))
+    path_b = write_import_workbook(tmp_path / 'b.xlsx', _rows('B', 2, ten_xa='Tô Châu'))
+    batch_a = _upload(path_a, tmp_path)['lo_import_id']
+    _upload(path_b, tmp_path)
+    assert db.query(CaBenh).count() == 6
+
+    result = rollback_import_batch(db, batch_a)
+    assert result['success'] and result['deleted'] == 3
+    remaining = {ma_so for (ma_so,) in db.query(CaBenh.ma_so_benh_nhan)}
+    assert remaining == {'TAY1', 'B0', 'B1'}
+    assert db.get(LoImport, batch_a).trang_thai == 'da_hoan_tac'
+    assert rollup_rows(db) == rebuilt_rollup_rows(db)
+
+    assert not rollback_import_batch(db, batch_a)['success']
+    # File đã hoàn tác được import lại bình thường
+    again = _upload(path_a, tmp_path)
+    assert not again.get('already_imported') and again['inserted'] == 3
+
+
+def _versions(db, units) -> dict:
+    return {key: get_data_version(db, [units[key].id]) for key in ('my_hoa', 'to_chau')}
+
+
+def test_update_mode_writes_only_changed_cases(db, units, tmp_path):
+    rebuild_case_rollup(db)
+    db.commit()
+    rows = _rows('A', 4, tinh_trang_hien_nay='Điều trị nội trú') + _rows('T', 1, ten_xa='Tô Châu')
+    _upload(write_import_workbook(tmp_path / 'a.xlsx', rows), tmp_path)
+    before = _versions(db, units)
+
+    # A0 đổi tình trạng, A1 có thêm ngày ra viện (NULL -> ngày); A2, A3 (phân độ vẫn trống) và T0 giữ nguyên; A4 là ca mới
+    rows[0]['tinh_trang_hien_nay'] = 'Tử vong'
+    rows[1]['ngay_ra_vien'] = datetime(2024, 5, 10)
+    rows.append(_rows('A', 5)[4])
+    result = _upload(write_import_workbook(tmp_path / 'b.xlsx', rows), tmp_path, update_existing=True)
+    assert result['success']
+    assert (result['updated'], result['inserted'], result['skipped']) == (2, 1, 3)
+
+    batch = db.get(LoImport, result['lo_import_id'])
+    assert batch.so_ca_cap_nhat == 2 and batch.so_ca_them == 1
+    stored = {case.ma_so_benh_nhan: case for case in db.query(CaBenh)}
+    assert stored['A0'].tinh_trang_hien_nay == 'Tử vong' and stored['A0'].ngay_ra_vien is None
+    assert stored['A1'].ngay_ra_vien == date(2024, 5, 10)
+    assert stored['A2'].tinh_trang_hien_nay == 'Điều trị nội trú' and stored['A3'].phan_do_benh is None
+    # Ca được cập nhật vẫn thuộc lượt đã thêm nó
+    assert stored['A0'].lo_import_id == stored['A2'].lo_import_id != batch.id == stored['A4'].lo_import_id
+    assert rollup_rows(db) == rebuilt_rollup_rows(db)
+
+    after = _versions(db, units)
+    assert after['my_hoa'] > before['my_hoa'] and after['to_chau'] == before['to_chau']
+
+
+def test_update_mode_with_identical_file_changes_nothing(db, units, tmp_path):
+    rebuild_case_rollup(db)
+    db.commit()
+    path = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', 3, phan_do_benh='Sốt xuất huyết Dengue'))
+    _upload(path, tmp_path)
+    before, rollup_before = _versions(db, units), rollup_rows(db)
+
+    result = _upload(path, tmp_path, update_existing=True)
+    assert (result['updated'], result['inserted'], result['skipped']) == (0, 0, 3)
+    assert db.get(LoImport, result['lo_import_id']).so_ca_cap_nhat == 0
+    assert _versions(db, units) == before and rollup_rows(db) == rollup_before
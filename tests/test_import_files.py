@@ -0,0 +1,91 @@
+# file: tests/test_import_files.py
+
+import zipfile
+from datetime import datetime
+
+import pytest
+from openpyxl import load_workbook
+
+from conftest import write_import_workbook
+from webapp.core import data_importer
+from webapp.core.data_importer import import_data_from_files
+from webapp.core.database_setup import CaBenh
+
+
+@pytest.fixture(autouse=True)
+def _sequential_parse(monkeypatch):
+    """Đọc các nguồn ngay trong tiến trình test (không tạo tiến trình con)."""
+    monkeypatch.setattr(data_importer, 'IMPORT_PARSE_PROCESSES', 1)
+
+
+def _rows(prefix: str, days, ten_xa: str = 'Mỹ Hòa') -> list:
+    return [dict(ma_so_benh_nhan=f'{prefix}{day}', ho_ten=f'Người {prefix}{day}', ten_xa=ten_xa,
+                 ngay_khoi_phat=datetime(2024, 5, day)) for day in days]
+
+
+def _zip(path, members: dict) -> str:
+    """members: {tên trong zip: đường dẫn file hoặc nội dung bytes}."""
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, content in members.items():
+            if isinstance(content, bytes):
+                archive.writestr(name, content)
+            else:
+                archive.write(content, name)
+    return str(path)
+
+
+def _stored(db) -> dict:
+    return {case.ma_so_benh_nhan: case.ho_ten for case in db.query(CaBenh)}
+
+
+def test_zip_dedupes_across_files_and_skips_non_excel_entries(db, units, tmp_path):
+    a = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', [1, 2, 3]))
+    # b.xlsx lặp lại ca A2 (giữ bản của file đứng trước) và có một ca ở xã không có trong danh mục
+    b = write_import_workbook(tmp_path / 'b.xlsx', [dict(_rows('A', [2])[0], ho_ten='Bản của b')] + _rows('B', [4])
+                              + _rows('C', [5], ten_xa='Vĩnh Thạnh'))
+    upload = _zip(tmp_path / 'upload.zip', {
+        'a.xlsx': a, 'thu_muc/b.xlsx': b, 'ghi_chu.txt': b'khong phai excel', 'thu_muc/~$b.xlsx': b'khoa',
+        '__MACOSX/._a.xlsx': b'metadata', 'hong.xlsx': b'khong phai xlsx',
+    })
+    result = import_data_from_files(upload, display_name='upload.zip')
+    assert result['success'] and result['inserted'] == 4 and result['skipped'] == 1
+
+    files = {file['file']: file for file in result['files']}
+    assert set(files) == {'a.xlsx', 'thu_muc/b.xlsx', 'hong.xlsx'}
+    assert files['thu_muc/b.xlsx']['duplicates'] == 1 and files['thu_muc/b.xlsx']['invalid'] == 1
+    assert files['a.xlsx']['error'] is None and files['hong.xlsx']['error'].startswith('Lỗi khi đọc file')
+    assert [(error['file'], error['row']) for error in result['errors']] == [('thu_muc/b.xlsx', 4)]
+    assert _stored(db) == {'A1': 'Người A1', 'A2': 'Người A2', 'A3': 'Người A3', 'B4': 'Người B4'}
+
+
+def test_multi_sheet_workbook_imports_every_sheet(db, units, tmp_path):
+    path = write_import_workbook(tmp_path / 'book.xlsx', _rows('A', [1, 2]), extra_sheets={
+        'Tuần 2': _rows('A', [2]) + _rows('B', [3]),
+        'Ghi chú': [],
+    })
+    workbook = load_workbook(path)
+    workbook['Ghi chú'].delete_cols(1, 3)
+    workbook.save(path)
+
+    result = import_data_from_files(path, display_name='book.xlsx')
+    assert result['success'] and result['inserted'] == 3
+    files = {file['file']: file for file in result['files']}
+    assert list(files) == ['book.xlsx / Sheet', 'book.xlsx / Tuần 2', 'book.xlsx / Ghi chú']
+    assert files['book.xlsx / Tuần 2']['duplicates'] == 1
+    assert 'không tồn tại' in files['book.xlsx / Ghi chú']['error']
+    assert set(_stored(db)) == {'A1', 'A2', 'B3'}
+
+
+def test_zip_over_size_limit_is_rejected(db, units, tmp_path, monkeypatch):
+    a = write_import_workbook(tmp_path / 'a.xlsx', _rows('A', [1, 2]))
+    upload = _zip(tmp_path / 'upload.zip', {'a.xlsx': a, 'b.xlsx': a})
+    monkeypatch.setattr(data_importer, 'IMPORT_ZIP_MAX_MB', 0.001)
+    result = import_data_from_files(upload, display_name='upload.zip')
+    assert not result['success'] and 'vượt quá' in result['message']
+    assert db.query(CaBenh).count() == 0
+
+
+def test_zip_without_excel_files_is_rejected(db, units, tmp_path):
+    upload = _zip(tmp_path / 'upload.zip', {'ghi_chu.txt': b'khong phai excel'})
+    result = import_data_from_files(upload, display_name='upload.zip')
+    assert not result['success'] and '.xlsx' in result['message']
@@ -0,0 +1,72 @@
+# file: tests/test_import_preview.py
+
+import shutil
+from datetime import date, datetime
+
+import pytest
+
+from conftest import make_case, write_import_workbook
+from webapp.core import import_jobs
+from webapp.core.database_setup import CaBenh, LoImport
+from webapp.core.import_jobs import _run_preview_confirm_job, _run_preview_job, take_preview
+
+
+def _row(ma_so: str, day: int, ten_xa: str = 'Mỹ Hòa', **fields) -> dict:
+    return dict(ma_so_benh_nhan=ma_so, ho_ten=f'Người {ma_so}', ten_xa=ten_xa, ngay_khoi_phat=datetime(2024, 5, day), **fields)
+
+
+def _preview(path: str, tmp_path, owner_id: int = 1, **options) -> dict:
+    """Chạy xem trước như công việc nền (công việc xóa file tải lên nên dùng bản sao)."""
+    upload = tmp_path / f"upload_{datetime.now():%H%M%S%f}.xlsx"
+    shutil.copy(path, upload)
+    return _run_preview_job(str(upload), display_name='ca_benh.xlsx', owner_id=owner_id, **options)
+
+
+@pytest.fixture
+def workbook(db, units, tmp_path):
+    """A1 đã có trong CSDL (file đổi tình trạng), A0/A3 mới, A2 sai xã, A0 lặp lại trong file."""
+    db.add(make_case(units['my_hoa'], 'A1', date(2024, 5, 2), tinh_trang_hien_nay='Điều trị nội trú'))
+    db.commit()
+    return write_import_workbook(tmp_path / 'a.xlsx', [
+        _row('A0', 1), _row('A1', 2, tinh_trang_hien_nay='Ra viện'), _row('A2', 3, ten_xa='Vĩnh Thạnh'), _row('A3', 4), _row('A0', 1),
+    ])
+
+
+@pytest.mark.parametrize('update_existing', [False, True])
+def test_confirm_writes_what_preview_counted(db, workbook, tmp_path, update_existing):
+    result = _preview(workbook, tmp_path, update_existing=update_existing)
+    preview = result['preview']
+    assert (preview['moi'], preview['cap_nhat'], preview['da_co'], preview['khong_hop_le']) == (
+        (2, 1, 0, 1) if update_existing else (2, 0, 1, 1))
+    assert db.query(CaBenh).count() == 1 and db.query(LoImport).count() == 0
+
+    entry = take_preview(result['preview_token'], owner_id=1)
+    confirmed = _run_preview_confirm_job(entry)
+    assert confirmed['success']
+    assert confirmed['inserted'] == preview['moi'] and confirmed['updated'] == preview['cap_nhat']
+    assert confirmed['skipped'] == preview['da_co'] + preview['khong_hop_le']
+    assert [error['row'] for error in confirmed['errors']] == [4]
+
+    db.expire_all()
+    assert {ma_so for (ma_so,) in db.query(CaBenh.ma_so_benh_nhan)} == {'A0', 'A1', 'A3'}
+    status = db.query(CaBenh.tinh_trang_hien_nay).filter_by(ma_so_benh_nhan='A1').scalar()
+    assert status == ('Ra viện' if update_existing else 'Điều trị nội trú')
+    batch = db.get(LoImport, confirmed['lo_import_id'])
+    assert (batch.so_ca_them, batch.so_ca_cap_nhat, batch.cap_nhat_ca_da_co) == (2, preview['cap_nhat'], update_existing)
+
+
+def test_preview_token_is_single_use_and_owned(db, workbook, tmp_path):
+    token = _preview(workbook, tmp_path)['preview_token']
+    assert take_preview('khong-co-token', owner_id=1) is None
+    assert take_preview(token, owner_id=2) is None
+    assert take_preview(token, owner_id=1) is not None
+    assert take_preview(token, owner_id=1) is None
+
+
+def test_expired_preview_is_rejected(db, workbook, tmp_path):
+    token = _preview(workbook, tmp_path)['preview_token']
+    import_jobs._previews[token]['created_at'] -= import_jobs.IMPORT_PREVIEW_TTL_SECONDS + 1
+    assert take_preview(token, owner_id=1) is None
+    # Bản hết hạn được dọn khi lưu bản xem trước tiếp theo
+    _preview(workbook, tmp_path)
+    assert token not in import_jobs._previews
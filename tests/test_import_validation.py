@@ -0,0 +1,101 @@
+# file: tests/test_import_validation.py
+
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from conftest import write_import_workbook
+from webapp.core.data_importer import COLUMN_MAP, import_data_from_excel
+from webapp.core.database_setup import CaBenh
+from webapp.core.import_validation import validate_cases
+from webapp.core.place_names import PlaceNameIndex
+
+INDEX = PlaceNameIndex([(1, 'Mỹ Hòa'), (2, 'Tô Châu')], [(1, 'Ấp 1'), (2, 'Ấp 2')])
+TODAY = date(2024, 6, 1)
+VALID = dict(
+    ma_so_benh_nhan='A1', ho_ten='Người A', ngay_sinh=date(1990, 1, 1), gioi_tinh='Nam', dia_chi_chi_tiet=None,
+    ten_xa='Mỹ Hòa', dia_chi_ap='Ấp 1', ngay_khoi_phat=date(2024, 5, 1), ngay_nhap_vien=date(2024, 5, 2),
+    ngay_ra_vien=date(2024, 5, 5), chan_doan_chinh='Sốt xuất huyết Dengue', phan_do_benh='Sốt xuất huyết Dengue',
+    tinh_trang_hien_nay='Ra viện',
+)
+
+
+def _validate(changes: dict, user_xa_id: int = None):
+    """Một dòng hợp lệ (A1) và một dòng (A2) mang các giá trị cần kiểm tra."""
+    df = pd.DataFrame([VALID, dict(VALID, ma_so_benh_nhan='A2', **changes)])
+    return validate_cases(df, INDEX, user_xa_id, today=TODAY)
+
+
+def test_valid_rows_are_normalized():
+    valid, rejected = _validate({'gioi_tinh': 'nữ', 'tinh_trang_hien_nay': 'ra viện', 'ten_xa': 'xa to chau', 'dia_chi_ap': '2'})
+    assert rejected.empty
+    assert valid['xa_id'].tolist() == [1, 2]
+    row = valid.iloc[1]
+    assert (row['gioi_tinh'], row['tinh_trang_hien_nay'], row['dia_chi_ap']) == ('Nữ', 'Ra viện', 'Ấp 2')
+
+
+@pytest.mark.parametrize('changes, user_xa_id, message, columns', [
+    ({'ngay_khoi_phat': date(2024, 6, 2)}, None, "Ngày khởi phát ở tương lai.", ['ngay_khoi_phat']),
+    ({'ngay_nhap_vien': date(2024, 6, 2), 'ngay_ra_vien': None}, None, "Ngày nhập viện ở tương lai.", ['ngay_nhap_vien']),
+    ({'ngay_ra_vien': date(2024, 6, 5)}, None, "Ngày ra viện ở tương lai.", ['ngay_ra_vien']),
+    ({'ngay_sinh': date(2024, 5, 10)}, None, "Ngày khởi phát trước ngày sinh.", ['ngay_khoi_phat', 'ngay_sinh']),
+    ({'ngay_sinh': date(2024, 7, 1)}, None, "Ngày khởi phát trước ngày sinh.; Ngày sinh ở tương lai.", ['ngay_khoi_phat', 'ngay_sinh']),
+    ({'ngay_ra_vien': date(2024, 4, 30)}, None, "Ngày ra viện trước ngày nhập viện.", ['ngay_ra_vien', 'ngay_nhap_vien']),
+    ({'chan_doan_chinh': None, 'phan_do_benh': None}, None, "Thiếu chẩn đoán chính.", ['chan_doan_chinh']),
+    ({'chan_doan_chinh': 'Bệnh lạ', 'phan_do_benh': None}, None, "Chẩn đoán 'Bệnh lạ' không có trong danh mục.", ['chan_doan_chinh']),
+    ({'phan_do_benh': 'Độ 2a'}, None, "Phân độ 'Độ 2a' không phù hợp với chẩn đoán.", ['phan_do_benh']),
+    ({'tinh_trang_hien_nay': 'Khỏi'}, None, "Tình trạng 'Khỏi' không có trong danh mục.", ['tinh_trang_hien_nay']),
+    ({'gioi_tinh': 'Nam giới'}, None, "Giới tính 'Nam giới' không hợp lệ (Nam, Nữ, Khác).", ['gioi_tinh']),
+    ({'ten_xa': 'Vĩnh Thạnh'}, None, "Tên xã 'Vĩnh Thạnh' không hợp lệ.", ['ten_xa']),
+    ({'ten_xa': 'Tô Châu'}, 1, "Bạn chỉ có quyền import dữ liệu cho xã của mình.", ['ten_xa']),
+])
+def test_rule_rejects_row(changes, user_xa_id, message, columns):
+    valid, rejected = _validate(changes, user_xa_id)
+    assert valid['ma_so_benh_nhan'].tolist() == ['A1']
+    assert rejected['ma_so_benh_nhan'].tolist() == ['A2']
+    assert rejected['_loi'].tolist() == [message]
+    assert rejected['_cot_loi'].tolist() == [columns]
+
+
+def test_missing_required_columns_stop_the_import(db, units, tmp_path):
+    headers = [col for col in COLUMN_MAP if col not in ('Xã', 'Chẩn đoán chính')]
+    workbook = Workbook()
+    workbook.active.append(headers)
+    workbook.save(tmp_path / 'thieu_cot.xlsx')
+    result = import_data_from_excel(str(tmp_path / 'thieu_cot.xlsx'))
+    assert not result['success']
+    assert 'Xã' in result['message'] and 'Chẩn đoán chính' in result['message']
+
+    # Chỉ thiếu cột 'Ấp' thì vẫn import được
+    workbook = Workbook()
+    workbook.active.append([col for col in COLUMN_MAP if col != 'Ấp'])
+    workbook.active.append(['B1', 'Người B', None, 'Nam', None, 'Mỹ Hòa', datetime(2024, 5, 1), None, None,
+                            'Sởi', None, 'Ra viện'])
+    workbook.save(tmp_path / 'thieu_ap.xlsx')
+    assert import_data_from_excel(str(tmp_path / 'thieu_ap.xlsx'))['inserted'] == 1
+
+
+def test_rejected_rows_are_written_to_error_workbook(db, units, tmp_path):
+    future = datetime.now() + timedelta(days=30)
+    path = write_import_workbook(tmp_path / 'a.xlsx', [
+        dict(ma_so_benh_nhan='A1', ho_ten='Người A1', ten_xa='Mỹ Hòa', ngay_khoi_phat=datetime(2024, 5, 1)),
+        dict(ma_so_benh_nhan='A2', ho_ten='Người A2', ten_xa='Mỹ Hòa', ngay_khoi_phat=future),
+        dict(ma_so_benh_nhan='A3', ho_ten='Người A3', ten_xa='Tô Châu', ngay_khoi_phat=datetime(2024, 5, 3)),
+        dict(ma_so_benh_nhan='A4', ho_ten='Người A4', ten_xa='Vĩnh Thạnh', gioi_tinh='X', ngay_khoi_phat=datetime(2024, 5, 4)),
+    ])
+    result = import_data_from_excel(path, error_workbook=str(tmp_path / 'loi.xlsx'))
+    assert result['inserted'] == 2 and result['skipped'] == 2
+    assert [error['row'] for error in result['errors']] == [3, 5]
+    assert result['error_workbook'] == 'loi.xlsx'
+    assert {ma_so for (ma_so,) in db.query(CaBenh.ma_so_benh_nhan)} == {'A1', 'A3'}
+
+    sheet = load_workbook(tmp_path / 'loi.xlsx').active
+    rows = list(sheet.iter_rows())
+    header = [cell.value for cell in rows[0]]
+    assert header == ['Dòng'] + list(COLUMN_MAP) + ['Lỗi']
+    assert [(row[0].value, row[1].value) for row in rows[1:]] == [(3, 'A2'), (5, 'A4')]
+    marked = [{header[cell.column - 1] for cell in row if cell.fill.fill_type == 'solid'} for row in rows[1:]]
+    assert marked == [{'Ngày khởi phát'}, {'Xã', 'Giới tính'}]
+    assert rows[2][-1].value == "Tên xã 'Vĩnh Thạnh' không hợp lệ.; Giới tính 'X' không hợp lệ (Nam, Nữ, Khác)."
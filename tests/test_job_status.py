@@ -0,0 +1,47 @@
+# file: tests/test_job_status.py
+
+import pytest
+
+from webapp import create_app
+from webapp.core.jobs import JobManager
+from webapp.core.report_jobs import report_job_manager
+
+
+@pytest.fixture
+def client(db, units):
+    app = create_app()
+    client = app.test_client()
+    with client.session_transaction() as flask_session:
+        flask_session.update(user_id=1, role='admin', don_vi_id=units['tinh'].id)
+    return client
+
+
+def test_status_dict_is_built_from_the_fetched_job():
+    manager = JobManager(name='test')
+    job_id = manager.add_done({'filename': 'a.xlsx'}, owner_id=1, meta={'display_name': 'a.xlsx'})
+    job = manager.get(job_id)
+    manager._jobs.clear()
+    assert manager.to_status_dict(job_id) is None
+    status = manager.status_dict(job)
+    assert (status['job_id'], status['status'], status['result']) == (job_id, 'done', {'filename': 'a.xlsx'})
+
+
+def test_report_job_status_survives_job_pruned_between_reads(client, monkeypatch):
+    job_id = report_job_manager.add_done({'filename': 'bao_cao.xlsx', 'display_name': 'BC.xlsx'}, owner_id=1,
+                                         meta={'display_name': 'BC.xlsx'})
+    get = report_job_manager.get
+
+    def get_then_prune(requested_id):
+        job = get(requested_id)
+        report_job_manager._jobs.pop(requested_id, None)
+        return job
+
+    monkeypatch.setattr(report_job_manager, 'get', get_then_prune)
+    response = client.get(f'/report/status/{job_id}')
+    assert response.status_code == 200
+    assert response.get_json()['download_url'].endswith('/bao_cao.xlsx/BC.xlsx')
+
+
+def test_report_job_status_of_other_user_is_not_found(client):
+    job_id = report_job_manager.add_done({'filename': 'x.xlsx', 'display_name': 'x.xlsx'}, owner_id=2)
+    assert client.get(f'/report/status/{job_id}').status_code == 404
@@ -0,0 +1,26 @@
+# file: tests/test_place_names.py
+
+import pandas as pd
+
+from webapp.core.place_names import PlaceNameIndex
+
+INDEX = PlaceNameIndex(
+    [(1, 'Tô Châu'), (2, 'Châu'), (3, 'Phường 3'), (4, 'Mỹ Hòa')],
+    [(1, 'Tổ 3'), (1, 'Ấp 1'), (4, 'Ấp 2'), (4, 'Khóm 2')],
+)
+
+
+def test_xa_names_resolve_with_prefixes_accents_and_case():
+    names = pd.Series(['Phường Tô Châu', 'P. Tô Châu', 'tô châu', 'Xã Châu', 'Phường 03', 'P.3', 'xa my hoa', 'Hòa'])
+    assert INDEX.xa_ids(names).tolist()[:7] == [1, 1, 1, 2, 3, 3, 4]
+    assert pd.isna(INDEX.xa_ids(names).iloc[7])
+
+
+def test_ap_names_resolve_within_their_xa():
+    df = pd.DataFrame({
+        'xa_id': [1, 1, 1, 1, 4, 4],
+        'dia_chi_ap': ['Ấp Tổ 3', 'tổ 3', '3', 'ap 01', '2', 'Khóm 2'],
+        'dia_chi_chi_tiet': [None] * 6,
+    })
+    # "2" khớp cả "Ấp 2" và "Khóm 2" của cùng xã nên được giữ nguyên
+    assert INDEX.resolve_ap(df)['dia_chi_ap'].tolist() == ['Tổ 3', 'Tổ 3', 'Tổ 3', 'Ấp 1', '2', 'Khóm 2']
@@ -0,0 +1,70 @@
+# file: tests/test_report_cache.py
+
+from datetime import date
+
+from conftest import make_case
+from webapp.core.admin_utils import update_case
+from webapp.core import report_cache
+from webapp.core.report_cache import get_or_render_report, get_report_cache_key
+from webapp.core.utils import get_all_child_xa_ids
+
+SCOPE = {'report_template': 'Báo cáo Sốt Xuất Huyết', 'year': 2024, 'period': 'week', 'period_number': 20}
+
+
+def _key(db, unit):
+    return get_report_cache_key(db, get_all_child_xa_ids(unit), don_vi_id=unit.id, **SCOPE)
+
+
+def _seed(db, units):
+    my_hoa = make_case(units['my_hoa'], 'C1', date(2024, 5, 14))
+    binh_duc = make_case(units['binh_duc'], 'C2', date(2024, 5, 14))
+    db.add_all([my_hoa, binh_duc])
+    db.commit()
+    return my_hoa, binh_duc
+
+
+def test_key_is_stable_until_data_changes(db, units):
+    _seed(db, units)
+    assert _key(db, units['kv_a']) == _key(db, units['kv_a'])
+    assert _key(db, units['kv_a']) != _key(db, units['kv_b'])
+    assert _key(db, units['kv_a']) != get_report_cache_key(
+        db, get_all_child_xa_ids(units['kv_a']), don_vi_id=units['kv_a'].id, **dict(SCOPE, period_number=21))
+
+
+def test_format_version_changes_key(db, units, monkeypatch):
+    _seed(db, units)
+    before = _key(db, units['kv_a'])
+    monkeypatch.setattr(report_cache, 'REPORT_FORMAT_VERSION', report_cache.REPORT_FORMAT_VERSION + 1)
+    assert _key(db, units['kv_a']) != before
+
+
+def test_case_edit_changes_key_of_units_in_scope_only(db, units):
+    my_hoa, _ = _seed(db, units)
+    before = {key: _key(db, units[key]) for key in ('tinh', 'kv_a', 'my_hoa', 'kv_b')}
+
+    assert update_case(my_hoa.id, {'tinh_trang_hien_nay': 'Tử vong'}, db_session=db)['success']
+    after = {key: _key(db, units[key]) for key in before}
+    assert after['tinh'] != before['tinh']
+    assert after['kv_a'] != before['kv_a']
+    assert after['my_hoa'] != before['my_hoa']
+    assert after['kv_b'] == before['kv_b']
+
+
+def test_cached_report_is_rendered_again_after_case_edit(db, units, tmp_path):
+    my_hoa, _ = _seed(db, units)
+    xa_ids = get_all_child_xa_ids(units['kv_a'])
+    renders = []
+
+    def render(filepath):
+        renders.append(filepath)
+        with open(filepath, 'w') as f:
+            f.write('báo cáo')
+
+    def report():
+        return get_or_render_report(db, str(tmp_path), xa_ids, '.xlsx', render, don_vi_id=units['kv_a'].id, **SCOPE)
+
+    first = report()
+    assert report() == first and len(renders) == 1
+
+    update_case(my_hoa.id, {'ngay_ra_vien': date(2024, 5, 20)}, db_session=db)
+    assert report() != first and len(renders) == 2
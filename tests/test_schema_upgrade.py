@@ -0,0 +1,33 @@
+# file: tests/test_schema_upgrade.py
+
+from sqlalchemy import Column, ForeignKey, MetaData, Table, create_engine, inspect
+
+from webapp.core.database_setup import ADDED_COLUMNS, Base, upgrade_schema
+
+
+def _old_metadata() -> MetaData:
+    """Cấu trúc CSDL của bản cũ: chưa có các cột trong ADDED_COLUMNS và chưa có bảng tổng hợp."""
+    added = {(model.__tablename__, column_name) for model, column_name in ADDED_COLUMNS}
+    old = MetaData()
+    for table in Base.metadata.sorted_tables:
+        if table.name == 'tong_hop_ca_benh':
+            continue
+        Table(table.name, old, *[
+            Column(col.name, col.type, *[ForeignKey(fk.target_fullname) for fk in col.foreign_keys], primary_key=col.primary_key)
+            for col in table.columns if (table.name, col.name) not in added
+        ])
+    return old
+
+
+def test_upgrade_adds_columns_missing_from_an_existing_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'cu.sqlite'}")
+    _old_metadata().create_all(engine)
+
+    upgrade_schema(engine)
+    upgrade_schema(engine)
+
+    inspector = inspect(engine)
+    for model, column_name in ADDED_COLUMNS:
+        assert column_name in {col['name'] for col in inspector.get_columns(model.__tablename__)}
+    assert 'ix_ca_benh_lo_import_id' in {index['name'] for index in inspector.get_indexes('ca_benh')}
+    assert inspector.has_table('tong_hop_ca_benh')
@@ -1,6 +1,7 @@
 # file: webapp/__init__.py
 
 import os
+import multiprocessing
 from datetime import datetime
 from flask import Flask, session, redirect, url_for
 from flask_caching import Cache
@@ -47,6 +48,35 @@ def create_app():
     # Cấu hình thư mục báo cáo
     app.config['REPORT_FOLDER'] = os.path.join(app.instance_path, 'reports')
     os.makedirs(app.config['REPORT_FOLDER'], exist_ok=True)
+
+    # Các luồng nền chỉ chạy ở tiến trình chính: tiến trình con (vd. tiến trình đọc file import, khởi tạo
+    # bằng 'spawn') nạp lại module chính và có thể gọi create_app() lần nữa
+    if multiprocessing.parent_process() is None:
+        # Nâng cấp cấu trúc CSDL đang chạy (bảng, cột mới) trước khi nhận request. Không nâng cấp được thì
+        # dừng khởi động: chạy tiếp với CSDL thiếu cột thì mọi truy vấn ca_benh đều lỗi
+        from sqlalchemy.exc import SQLAlchemyError
+        from .core.database_setup import upgrade_schema
+        from .core.database_utils import engine
+        try:
+            upgrade_schema(engine)
+        except SQLAlchemyError as e:
+            raise RuntimeError(f"Lỗi nâng cấp cấu trúc CSDL, ứng dụng không khởi động: {e}") from e
+
+        # Dựng bảng tổng hợp ca bệnh cho báo cáo nếu chưa có (lần đầu chạy bản có bảng tổng hợp)
+        from .core.case_rollup import ensure_case_rollup
+        from .core.database_utils import session_scope
+        with session_scope() as db:
+            so_dong = ensure_case_rollup(db)
+        if so_dong is not None:
+            print(f"--- Đã dựng bảng tổng hợp ca bệnh ({so_dong} dòng) ---")
+
+        # Dọn dẹp định kỳ thư mục báo cáo (giới hạn dung lượng, tuổi file, số file mỗi người dùng)
+        from .core.report_store import start_report_store_sweeper
+        start_report_store_sweeper(app.config['REPORT_FOLDER'])
+
+        # Tạo sẵn báo cáo tuần/tháng vừa kết thúc cho các đơn vị có người dùng
+        from .core.report_prerender import start_report_prerender
+        start_report_prerender(app.config['REPORT_FOLDER'])
     
     # Kết nối Cache với app
     cache.init_app(app)
@@ -0,0 +1,87 @@
+# file: webapp/core/case_options.py
+
+# ==============================================================================
+# DANH MỤC GIÁ TRỊ CỦA CA BỆNH
+# ==============================================================================
+# Dùng chung cho form nhập/sửa ca bệnh và bước kiểm tra dữ liệu khi import.
+CASE_OPTIONS = {
+    'chan_doan_chinh': [
+    'Dịch hạch',
+    'Cúm A(H5N1)',
+    'Cúm A(H7N9)',
+    'Viêm đường hô hấp Trung đông (MERS-CoV)',
+    'Ê-bô-la (Ebolla)',
+    'Lát-sa (Lassa)',
+    'Mác-bớt (Marburg)',
+    'Sốt Tây sông Nin',
+    'Sốt Vàng',
+    'Than',
+    'Bệnh truyền nhiễm nguy hiểm và Bệnh chưa rõ tác nhân gây bệnh',
+
+    # Nhóm B
+    'Bạch hầu',
+    'Bệnh do liên cầu lợn ở người',
+    'COVID-19',
+    'Dại',
+    'Ho gà',
+    'Lao phổi',
+    'Liệt mềm cấp nghi bại liệt',
+    'Rubella (Rubeon)',
+    'Sởi',
+    'Sốt rét',
+    'Sốt xuất huyết Dengue',
+    'Tả',
+    'Tay - chân - miệng',
+    'Thương hàn',
+    'Thủy đậu',
+    'Uốn ván sơ sinh',
+    'Uốn ván khác',
+    'Viêm gan vi rút A',
+    'Viêm gan vi rút B',
+    'Viêm gan vi rút C',
+    'Viêm gan vi rút khác',
+    'Viêm màng não do não mô cầu',
+    'Viêm não Nhật bản',
+    'Viêm não vi rút khác',
+    'Xoắn khuẩn vàng da (Leptospira)',
+    'Zika',
+    'Chikungunya',
+    
+    # Nhóm C
+    'Bệnh do vi rút Adeno',
+    'Cúm',
+    'Lỵ amíp',
+    'Lỵ trực trùng',
+    'Quai bị',
+    'Tiêu chảy',
+    
+    # Các mục khác
+    'Thay đổi chẩn đoán- Bệnh không thuộc danh mục',
+    'Đã điều tra nhưng không có ca bệnh trên địa bàn'
+    ],
+    'phan_do_benh': {
+        'Sốt xuất huyết Dengue': [
+            'Sốt xuất huyết Dengue',
+            'Sốt xuất huyết Dengue có dấu hiệu cảnh báo',
+            'Sốt xuất huyết Dengue nặng'
+        ],
+        'Tay - chân - miệng': [
+            'Độ 1',
+            'Độ 2a',
+            'Độ 2b',
+            'Độ 3',
+            'Độ 4'
+        ]
+        # Thêm các bệnh khác nếu cần
+    },
+    'tinh_trang_hien_nay': [
+        'Điều trị ngoại trú',
+        'Điều trị nội trú',
+        'Ra viện',
+        'Tử vong',
+        'Chuyển viện',
+        'Tình trạng khác'
+    ]
+}
+
+GIOI_TINH_OPTIONS = ['Nam', 'Nữ', 'Khác']
@@ -0,0 +1,123 @@
+# file: webapp/core/case_rollup.py
+
+import os
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import select, insert, delete, func, or_, and_
+from sqlalchemy.orm import Session
+
+from .database_setup import CaBenh, TongHopCaBenh, PhienBanDuLieu
+from .sql_compat import age_years, upsert, advisory_xact_lock
+
+# ==============================================================================
+# BẢNG TỔNG HỢP CA BỆNH (tong_hop_ca_benh)
+# ==============================================================================
+# Mỗi dòng là số ca của một nhóm (xã, ấp, chẩn đoán, phân độ, ngày khởi phát, ngày import, tử vong, ≤15 tuổi).
+# Nhóm theo ngày (không theo tuần) để phục vụ được cả kỳ tuần, kỳ tháng, khoảng ngày tùy chỉnh
+# và điều kiện "bổ sung" (ngày import trong kỳ, khởi phát trước kỳ). Tuần báo cáo theo WeekCalendar không
+# trùng tuần ISO và mốc "cùng kỳ năm trước" cắt giữa tuần/tháng, nên gộp theo tuần/tháng không dùng được;
+# số dòng chủ yếu do tổ hợp xã x ấp x chẩn đoán x phân độ, gộp theo tháng cũng chỉ bớt vài phần trăm.
+# Khi ca bệnh thay đổi, các nhóm thuộc (xã, ngày khởi phát) bị ảnh hưởng được tính lại từ ca_benh.
+
+# REPORT_USE_ROLLUP=0 để báo cáo luôn đọc trực tiếp từ ca_benh
+REPORT_USE_ROLLUP = os.getenv("REPORT_USE_ROLLUP", "1") == "1"
+
+# Dấu hiệu bảng tổng hợp đã được dựng đầy đủ (lưu trong phien_ban_du_lieu)
+ROLLUP_READY_KEY = 'tong_hop_ca_benh'
+
+# Khóa advisory để các transaction cập nhật bảng tổng hợp không chèn trùng nhóm của nhau
+_ROLLUP_LOCK_ID = 72310701
+
+_REFRESH_CHUNK_SIZE = 1000
+
+
+def _rollup_select():
+    """Truy vấn gom nhóm ca_benh thành các dòng của bảng tổng hợp."""
+    is_death = func.coalesce(CaBenh.tinh_trang_hien_nay == 'Tử vong', False)
+    is_under_15 = func.coalesce(age_years(CaBenh.ngay_khoi_phat, CaBenh.ngay_sinh) <= 15, False)
+    group_cols = [
+        CaBenh.xa_id, CaBenh.dia_chi_ap, CaBenh.chan_doan_chinh, CaBenh.phan_do_benh,
+        CaBenh.ngay_khoi_phat, CaBenh.ngay_import, is_death, is_under_15
+    ]
+    return (
+        select(*group_cols, func.count().label('so_ca'))
+        .where(CaBenh.ngay_khoi_phat.isnot(None))
+        .group_by(*group_cols)
+    )
+
+
+def _insert_from(stmt):
+    columns = ['xa_id', 'dia_chi_ap', 'chan_doan_chinh', 'phan_do_benh', 'ngay_khoi_phat', 'ngay_import', 'is_death', 'is_under_15', 'so_ca']
+    return insert(TongHopCaBenh).from_select(columns, stmt)
+
+
+def _keys_criteria(model, keys):
+    """
+    Điều kiện (xa_id, ngay_khoi_phat) thuộc `keys`, viết dạng xa_id = x AND ngay_khoi_phat IN (...) cho từng xã
+    để dùng được chỉ mục (so khớp tuple IN phải duyệt cả bảng và so từng dòng với mọi cặp).
+    """
+    dates_by_xa = defaultdict(list)
+    for xa_id, ngay in keys:
+        dates_by_xa[xa_id].append(ngay)
+    return or_(*[and_(model.xa_id == xa_id, model.ngay_khoi_phat.in_(dates)) for xa_id, dates in dates_by_xa.items()])
+
+
+def _lock(db_session: Session):
+    advisory_xact_lock(db_session, _ROLLUP_LOCK_ID)
+
+
+def is_case_rollup_ready(db_session: Session) -> bool:
+    return db_session.query(PhienBanDuLieu.khoa).filter(PhienBanDuLieu.khoa == ROLLUP_READY_KEY).first() is not None
+
+
+def use_case_rollup(db_session: Session) -> bool:
+    """Báo cáo có đọc từ bảng tổng hợp hay không (đã bật và bảng đã được dựng)."""
+    return REPORT_USE_ROLLUP and is_case_rollup_ready(db_session)
+
+
+def rebuild_case_rollup(db_session: Session) -> int:
+    """
+    Dựng lại toàn bộ bảng tổng hợp từ ca_benh và đánh dấu sẵn sàng.
+    Chạy trong transaction của nơi gọi, không tự commit. Trả về số dòng tổng hợp.
+    """
+    db_session.flush()
+    _lock(db_session)
+    db_session.execute(delete(TongHopCaBenh))
+    result = db_session.execute(_insert_from(_rollup_select()))
+    marker = upsert(db_session, PhienBanDuLieu).values(khoa=ROLLUP_READY_KEY, phien_ban=1, cap_nhat_luc=datetime.now())
+    db_session.execute(marker.on_conflict_do_update(index_elements=['khoa'], set_={'phien_ban': PhienBanDuLieu.phien_ban + 1, 'cap_nhat_luc': datetime.now()}))
+    return result.rowcount
+
+
+def ensure_case_rollup(db_session: Session):
+    """
+    Dựng bảng tổng hợp nếu chưa có dấu hiệu sẵn sàng (CSDL mới hoặc vừa nâng cấp) và commit.
+    Gọi khi ứng dụng khởi động; các tiến trình khởi động cùng lúc chờ khóa và chỉ một bên dựng.
+    Trả về số dòng tổng hợp đã dựng, None nếu bảng đã sẵn sàng.
+    """
+    if is_case_rollup_ready(db_session):
+        return None
+    _lock(db_session)
+    if is_case_rollup_ready(db_session):
+        db_session.rollback()
+        return None
+    so_dong = rebuild_case_rollup(db_session)
+    db_session.commit()
+    return so_dong
+
+
+def refresh_case_rollup(db_session: Session, keys):
+    """
+    Tính lại các nhóm tổng hợp của những cặp (xa_id, ngay_khoi_phat) vừa có ca bệnh thêm/sửa/xóa.
+    Gọi sau khi đã thay đổi ca_benh và trước commit, để bảng tổng hợp luôn khớp với dữ liệu đã lưu.
+    Bỏ qua nếu bảng tổng hợp chưa được dựng (báo cáo khi đó vẫn đọc trực tiếp ca_benh).
+    """
+    keys = list({(int(xa_id), ngay) for xa_id, ngay in keys if xa_id is not None and ngay is not None})
+    if not keys or not is_case_rollup_ready(db_session):
+        return
+    db_session.flush()
+    _lock(db_session)
+    for i in range(0, len(keys), _REFRESH_CHUNK_SIZE):
+        chunk = keys[i:i + _REFRESH_CHUNK_SIZE]
+        db_session.execute(delete(TongHopCaBenh).where(_keys_criteria(TongHopCaBenh, chunk)))
+        db_session.execute(_insert_from(_rollup_select().where(_keys_criteria(CaBenh, chunk))))
@@ -7,19 +7,19 @@ import plotly.express as px
 import plotly.graph_objects as go # <-- Import thêm graph_objects
 import json
 from sqlalchemy import func
+from sqlalchemy.orm import Session
 from datetime import date, timedelta
 
-from .database_utils import get_db_session
+from .database_utils import session_scope
 from .database_setup import CaBenh, DonViHanhChinh as DonVi
 from .utils import get_all_child_xa_ids
 
 
-def get_weekly_case_counts_for_comparison(user_don_vi, disease_filter: str = None, khu_vuc_id: str = None, xa_id: str = None):
+def get_weekly_case_counts_for_comparison(user_don_vi, disease_filter: str = None, khu_vuc_id: str = None, xa_id: str = None, db_session: Session = None):
     """
     Lấy dữ liệu số ca bệnh theo tuần của NĂM NAY và NĂM TRƯỚC để so sánh.
     """
-    db = get_db_session()
-    try:
+    with session_scope(db_session) as db:
         if xa_id:
             xa_ids_to_query = [int(xa_id)]
         elif khu_vuc_id:
@@ -50,7 +50,7 @@ def get_weekly_case_counts_for_comparison(user_don_vi, disease_filter: str = Non
         if disease_filter and disease_filter != 'Tất cả':
             query = query.filter(CaBenh.chan_doan_chinh == disease_filter)
         
-        df_dates = pd.read_sql(query.statement, query.session.bind)
+        df_dates = pd.read_sql(query.statement, db.connection())
         
         if df_dates.empty:
             return pd.DataFrame(), current_year, previous_year
@@ -84,25 +84,20 @@ def get_weekly_case_counts_for_comparison(user_don_vi, disease_filter: str = Non
         df_final.loc[df_final['week'] > current_week, f'Năm {current_year}'] = None
 
         return df_final, current_year, previous_year
-    finally:
-        db.close()
 
 
-def create_cases_by_week_chart(user_don_vi, disease_filter: str = None, khu_vuc_id: str = None, xa_id: str = None):
+def create_cases_by_week_chart(user_don_vi, disease_filter: str = None, khu_vuc_id: str = None, xa_id: str = None, db_session: Session = None):
     """
     Tạo biểu đồ đường so sánh số ca mắc giữa năm nay và năm trước.
     """
-    df, current_year, previous_year = get_weekly_case_counts_for_comparison(user_don_vi, disease_filter, khu_vuc_id, xa_id)
+    df, current_year, previous_year = get_weekly_case_counts_for_comparison(user_don_vi, disease_filter, khu_vuc_id, xa_id, db_session)
     
     location_name = user_don_vi.ten_don_vi
-    db = get_db_session()
-    try:
+    with session_scope(db_session) as db:
         if xa_id:
             location_name = db.query(DonVi.ten_don_vi).filter(DonVi.id == int(xa_id)).scalar() or location_name
         elif khu_vuc_id:
             location_name = db.query(DonVi.ten_don_vi).filter(DonVi.id == int(khu_vuc_id)).scalar() or location_name
-    finally:
-        db.close()
 
     if disease_filter and disease_filter != 'Tất cả':
         title = f'Diễn biến ca {disease_filter} tại {location_name}'
@@ -145,12 +140,11 @@ def create_cases_by_week_chart(user_don_vi, disease_filter: str = None, khu_vuc_
     return json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
 
 # <<< THAY ĐỔI MỚI: Thêm tham số khu_vuc_id và xa_id
-def get_top_diseases(user_don_vi, start_date: date, end_date: date, khu_vuc_id: str = None, xa_id: str = None):
+def get_top_diseases(user_don_vi, start_date: date, end_date: date, khu_vuc_id: str = None, xa_id: str = None, db_session: Session = None):
     """
     Truy vấn CSDL, tổng hợp và trả về top các bệnh có số ca mắc cao nhất.
     """
-    db = get_db_session()
-    try:
+    with session_scope(db_session) as db:
         # <<< THAY ĐỔI MỚI: Logic xác định danh sách xã cần truy vấn
         if xa_id:
             xa_ids_to_query = [int(xa_id)]
@@ -172,10 +166,8 @@ def get_top_diseases(user_don_vi, start_date: date, end_date: date, khu_vuc_id:
             CaBenh.ngay_khoi_phat <= end_date
         ).group_by(CaBenh.chan_doan_chinh).order_by(func.count(CaBenh.id).desc())
         
-        df = pd.read_sql(query.statement, query.session.bind)
+        df = pd.read_sql(query.statement, db.connection())
         return df
-    finally:
-        db.close()
 
 
 # Các hàm tạo biểu đồ còn lại không cần thay đổi
@@ -1,11 +1,30 @@
 # webapp/core/data_importer.py
 
+import io
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
 import pandas as pd
 import numpy as np
-from sqlalchemy import text
+from sqlalchemy import text, select, tuple_
 from sqlalchemy.orm import Session
-from .database_setup import CaBenh, DonViHanhChinh
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from .database_setup import CaBenh
 from .database_utils import get_db_session
+from .data_version import bump_data_version
+from .case_rollup import refresh_case_rollup
+from .import_validation import validate_cases, rejected_errors
+from .place_names import get_place_index
+from .sql_compat import dialect_name
 import traceback
 
 # Helper function này không thay đổi
@@ -22,49 +41,320 @@ COLUMN_MAP = {
     'Phân độ bệnh': 'phan_do_benh', 'Tình trạng hiện nay': 'tinh_trang_hien_nay'
 }
 
-def import_data_from_excel(filepath: str, user_xa_id: int = None):
+# Các cột ghi vào ca_benh (ngay_import được gán khi chèn)
+CASE_IMPORT_COLUMNS = [col for col in COLUMN_MAP.values() if col != 'ten_xa'] + ['xa_id']
+CASE_KEY_COLUMNS = ['ma_so_benh_nhan', 'ngay_khoi_phat', 'chan_doan_chinh']
+# Các cột diễn biến bệnh được cập nhật cho ca đã có khi import ở chế độ cập nhật (update_existing)
+CASE_UPDATE_COLUMNS = ['ngay_nhap_vien', 'ngay_ra_vien', 'phan_do_benh', 'tinh_trang_hien_nay']
+
+# Số dòng mỗi lượt kiểm tra trùng lặp ở nhánh không dùng COPY
+BATCH_SIZE = 5000
+
+# Xem trước import: trạng thái của từng dòng, số dòng mẫu và các cột hiển thị trong mẫu
+PREVIEW_STATUSES = ['moi', 'cap_nhat', 'da_co', 'khong_hop_le']
+PREVIEW_SAMPLE_ROWS = 20
+PREVIEW_SAMPLE_COLUMNS = ['ma_so_benh_nhan', 'ho_ten', 'ten_xa', 'dia_chi_ap', 'ngay_khoi_phat', 'chan_doan_chinh']
+
+
+def _insert_cases_copy(db_session: Session, df: pd.DataFrame, lo_import_id: int = None, update_existing: bool = False):
+    """
+    PostgreSQL: COPY toàn bộ dữ liệu vào bảng tạm rồi INSERT ... SELECT ... ON CONFLICT DO NOTHING.
+    Ràng buộc UNIQUE quyết định ca nào đã có, nên hai lượt import trùng nhau chạy cùng lúc không chèn trùng.
+    Với `update_existing`, trước đó một câu UPDATE ... FROM bảng tạm ghi các cột CASE_UPDATE_COLUMNS
+    cho những ca đã có (cùng khóa, cùng xã) mà giá trị thực sự khác.
+    Trả về (các ca được chèn, các ca được cập nhật) dạng danh sách (xa_id, ngay_khoi_phat).
+    """
+    columns = ", ".join(CASE_IMPORT_COLUMNS)
+    db_session.execute(text("DROP TABLE IF EXISTS tmp_import_ca_benh"))
+    db_session.execute(text(f"CREATE TEMP TABLE tmp_import_ca_benh ON COMMIT DROP AS SELECT {columns} FROM ca_benh WITH NO DATA"))
+
+    # Giá trị thiếu ghi là \N (COPY ... NULL '\N'): ô rỗng không đặt trong ngoặc kép vẫn là chuỗi rỗng như ở SQLite
+    buffer = io.StringIO()
+    df[CASE_IMPORT_COLUMNS].to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+    cursor = db_session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY tmp_import_ca_benh ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+
+    updated_keys = []
+    if update_existing:
+        assignments = ", ".join(f"{col} = t.{col}" for col in CASE_UPDATE_COLUMNS)
+        changed = " OR ".join(f"c.{col} IS DISTINCT FROM t.{col}" for col in CASE_UPDATE_COLUMNS)
+        matched = " AND ".join(f"c.{col} = t.{col}" for col in CASE_KEY_COLUMNS + ['xa_id'])
+        result = db_session.execute(text(f"""
+            UPDATE ca_benh AS c SET {assignments}
+            FROM tmp_import_ca_benh AS t
+            WHERE {matched} AND ({changed})
+            RETURNING c.xa_id, c.ngay_khoi_phat
+        """))
+        updated_keys = [(row.xa_id, row.ngay_khoi_phat) for row in result]
+
+    result = db_session.execute(text(f"""
+        INSERT INTO ca_benh ({columns}, ngay_import, lo_import_id)
+        SELECT {columns}, :ngay_import, :lo_import_id FROM tmp_import_ca_benh
+        ON CONFLICT ON CONSTRAINT _ma_so_ngay_khoi_phat_chan_doan_uc DO NOTHING
+        RETURNING xa_id, ngay_khoi_phat
+    """), {"ngay_import": date.today(), "lo_import_id": lo_import_id})
+    return [(row.xa_id, row.ngay_khoi_phat) for row in result], updated_keys
+
+
+def _changed_cases(df: pd.DataFrame, existing: pd.DataFrame) -> pd.DataFrame:
+    """Các ca đã có (cùng khóa, cùng xã) mà cột CASE_UPDATE_COLUMNS trong file khác giá trị đang lưu, kèm id của ca."""
+    merged = df[CASE_KEY_COLUMNS + ['xa_id'] + CASE_UPDATE_COLUMNS].merge(
+        existing, on=CASE_KEY_COLUMNS + ['xa_id'], suffixes=('', '_cu')
+    )
+    changed = pd.Series(False, index=merged.index)
+    for col in CASE_UPDATE_COLUMNS:
+        new, old = merged[col], merged[f'{col}_cu']
+        changed |= ~((new == old) | (new.isna() & old.isna()))
+    return merged[changed]
+
+
+def _update_changed_cases(db_session: Session, df: pd.DataFrame, existing: pd.DataFrame) -> list:
+    """
+    So các cột CASE_UPDATE_COLUMNS của file với ca đã có (cùng khóa, cùng xã) và bulk update các ca có giá trị khác.
+    Trả về danh sách (xa_id, ngay_khoi_phat) của các ca được cập nhật.
+    """
+    merged = _changed_cases(df, existing)
+    if merged.empty:
+        return []
+    db_session.bulk_update_mappings(CaBenh, merged[['id'] + CASE_UPDATE_COLUMNS].to_dict('records'))
+    return list(zip(merged['xa_id'], merged['ngay_khoi_phat']))
+
+
+def _existing_cases(db_session: Session, df: pd.DataFrame, with_values: bool = False) -> pd.DataFrame:
+    """
+    Các ca đã có trong CSDL trùng khóa với `df`, tra theo từng batch BATCH_SIZE khóa.
+    Cột: id và CASE_KEY_COLUMNS; với `with_values` thêm xa_id và CASE_UPDATE_COLUMNS để so sánh khi cập nhật.
+    """
+    keys = list(df[CASE_KEY_COLUMNS].itertuples(index=False, name=None))
+    existing_rows = []
+    key_columns = tuple_(CaBenh.ma_so_benh_nhan, CaBenh.ngay_khoi_phat, CaBenh.chan_doan_chinh)
+    selected = [CaBenh.id, CaBenh.ma_so_benh_nhan, CaBenh.ngay_khoi_phat, CaBenh.chan_doan_chinh]
+    if with_values:
+        selected += [CaBenh.xa_id] + [getattr(CaBenh, col) for col in CASE_UPDATE_COLUMNS]
+    for batch_start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[batch_start: batch_start + BATCH_SIZE]
+        existing_rows.extend(db_session.execute(select(*selected).where(key_columns.in_(batch))).all())
+    return pd.DataFrame(existing_rows, columns=[col.key for col in selected])
+
+
+def _insert_cases_checked(db_session: Session, df: pd.DataFrame, lo_import_id: int = None, update_existing: bool = False):
+    """
+    Các CSDL khác (SQLite): tìm các ca đã có theo từng batch rồi chèn hàng loạt những dòng còn lại.
+    Với `update_existing`, các ca đã có mà cột CASE_UPDATE_COLUMNS khác được cập nhật hàng loạt.
+    Trả về (các ca được chèn, các ca được cập nhật) dạng danh sách (xa_id, ngay_khoi_phat).
+    """
+    keys = list(df[CASE_KEY_COLUMNS].itertuples(index=False, name=None))
+    existing = _existing_cases(db_session, df, with_values=update_existing)
+    existing_keys = set(existing[CASE_KEY_COLUMNS].itertuples(index=False, name=None))
+
+    updated_keys = []
+    if update_existing and not existing.empty:
+        updated_keys = _update_changed_cases(db_session, df, existing)
+
+    df_new_cases = df[[key not in existing_keys for key in keys]]
+    if df_new_cases.empty:
+        return [], updated_keys
+    db_session.bulk_insert_mappings(CaBenh, df_new_cases[CASE_IMPORT_COLUMNS].assign(lo_import_id=lo_import_id).to_dict('records'))
+    return list(zip(df_new_cases['xa_id'], df_new_cases['ngay_khoi_phat'])), updated_keys
+
+
+def _check_columns(df: pd.DataFrame):
+    """Kiểm tra các cột bắt buộc; thêm cột 'Ấp' rỗng nếu chỉ thiếu cột này. Trả về thông báo lỗi hoặc None."""
+    missing_cols = set(COLUMN_MAP.keys()) - set(df.columns)
+    if missing_cols:
+        if 'Ấp' in missing_cols and len(missing_cols) == 1:
+            df['Ấp'] = None
+        else:
+            return f"Lỗi: Các cột sau không tồn tại: {', '.join(missing_cols)}"
+    return None
+
+
+def _clean_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Đổi tên cột, làm sạch chuỗi, chuyển ngày và bỏ các dòng không có mã số hoặc ngày khởi phát.
+    Ô chỉ có khoảng trắng ở các cột chuỗi chính được coi là ô trống.
+    """
+    df = df[list(COLUMN_MAP.keys())].rename(columns=COLUMN_MAP)
+
+    # Vector hóa làm sạch và chuyển đổi
+    str_cols = ['ma_so_benh_nhan', 'ho_ten', 'ten_xa', 'chan_doan_chinh']
+    for col in str_cols:
+        cleaned = df[col].astype(str).str.strip()
+        df[col] = cleaned.mask(cleaned == '')
+
+    date_cols = ['ngay_sinh', 'ngay_khoi_phat', 'ngay_nhap_vien', 'ngay_ra_vien']
+    for col in date_cols:
+        df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True).dt.date
+
+    # Thay thế NaN/NaT bằng None
+    df = df.replace({pd.NaT: None, np.nan: None, 'nan': None})
+    # Bỏ các dòng không có mã số hoặc ngày khởi phát
+    return df.dropna(subset=['ma_so_benh_nhan', 'ngay_khoi_phat'])
+
+
+def _validate_rows(df: pd.DataFrame, place_index, user_xa_id, error_log: list, rejected: list) -> pd.DataFrame:
+    """
+    Gán xa_id, chuẩn hóa tên ấp (place_names.py) và kiểm tra dữ liệu theo import_validation.IMPORT_RULES (vector hóa).
+    Lỗi được ghi vào `error_log`, các dòng bị loại được giữ trong `rejected` để tạo file lỗi. Trả về các dòng hợp lệ.
+    """
+    valid_df, rejected_df = validate_cases(df, place_index, user_xa_id)
+    if not rejected_df.empty:
+        error_log.extend(rejected_errors(rejected_df))
+        rejected.append(rejected_df)
+    return valid_df
+
+
+def _write_error_workbook(filepath: str, rejected: list):
+    """
+    Ghi các dòng bị loại ra file Excel theo đúng mẫu import (sửa xong có thể import lại ngay), thêm cột
+    'Dòng' (số dòng trong file gốc), 'File' (khi import nhiều file) và 'Lỗi'; các ô lỗi được tô đỏ.
+    """
+    df = pd.concat(rejected)
+    with_file = '_file' in df.columns
+    source_columns = list(COLUMN_MAP.keys())
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Dòng lỗi')
+    sheet.append(['Dòng'] + (['File'] if with_file else []) + source_columns + ['Lỗi'])
+    error_fill = PatternFill(fill_type='solid', fgColor='FFC7CE')
+    error_font = Font(color='9C0006')
+    for index, row in zip(df.index, df.to_dict('records')):
+        values = [index + 2] + ([row['_file']] if with_file else [])
+        for source_column in source_columns:
+            value = row[COLUMN_MAP[source_column]]
+            if isinstance(value, date):
+                value = value.strftime('%d/%m/%Y')
+            if COLUMN_MAP[source_column] in row['_cot_loi']:
+                value = WriteOnlyCell(sheet, value=value)
+                value.fill, value.font = error_fill, error_font
+            values.append(value)
+        sheet.append(values + [row['_loi']])
+    workbook.save(filepath)
+
+
+def _attach_error_workbook(result: dict, rejected: list, error_workbook: str = None) -> dict:
+    """Tạo file lỗi tại `error_workbook` (nếu có đường dẫn và có dòng bị loại) và ghi tên file vào kết quả."""
+    if error_workbook and rejected:
+        _write_error_workbook(error_workbook, rejected)
+        result['error_workbook'] = os.path.basename(error_workbook)
+    return result
+
+
+def _insert_cases(db_session: Session, df: pd.DataFrame, lo_import_id: int = None, update_existing: bool = False):
+    """
+    Chèn các ca chưa có (gắn lo_import_id nếu có); với `update_existing` cập nhật thêm diễn biến bệnh
+    (CASE_UPDATE_COLUMNS) của các ca đã có nếu khác. Cập nhật phiên bản dữ liệu và bảng tổng hợp.
+    Ca được cập nhật giữ lo_import_id của lượt đã thêm nó.
+    Trả về (xa_id, ngay_khoi_phat) của các ca đã chèn và của các ca đã cập nhật.
+    """
+    if dialect_name(db_session) == 'postgresql':
+        inserted_keys, updated_keys = _insert_cases_copy(db_session, df, lo_import_id, update_existing)
+    else:
+        inserted_keys, updated_keys = _insert_cases_checked(db_session, df, lo_import_id, update_existing)
+
+    changed_keys = inserted_keys + updated_keys
+    if changed_keys:
+        bump_data_version(db_session, {xa_id for xa_id, _ in changed_keys})
+        refresh_case_rollup(db_session, changed_keys)
+    return inserted_keys, updated_keys
+
+
+def _import_summary(original_row_count: int, new_cases_count: int, duplicate_count: int, error_log: list, updated_count: int = 0) -> dict:
+    skipped_cases_count = original_row_count - new_cases_count - updated_count
+    if updated_count:
+        message = (f"Hoàn thành! Đã thêm {new_cases_count} ca mới, cập nhật {updated_count} ca đã có, bỏ qua {skipped_cases_count} ca "
+                   f"không thay đổi hoặc có lỗi ({duplicate_count} ca đã có trong hệ thống không thay đổi).")
+    else:
+        message = f"Hoàn thành! Đã thêm {new_cases_count} ca mới, bỏ qua {skipped_cases_count} ca trùng lặp hoặc có lỗi ({duplicate_count} ca đã có trong hệ thống)."
+    return {"success": True, "message": message, "errors": error_log, "inserted": new_cases_count, "updated": updated_count, "skipped": skipped_cases_count}
+
+
+class _ImportProgress:
+    """
+    Cộng dồn số liệu tiến độ import (số dòng đã đọc, bị loại, trùng, đã chèn và thời gian từng phần)
+    và gửi toàn bộ qua `callback(**fields)` sau mỗi bước, vd. JobManager.report_progress.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.fields = {
+            'stage': 'reading', 'rows_total': None, 'rows_parsed': 0, 'rows_missing_required': 0,
+            'duplicates_in_file': 0, 'rows_invalid': 0, 'duplicates_existing': 0, 'rows_inserted': 0, 'rows_updated': 0, 'batches': [],
+        }
+
+    def update(self, **fields):
+        self.fields.update(fields)
+        self._send()
+
+    def add_batch(self, read_seconds: float, validate_seconds: float, insert_seconds: float, label: str = None, **counts):
+        for name, value in counts.items():
+            self.fields[name] += value
+        batch = {
+            'rows': counts.get('rows_parsed', 0),
+            'read_seconds': round(read_seconds, 3),
+            'validate_seconds': round(validate_seconds, 3),
+            'insert_seconds': round(insert_seconds, 3),
+        }
+        if label:
+            batch['label'] = label
+        self.fields['batches'].append(batch)
+        self._send()
+
+    def _send(self):
+        if self.callback is not None:
+            self.callback(**dict(self.fields, batches=list(self.fields['batches'])))
+
+
+def import_data_from_excel(filepath: str, user_xa_id: int = None, progress_callback=None, lo_import_id: int = None,
+                           update_existing: bool = False, error_workbook: str = None):
     """
     Nhập dữ liệu ca bệnh từ file Excel, tối ưu hóa đặc biệt cho PostgreSQL.
     Cải tiến:
     1. Chuẩn bị dữ liệu bằng Pandas (vectorization).
-    2. Chia batch 5000 record để kiểm tra trùng lặp với DB bằng VALUES + LEFT JOIN.
-    3. Sử dụng session.bulk_insert_mappings để chèn dữ liệu hàng loạt một cách hiệu quả.
+    2. PostgreSQL: COPY vào bảng tạm rồi INSERT ... ON CONFLICT DO NOTHING (ràng buộc UNIQUE loại ca trùng).
+    3. CSDL khác: kiểm tra trùng lặp theo batch 5000 record rồi bulk_insert_mappings.
+    File từ IMPORT_CHUNKED_MIN_MB trở lên được đọc và ghi theo từng phần (import_data_from_excel_chunked).
+    `progress_callback(**fields)` (nếu có) nhận tiến độ sau mỗi bước, xem _ImportProgress.
+    Các ca được thêm mang `lo_import_id` (xem import_batches.py).
+    `update_existing`: ca đã có được cập nhật các cột diễn biến bệnh (CASE_UPDATE_COLUMNS) nếu file có giá trị khác,
+    thay vì bị bỏ qua như ca trùng.
+    Dòng vi phạm quy tắc kiểm tra (import_validation.py) bị loại; nếu có `error_workbook`, các dòng này được ghi ra
+    file Excel tại đường dẫn đó với ô lỗi được tô màu (kết quả có 'error_workbook': tên file).
     """
+    if os.path.getsize(filepath) >= IMPORT_CHUNKED_MIN_MB * 1024 * 1024:
+        return import_data_from_excel_chunked(filepath, user_xa_id, progress_callback=progress_callback, lo_import_id=lo_import_id,
+                                              update_existing=update_existing, error_workbook=error_workbook)
+
+    progress = _ImportProgress(progress_callback)
+    progress.update(stage='reading')
     # ======================================================================
     # BƯỚC 1: ĐỌC VÀ CHUẨN BỊ DỮ LIỆU
     # ======================================================================
     try:
+        started = time.perf_counter()
         df = pd.read_excel(filepath, dtype={'Mã số': str})
+        read_seconds = time.perf_counter() - started
+        rows_parsed = len(df)
+        progress.update(stage='validating', rows_total=rows_parsed)
 
         # Kiểm tra cột
-        excel_cols_set = set(COLUMN_MAP.keys())
-        missing_cols = excel_cols_set - set(df.columns)
-        if missing_cols:
-            if 'Ấp' in missing_cols and len(missing_cols) == 1:
-                df['Ấp'] = None
-            else:
-                return {"success": False, "message": f"Lỗi: Các cột sau không tồn tại: {', '.join(missing_cols)}"}
-
-        df = df[list(COLUMN_MAP.keys())]
-        df.rename(columns=COLUMN_MAP, inplace=True)
+        column_error = _check_columns(df)
+        if column_error:
+            return {"success": False, "message": column_error}
 
-        # Vector hóa làm sạch và chuyển đổi
-        str_cols = ['ma_so_benh_nhan', 'ho_ten', 'ten_xa', 'chan_doan_chinh']
-        for col in str_cols:
-            df[col] = df[col].astype(str).str.strip()
-
-        date_cols = ['ngay_sinh', 'ngay_khoi_phat', 'ngay_nhap_vien', 'ngay_ra_vien']
-        for col in date_cols:
-            df[col] = pd.to_datetime(df[col], errors='coerce', dayfirst=True).dt.date
-
-        # Thay thế NaN/NaT bằng None
-        df.replace({pd.NaT: None, np.nan: None, 'nan': None}, inplace=True)
-        # Bỏ các dòng không có mã số hoặc ngày khởi phát
-        df.dropna(subset=['ma_so_benh_nhan', 'ngay_khoi_phat'], inplace=True)
+        started = time.perf_counter()
+        df = _clean_frame(df)
+        rows_missing_required = rows_parsed - len(df)
         # Loại bỏ trùng lặp trong chính file Excel
-        df.drop_duplicates(subset=['ma_so_benh_nhan', 'ngay_khoi_phat', 'chan_doan_chinh'], inplace=True)
+        df = df.drop_duplicates(subset=CASE_KEY_COLUMNS)
+        duplicates_in_file = rows_parsed - rows_missing_required - len(df)
 
         if df.empty:
+            progress.add_batch(read_seconds, time.perf_counter() - started, 0, rows_parsed=rows_parsed,
+                               rows_missing_required=rows_missing_required, duplicates_in_file=duplicates_in_file)
+            progress.update(stage='done')
             return {"success": True, "message": "Hoàn thành! Không có dữ liệu hợp lệ để import.", "errors": []}
 
     except Exception as e:
@@ -73,98 +363,567 @@ def import_data_from_excel(filepath: str, user_xa_id: int = None):
     db_session = get_db_session()
     try:
         # ======================================================================
-        # BƯỚC 2: KIỂM TRA QUYỀN & MAP `xa_id`
+        # BƯỚC 2: MAP `xa_id`, KIỂM TRA QUYỀN & DỮ LIỆU
         # ======================================================================
-        xa_map_query = db_session.query(DonViHanhChinh.ten_don_vi, DonViHanhChinh.id).filter_by(cap_don_vi='Xã').all()
-        xa_map = {name: id for name, id in xa_map_query}
-        df['xa_id'] = df['ten_xa'].map(xa_map)
-
-        error_log = []
+        error_log, rejected = [], []
         original_row_count = len(df)
-
-        # Lọc ra các dòng có xã không hợp lệ
-        invalid_xa_df = df[df['xa_id'].isnull()]
-        for index, row in invalid_xa_df.iterrows():
-            error_log.append({'row': index + 2, 'error': f"Tên xã '{row['ten_xa']}' không hợp lệ."})
-        df.dropna(subset=['xa_id'], inplace=True)
-        df['xa_id'] = df['xa_id'].astype(int)
-
-        # Lọc ra các dòng vi phạm quyền user (nếu có)
-        if user_xa_id is not None:
-            unauthorized_df = df[df['xa_id'] != user_xa_id]
-            for index, row in unauthorized_df.iterrows():
-                error_log.append({'row': index + 2, 'error': 'Bạn chỉ có quyền import dữ liệu cho xã của mình.'})
-            df = df[df['xa_id'] == user_xa_id]
+        df = _validate_rows(df, get_place_index(db_session), user_xa_id, error_log, rejected)
+        validate_seconds = time.perf_counter() - started
 
         if df.empty:
+            progress.add_batch(read_seconds, validate_seconds, 0, rows_parsed=rows_parsed, rows_missing_required=rows_missing_required,
+                               duplicates_in_file=duplicates_in_file, rows_invalid=original_row_count)
+            progress.update(stage='done')
             skipped_cases_count = original_row_count
             message = f"Hoàn thành! Đã thêm 0 ca mới, bỏ qua {skipped_cases_count} ca do lỗi hoặc không có quyền."
-            return {"success": True, "message": message, "errors": error_log}
+            return _attach_error_workbook({"success": True, "message": message, "errors": error_log}, rejected, error_workbook)
 
         # ======================================================================
-        # BƯỚC 3: KIỂM TRA TRÙNG LẶP VỚI DB BẰNG BATCH QUERY
+        # BƯỚC 3: CHÈN CA MỚI, BỎ QUA (HOẶC CẬP NHẬT) CA ĐÃ CÓ
         # ======================================================================
-        BATCH_SIZE = 5000
-        keys_to_check = df[['ma_so_benh_nhan', 'ngay_khoi_phat', 'chan_doan_chinh']].to_dict('records')
-        non_existing_keys = set()
-
-        for batch_start in range(0, len(keys_to_check), BATCH_SIZE):
-            batch = keys_to_check[batch_start: batch_start + BATCH_SIZE]
-
-            # Xây dựng danh sách values cho batch
-            values_sql = ", ".join([
-                f"(:ma_so_{i+1}, :ngay_kp_{i+1}, :chan_doan_{i+1})"
-                for i in range(len(batch))
-            ])
-
-            sql = text(f"""
-                SELECT v.ma_so, v.ngay_kp, v.chan_doan
-                FROM (VALUES {values_sql})
-                AS v (ma_so, ngay_kp, chan_doan)
-                LEFT JOIN ca_benh cb ON 
-                    cb.ma_so_benh_nhan = v.ma_so AND 
-                    cb.ngay_khoi_phat = v.ngay_kp AND
-                    cb.chan_doan_chinh = v.chan_doan
-                WHERE cb.id IS NULL
-            """)
-
-            # Tạo dictionary tham số cho batch
-            params = {}
-            for i, key_dict in enumerate(batch):
-                params[f"ma_so_{i+1}"] = key_dict['ma_so_benh_nhan']
-                params[f"ngay_kp_{i+1}"] = key_dict['ngay_khoi_phat']
-                params[f"chan_doan_{i+1}"] = key_dict['chan_doan_chinh']
-
-            # Thực thi query và gom các ca chưa tồn tại
-            result = db_session.execute(sql, params)
-            for row in result:
-                non_existing_keys.add((row.ma_so, row.ngay_kp, row.chan_doan))
+        progress.update(stage='inserting')
+        started = time.perf_counter()
+        inserted_keys, updated_keys = _insert_cases(db_session, df, lo_import_id, update_existing)
+        db_session.commit()
+        unchanged_count = len(df) - len(inserted_keys) - len(updated_keys)
+        progress.add_batch(
+            read_seconds, validate_seconds, time.perf_counter() - started,
+            rows_parsed=rows_parsed, rows_missing_required=rows_missing_required, duplicates_in_file=duplicates_in_file,
+            rows_invalid=original_row_count - len(df), duplicates_existing=unchanged_count,
+            rows_inserted=len(inserted_keys), rows_updated=len(updated_keys)
+        )
+        progress.update(stage='done')
+
+        return _attach_error_workbook(
+            _import_summary(original_row_count, len(inserted_keys), unchanged_count, error_log, len(updated_keys)), rejected, error_workbook
+        )
+
+    except Exception as e:
+        db_session.rollback()
+        traceback.print_exc()
+        return {"success": False, "message": f"Lỗi nghiêm trọng khi xử lý dữ liệu: {e}", "errors": []}
+    finally:
+        db_session.close()
+
+
+# ==============================================================================
+# IMPORT FILE LỚN THEO TỪNG PHẦN
+# ==============================================================================
+# Sheet được đọc bằng openpyxl ở chế độ read_only (không nạp cả workbook vào bộ nhớ) thành từng phần
+# IMPORT_CHUNK_ROWS dòng. Một luồng nền đọc trước phần kế tiếp trong khi phần hiện tại được làm sạch
+# và ghi vào CSDL; mỗi phần được commit riêng nên dữ liệu vào CSDL dần trong lúc file vẫn đang được đọc.
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "5000"))
+IMPORT_CHUNKED_MIN_MB = float(os.getenv("IMPORT_CHUNKED_MIN_MB", "2"))
+# Số phần được đọc sẵn chờ ghi (giới hạn bộ nhớ khi đọc nhanh hơn ghi)
+_PREFETCH_CHUNKS = 2
+
+
+def _excel_cell_to_str(value):
+    """Giống pd.read_excel(dtype=str): số nguyên lưu dạng float (vd. 123.0) được đọc thành '123'."""
+    if value is None:
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _iter_excel_chunks(filepath: str, chunk_size: int):
+    """
+    Đọc sheet đầu tiên theo từng DataFrame tối đa `chunk_size` dòng (luôn trả về ít nhất một DataFrame,
+    có thể rỗng, để nơi gọi kiểm tra được cột). Index của DataFrame là số dòng Excel trừ 2, như pd.read_excel.
+    """
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(value) if value is not None else f"Unnamed: {idx}" for idx, value in enumerate(next(rows, ()))]
+        width = len(header)
+        batch, start_index, emitted = [], 0, False
+        for index, row in enumerate(rows):
+            if not batch:
+                start_index = index
+            batch.append((tuple(row) + (None,) * width)[:width])
+            if len(batch) >= chunk_size:
+                yield _chunk_frame(batch, header, start_index)
+                batch, emitted = [], True
+        if batch or not emitted:
+            yield _chunk_frame(batch, header, start_index)
+    finally:
+        workbook.close()
+
+
+def _chunk_frame(batch: list, header: list, start_index: int) -> pd.DataFrame:
+    df = pd.DataFrame(batch, columns=header, index=range(start_index, start_index + len(batch)), dtype=object)
+    df = df.where(df.notna(), np.nan)
+    if 'Mã số' in df.columns:
+        df['Mã số'] = df['Mã số'].map(_excel_cell_to_str)
+    return df
+
+
+def _prefetch(iterable, depth: int):
+    """Chạy `iterable` trong luồng nền, giữ sẵn tối đa `depth` phần tử; lỗi trong luồng nền được ném lại ở nơi gọi."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
 
+    threading.Thread(target=produce, name='import-reader', daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Nơi gọi dừng sớm (lỗi khi ghi): báo luồng nền ngừng đọc
+        stop.set()
+
+
+def _excel_row_count(filepath: str):
+    """Số dòng dữ liệu theo kích thước sheet ghi trong file (không đọc dữ liệu); None nếu file không ghi kích thước."""
+    workbook = load_workbook(filepath, read_only=True)
+    try:
+        max_row = workbook.worksheets[0].max_row
+        return max(max_row - 1, 0) if max_row else None
+    finally:
+        workbook.close()
+
+
+def import_data_from_excel_chunked(filepath: str, user_xa_id: int = None, chunk_size: int = None, progress_callback=None,
+                                   lo_import_id: int = None, update_existing: bool = False, error_workbook: str = None):
+    """
+    Nhập file Excel lớn theo từng phần `chunk_size` dòng: đọc read_only, làm sạch, loại trùng (cả với các phần trước),
+    ghi và commit từng phần. Bộ nhớ chỉ phụ thuộc kích thước phần, không phụ thuộc kích thước file.
+    Khi gặp lỗi giữa chừng, các phần đã commit được giữ lại; import lại cùng file sẽ bỏ qua các ca đã có.
+    """
+    chunk_size = chunk_size or IMPORT_CHUNK_ROWS
+    progress = _ImportProgress(progress_callback)
+    db_session = get_db_session()
+    error_log, rejected = [], []
+    seen_keys = set()
+    original_row_count = new_cases_count = updated_count = duplicate_count = 0
+    chunks = None
+    try:
+        progress.update(stage='reading', rows_total=_excel_row_count(filepath))
+        place_index = get_place_index(db_session)
+        db_session.commit()
+        chunks = _prefetch(_iter_excel_chunks(filepath, chunk_size), _PREFETCH_CHUNKS)
+        while True:
+            # Thời gian đọc: thời gian chờ luồng nền đọc xong phần kế tiếp
+            started = time.perf_counter()
+            df = next(chunks, None)
+            if df is None:
+                break
+            read_seconds = time.perf_counter() - started
+
+            column_error = _check_columns(df)
+            if column_error:
+                return {"success": False, "message": column_error}
+
+            started = time.perf_counter()
+            rows_parsed = len(df)
+            df = _clean_frame(df)
+            rows_missing_required = rows_parsed - len(df)
+            # Loại bỏ trùng lặp trong chính file Excel (kể cả với các phần đã đọc trước)
+            keys = list(df[CASE_KEY_COLUMNS].itertuples(index=False, name=None))
+            is_first = [key not in seen_keys and not seen_keys.add(key) for key in keys]
+            df = df[is_first]
+            counts = {
+                'rows_parsed': rows_parsed, 'rows_missing_required': rows_missing_required,
+                'duplicates_in_file': rows_parsed - rows_missing_required - len(df),
+            }
+            if df.empty:
+                progress.add_batch(read_seconds, time.perf_counter() - started, 0, **counts)
+                continue
+            original_row_count += len(df)
+
+            valid_count = len(df)
+            df = _validate_rows(df, place_index, user_xa_id, error_log, rejected)
+            counts['rows_invalid'] = valid_count - len(df)
+            validate_seconds = time.perf_counter() - started
+            if df.empty:
+                progress.add_batch(read_seconds, validate_seconds, 0, **counts)
+                continue
+
+            progress.update(stage='inserting')
+            started = time.perf_counter()
+            inserted_keys, updated_keys = _insert_cases(db_session, df, lo_import_id, update_existing)
+            db_session.commit()
+            unchanged_count = len(df) - len(inserted_keys) - len(updated_keys)
+            new_cases_count += len(inserted_keys)
+            updated_count += len(updated_keys)
+            duplicate_count += unchanged_count
+            progress.add_batch(read_seconds, validate_seconds, time.perf_counter() - started, duplicates_existing=unchanged_count,
+                               rows_inserted=len(inserted_keys), rows_updated=len(updated_keys), **counts)
+            progress.update(stage='reading')
+
+        progress.update(stage='done')
+        if original_row_count == 0:
+            return {"success": True, "message": "Hoàn thành! Không có dữ liệu hợp lệ để import.", "errors": []}
+        return _attach_error_workbook(
+            _import_summary(original_row_count, new_cases_count, duplicate_count, error_log, updated_count), rejected, error_workbook
+        )
+
+    except Exception as e:
+        db_session.rollback()
+        traceback.print_exc()
+        saved = f" Đã lưu {new_cases_count} ca mới trước khi gặp lỗi; có thể import lại file để tiếp tục." if new_cases_count else ""
+        if updated_count:
+            saved += f" Đã cập nhật {updated_count} ca đã có."
+        return {"success": False, "message": f"Lỗi nghiêm trọng khi xử lý dữ liệu: {e}.{saved}", "errors": error_log, "updated": updated_count}
+    finally:
+        if chunks is not None:
+            # Dừng luồng đọc nền nếu kết thúc sớm
+            chunks.close()
+        db_session.close()
+
+
+# ==============================================================================
+# IMPORT NHIỀU FILE (ZIP) / NHIỀU SHEET
+# ==============================================================================
+# Mỗi sheet của mỗi file là một nguồn; các nguồn được đọc và làm sạch song song trong các tiến trình con
+# (pandas/openpyxl chủ yếu chạy Python thuần nên luồng không tăng tốc được). Dữ liệu được gộp, loại trùng
+# giữa các file theo (mã số, ngày khởi phát, chẩn đoán) rồi ghi một lần trong một transaction.
+IMPORT_PARSE_PROCESSES = int(os.getenv("IMPORT_PARSE_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# Giới hạn tổng dung lượng giải nén của file zip
+IMPORT_ZIP_MAX_MB = float(os.getenv("IMPORT_ZIP_MAX_MB", "500"))
+
+
+def _parse_source(filepath: str, sheet_name: str, label: str) -> dict:
+    """
+    Đọc và làm sạch một sheet (chạy trong tiến trình con). Trả về DataFrame đã làm sạch, loại trùng trong sheet,
+    kèm số liệu; lỗi đọc file hoặc thiếu cột được trả về ở khóa 'error' thay vì ném ra.
+    """
+    started = time.perf_counter()
+    parsed = {'label': label, 'df': None, 'error': None, 'rows_parsed': 0, 'rows_missing_required': 0, 'duplicates_in_file': 0}
+    try:
+        df = pd.read_excel(filepath, sheet_name=sheet_name, dtype={'Mã số': str})
+        parsed['rows_parsed'] = len(df)
+        column_error = _check_columns(df)
+        if column_error:
+            parsed['error'] = column_error
+        else:
+            df = _clean_frame(df)
+            parsed['rows_missing_required'] = parsed['rows_parsed'] - len(df)
+            df = df.drop_duplicates(subset=CASE_KEY_COLUMNS)
+            parsed['duplicates_in_file'] = parsed['rows_parsed'] - parsed['rows_missing_required'] - len(df)
+            parsed['df'] = df
+    except Exception as e:
+        parsed['error'] = f"Lỗi khi đọc file: {e}"
+    parsed['read_seconds'] = time.perf_counter() - started
+    return parsed
+
+
+def _list_sources(filepath: str, label: str) -> list:
+    """Các sheet của một workbook: [(filepath, sheet_name, nhãn hiển thị)]. Nhãn có tên sheet khi workbook có nhiều sheet."""
+    workbook = load_workbook(filepath, read_only=True)
+    try:
+        sheet_names = workbook.sheetnames
+    finally:
+        workbook.close()
+    if len(sheet_names) == 1:
+        return [(filepath, sheet_names[0], label)]
+    return [(filepath, sheet_name, f"{label} / {sheet_name}") for sheet_name in sheet_names]
+
+
+def _extract_zip(filepath: str, target_dir: str) -> list:
+    """
+    Giải nén các file .xlsx trong zip vào `target_dir` (đặt tên theo số thứ tự, không dùng đường dẫn trong zip).
+    Trả về [(đường dẫn đã giải nén, tên trong zip)]. Bỏ qua thư mục, file tạm của Excel (~$) và thư mục __MACOSX.
+    """
+    extracted = []
+    with zipfile.ZipFile(filepath) as archive:
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith('.xlsx')
+            and not info.filename.startswith('__MACOSX/') and not os.path.basename(info.filename).startswith('~$')
+        ]
+        if sum(info.file_size for info in members) > IMPORT_ZIP_MAX_MB * 1024 * 1024:
+            raise ValueError(f"Tổng dung lượng các file trong zip vượt quá {IMPORT_ZIP_MAX_MB:g} MB.")
+        for index, info in enumerate(members):
+            target = os.path.join(target_dir, f"{index}.xlsx")
+            with archive.open(info) as source, open(target, 'wb') as output:
+                shutil.copyfileobj(source, output)
+            extracted.append((target, info.filename))
+    return extracted
+
+
+def _parse_sources(sources: list, progress: _ImportProgress) -> list:
+    """Đọc các nguồn song song trong IMPORT_PARSE_PROCESSES tiến trình con (đọc tuần tự nếu chỉ có một nguồn)."""
+    def on_parsed(parsed):
+        progress.add_batch(parsed['read_seconds'], 0, 0, label=parsed['label'], files_parsed=1, rows_parsed=parsed['rows_parsed'],
+                           rows_missing_required=parsed['rows_missing_required'], duplicates_in_file=parsed['duplicates_in_file'])
+        return parsed
+
+    if len(sources) == 1 or IMPORT_PARSE_PROCESSES <= 1:
+        return [on_parsed(_parse_source(*source)) for source in sources]
+
+    # 'spawn': tiến trình con không kế thừa các luồng và kết nối CSDL của ứng dụng web (và giống hành vi trên Windows)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(IMPORT_PARSE_PROCESSES, len(sources)), mp_context=context) as executor:
+        futures = {executor.submit(_parse_source, *source): index for index, source in enumerate(sources)}
+        for future in as_completed(futures):
+            results[futures[future]] = on_parsed(future.result())
+    # Giữ thứ tự nguồn như trong file/zip để việc chọn bản ghi khi trùng giữa các file ổn định
+    return [results[index] for index in range(len(sources))]
+
+
+def _prepare_sources(filepath: str, user_xa_id: int = None, display_name: str = None, progress: _ImportProgress = None) -> dict:
+    """
+    Các bước đọc và kiểm tra của import_data_from_files (chưa ghi CSDL). Trả về {'result': kết quả} nếu dừng sớm
+    (không đọc được file, không có dữ liệu), ngược lại là dữ liệu đã chuẩn bị: 'df' (các dòng hợp lệ), 'files', 'error_log',
+    'rejected', 'original_row_count', 'validate_seconds' và 'progress' (số liệu tiến độ đến hết bước kiểm tra).
+    """
+    progress = progress or _ImportProgress()
+    temp_dir = tempfile.mkdtemp(prefix='import_')
+    try:
         # ======================================================================
-        # BƯỚC 4: LỌC DỮ LIỆU MỚI & INSERT
+        # BƯỚC 1: LIỆT KÊ VÀ ĐỌC SONG SONG CÁC NGUỒN
         # ======================================================================
-        df['_key'] = list(zip(df['ma_so_benh_nhan'], df['ngay_khoi_phat'], df['chan_doan_chinh']))
-        df_new_cases = df[df['_key'].isin(non_existing_keys)]
+        label = display_name or os.path.basename(filepath)
+        try:
+            if label.lower().endswith('.zip'):
+                sources = []
+                for path, name in _extract_zip(filepath, temp_dir):
+                    try:
+                        sources.extend(_list_sources(path, name))
+                    except Exception:
+                        # File .xlsx hỏng trong zip: vẫn giữ làm một nguồn để lỗi đọc file được báo trong tóm tắt của file đó
+                        sources.append((path, 0, name))
+            else:
+                sources = _list_sources(filepath, label)
+        except (zipfile.BadZipFile, ValueError, OSError) as e:
+            return {'result': {"success": False, "message": f"Lỗi khi đọc file tải lên: {e}"}}
+        if not sources:
+            return {'result': {"success": False, "message": "Lỗi: Không tìm thấy file .xlsx nào trong file zip."}}
+
+        progress.update(files_total=len(sources), files_parsed=0)
+        parsed_sources = _parse_sources(sources, progress)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    files = [
+        {'file': parsed['label'], 'rows': parsed['rows_parsed'], 'error': parsed['error'],
+         'missing_required': parsed['rows_missing_required'], 'duplicates': parsed['duplicates_in_file'], 'invalid': 0}
+        for parsed in parsed_sources
+    ]
+
+    # ======================================================================
+    # BƯỚC 2: GỘP, LOẠI TRÙNG GIỮA CÁC FILE
+    # ======================================================================
+    progress.update(stage='validating')
+    started = time.perf_counter()
+    frames = [parsed['df'].assign(_source=index) for index, parsed in enumerate(parsed_sources) if parsed['df'] is not None]
+    if not frames or sum(len(df) for df in frames) == 0:
+        progress.update(stage='done')
+        message = "Hoàn thành! Không có dữ liệu hợp lệ để import."
+        if any(file['error'] for file in files):
+            message += " Một số file có lỗi, xem tóm tắt từng file."
+        return {'result': {"success": True, "message": message, "errors": [], "files": files}}
+    df = pd.concat(frames)
+    duplicated = df.duplicated(subset=CASE_KEY_COLUMNS, keep='first')
+    for index, count in df.loc[duplicated, '_source'].value_counts().items():
+        files[index]['duplicates'] += int(count)
+    df = df[~duplicated]
+    progress.update(duplicates_in_file=progress.fields['duplicates_in_file'] + int(duplicated.sum()))
+    original_row_count = len(df)
 
-        if not df_new_cases.empty:
-            # Chuẩn bị dữ liệu cho bulk insert
-            columns_for_db = [col for col in COLUMN_MAP.values() if col != 'ten_xa'] + ['xa_id']
-            new_cases_dict = df_new_cases[columns_for_db].to_dict('records')
+    # ======================================================================
+    # BƯỚC 3: KIỂM TRA QUYỀN & MAP `xa_id` THEO TỪNG FILE
+    # ======================================================================
+    db_session = get_db_session()
+    try:
+        place_index = get_place_index(db_session)
+    finally:
+        db_session.close()
+    error_log, rejected = [], []
+    valid_frames = []
+    for index, source_df in df.groupby('_source', sort=True):
+        valid_df, rejected_df = validate_cases(source_df, place_index, user_xa_id)
+        files[index]['invalid'] = len(rejected_df)
+        error_log.extend(dict(error, file=files[index]['file']) for error in rejected_errors(rejected_df))
+        if not rejected_df.empty:
+            rejected.append(rejected_df.assign(_file=files[index]['file']))
+        valid_frames.append(valid_df)
+    df = pd.concat(valid_frames).drop(columns='_source')
+    progress.update(rows_invalid=original_row_count - len(df))
+    return {
+        'df': df, 'files': files, 'error_log': error_log, 'rejected': rejected, 'original_row_count': original_row_count,
+        'validate_seconds': time.perf_counter() - started,
+        'progress': dict(progress.fields, batches=list(progress.fields['batches'])),
+    }
 
-            # Insert hàng loạt
-            db_session.bulk_insert_mappings(CaBenh, new_cases_dict)
 
+def _write_prepared(prepared: dict, progress: _ImportProgress, lo_import_id: int = None, update_existing: bool = False,
+                    error_workbook: str = None) -> dict:
+    """Bước ghi của import_data_from_files: ghi các dòng đã chuẩn bị một lần trong một transaction và tổng hợp kết quả."""
+    df, files = prepared['df'], prepared['files']
+    db_session = get_db_session()
+    try:
+        # ======================================================================
+        # BƯỚC 4: GHI MỘT LẦN TRONG MỘT TRANSACTION
+        # ======================================================================
+        progress.update(stage='inserting')
+        started = time.perf_counter()
+        inserted_keys, updated_keys = _insert_cases(db_session, df, lo_import_id, update_existing) if not df.empty else ([], [])
         db_session.commit()
+        unchanged_count = len(df) - len(inserted_keys) - len(updated_keys)
+        progress.add_batch(0, prepared['validate_seconds'], time.perf_counter() - started, label='Ghi CSDL',
+                           duplicates_existing=unchanged_count, rows_inserted=len(inserted_keys), rows_updated=len(updated_keys))
+        progress.update(stage='done')
+    except Exception as e:
+        db_session.rollback()
+        traceback.print_exc()
+        return {"success": False, "message": f"Lỗi nghiêm trọng khi xử lý dữ liệu: {e}", "errors": [], "files": files}
+    finally:
+        db_session.close()
+
+    result = _import_summary(prepared['original_row_count'], len(inserted_keys), unchanged_count, prepared['error_log'], len(updated_keys))
+    failed_files = sum(1 for file in files if file['error'])
+    result['message'] += f" Đã đọc {len(files)} file/sheet" + (f", {failed_files} file/sheet bị lỗi." if failed_files else ".")
+    result['files'] = files
+    return _attach_error_workbook(result, prepared['rejected'], error_workbook)
 
-        new_cases_count = len(df_new_cases)
-        skipped_cases_count = original_row_count - new_cases_count
-        message = f"Hoàn thành! Đã thêm {new_cases_count} ca mới, bỏ qua {skipped_cases_count} ca trùng lặp hoặc có lỗi."
 
-        return {"success": True, "message": message, "errors": error_log}
+def import_data_from_files(filepath: str, user_xa_id: int = None, display_name: str = None, progress_callback=None,
+                           lo_import_id: int = None, update_existing: bool = False, error_workbook: str = None):
+    """
+    Nhập một file zip chứa nhiều file .xlsx, hoặc một workbook có nhiều sheet.
+    Các sheet được đọc song song, gộp và loại trùng giữa các file (giữ bản ghi của file đứng trước),
+    rồi ghi một lần trong một transaction. Kết quả có thêm 'files': tóm tắt số dòng và lỗi của từng file/sheet.
+    Nguồn thiếu cột hoặc không đọc được chỉ bị bỏ qua và báo trong tóm tắt, các nguồn khác vẫn được import.
+    """
+    progress = _ImportProgress(progress_callback)
+    progress.update(stage='reading')
+    prepared = _prepare_sources(filepath, user_xa_id, display_name, progress)
+    if 'result' in prepared:
+        return prepared['result']
+    return _write_prepared(prepared, progress, lo_import_id, update_existing, error_workbook)
+
+
+def import_prepared(prepared: dict, progress_callback=None, lo_import_id: int = None, update_existing: bool = False,
+                    error_workbook: str = None):
+    """Ghi dữ liệu đã được preview_import đọc và kiểm tra, không đọc lại file. Kết quả như import_data_from_files."""
+    progress = _ImportProgress(progress_callback)
+    progress.update(**prepared['progress'])
+    return _write_prepared(prepared, progress, lo_import_id, update_existing, error_workbook)
+
+
+def _sample_records(df: pd.DataFrame, columns: list) -> list:
+    """Các dòng mẫu dạng dict (ngày dạng dd/mm/yyyy, ô trống là None) để trả về dưới dạng JSON."""
+    records = df[columns].astype(object).where(df[columns].notna(), None).to_dict('records')
+    for record in records:
+        for col, value in record.items():
+            if isinstance(value, date):
+                record[col] = value.strftime('%d/%m/%Y')
+    return records
+
+
+def _preview_breakdown(labels: pd.Series, statuses: pd.Series) -> list:
+    """Số dòng theo từng nhãn (xã, bệnh) và từng trạng thái PREVIEW_STATUSES."""
+    table = pd.crosstab(labels, statuses).reindex(columns=PREVIEW_STATUSES, fill_value=0)
+    return [dict(name=name, **{status: int(count) for status, count in row.items()}) for name, row in table.iterrows()]
+
+
+def preview_import(filepath: str, user_xa_id: int = None, display_name: str = None, update_existing: bool = False,
+                   progress_callback=None, error_workbook: str = None):
+    """
+    Chạy thử import, không ghi CSDL: đọc, kiểm tra và map xã như import_data_from_files (cho cả file một sheet),
+    rồi tra các ca đã có theo từng batch khóa như nhánh kiểm tra trùng (với `update_existing` so thêm các cột cập nhật).
+    Trả về (kết quả, dữ liệu đã chuẩn bị hoặc None). Kết quả có thêm 'preview': số ca mới / cập nhật / đã có / không hợp lệ /
+    không có quyền, số liệu theo xã và theo bệnh, và các dòng mẫu. Dữ liệu đã chuẩn bị được import_prepared ghi khi xác nhận.
+    """
+    progress = _ImportProgress(progress_callback)
+    progress.update(stage='reading')
+    prepared = _prepare_sources(filepath, user_xa_id, display_name, progress)
+    if 'result' in prepared:
+        return prepared['result'], None
 
+    # Chỉ số dòng trùng nhau giữa các file: đánh lại chỉ số, giữ số dòng Excel trong cột 'dong'
+    df = prepared['df'].assign(dong=prepared['df'].index + 2).reset_index(drop=True)
+    rejected = prepared['rejected']
+    progress.update(stage='checking')
+    db_session = get_db_session()
+    try:
+        place_index = get_place_index(db_session)
+        existing = _existing_cases(db_session, df, with_values=update_existing) if not df.empty else pd.DataFrame()
     except Exception as e:
-        db_session.rollback()
         traceback.print_exc()
-        return {"success": False, "message": f"Lỗi nghiêm trọng khi xử lý dữ liệu: {e}", "errors": []}
+        return {"success": False, "message": f"Lỗi khi tra cứu các ca đã có: {e}", "errors": [], "files": prepared['files']}, None
     finally:
         db_session.close()
+
+    # Trạng thái từng dòng hợp lệ: thêm mới, cập nhật (chế độ cập nhật, có giá trị khác) hoặc đã có (bỏ qua)
+    status = pd.Series('moi', index=df.index)
+    if not existing.empty:
+        keys = pd.MultiIndex.from_frame(df[CASE_KEY_COLUMNS])
+        status[keys.isin(pd.MultiIndex.from_frame(existing[CASE_KEY_COLUMNS]))] = 'da_co'
+        if update_existing:
+            changed = _changed_cases(df, existing)
+            status[keys.isin(pd.MultiIndex.from_frame(changed[CASE_KEY_COLUMNS]))] = 'cap_nhat'
+    invalid = pd.concat(rejected) if rejected else pd.DataFrame(columns=list(df.columns) + ['_file', '_loi'])
+    invalid = invalid.assign(dong=invalid.index + 2).reset_index(drop=True)
+    unauthorized = (invalid['xa_id'].notna() & (invalid['xa_id'] != user_xa_id)) if user_xa_id is not None else pd.Series(False, index=invalid.index)
+
+    xa_names = place_index.xa_names
+    valid_xa = df['xa_id'].map(xa_names)
+    invalid_xa = invalid['xa_id'].map(xa_names).fillna(invalid['ten_xa']).fillna('(không ghi xã)')
+    statuses = pd.concat([status, pd.Series('khong_hop_le', index=invalid.index)], ignore_index=True)
+    counts = status.value_counts()
+    progress.update(stage='done', duplicates_existing=int(counts.get('da_co', 0)))
+
+    sample = df.assign(ten_xa=valid_xa, trang_thai=status)[status != 'da_co'].head(PREVIEW_SAMPLE_ROWS)
+    preview = {
+        'rows': prepared['original_row_count'],
+        'moi': int(counts.get('moi', 0)),
+        'cap_nhat': int(counts.get('cap_nhat', 0)),
+        'da_co': int(counts.get('da_co', 0)),
+        'khong_hop_le': len(invalid),
+        'khong_co_quyen': int(unauthorized.sum()),
+        'update_existing': update_existing,
+        'by_xa': _preview_breakdown(pd.concat([valid_xa, invalid_xa], ignore_index=True), statuses),
+        'by_disease': _preview_breakdown(
+            pd.concat([df['chan_doan_chinh'], invalid['chan_doan_chinh']], ignore_index=True).fillna('(không ghi chẩn đoán)'), statuses
+        ),
+        'sample': _sample_records(sample, ['dong'] + PREVIEW_SAMPLE_COLUMNS + ['trang_thai']),
+        'sample_invalid': _sample_records(invalid.head(PREVIEW_SAMPLE_ROWS), ['dong'] + PREVIEW_SAMPLE_COLUMNS + ['_file', '_loi']),
+    }
+    message = (f"Xem trước: {preview['moi']} ca sẽ được thêm mới"
+               + (f", {preview['cap_nhat']} ca đã có sẽ được cập nhật" if update_existing else "")
+               + f", {preview['da_co']} ca đã có trong hệ thống sẽ được bỏ qua, {preview['khong_hop_le']} dòng không hợp lệ."
+               + " Chưa có dữ liệu nào được ghi.")
+    result = {"success": True, "message": message, "errors": prepared['error_log'], "files": prepared['files'], "preview": preview}
+    return _attach_error_workbook(result, rejected, error_workbook), prepared
+
+
+def is_multi_source_upload(filepath: str, display_name: str = None) -> bool:
+    """File tải lên là zip, hoặc workbook có nhiều sheet (cần import bằng import_data_from_files)."""
+    if (display_name or filepath).lower().endswith('.zip'):
+        return True
+    try:
+        workbook = load_workbook(filepath, read_only=True)
+    except Exception:
+        # File hỏng: để import_data_from_excel báo lỗi như trước
+        return False
+    try:
+        return len(workbook.sheetnames) > 1
+    finally:
+        workbook.close()
@@ -0,0 +1,49 @@
+# file: webapp/core/data_version.py
+
+from datetime import datetime
+from sqlalchemy import text, func
+from sqlalchemy.orm import Session
+
+from .database_setup import PhienBanDuLieu
+
+# Khóa phiên bản của danh mục đơn vị hành chính (tên, cấp, quan hệ cha con)
+DON_VI_KEY = 'don_vi'
+
+
+def xa_version_key(xa_id: int) -> str:
+    """Khóa phiên bản cho dữ liệu ca bệnh/ổ dịch của một xã."""
+    return f"xa:{int(xa_id)}"
+
+
+def bump_data_version(db_session: Session, xa_ids=None, don_vi: bool = False):
+    """
+    Tăng phiên bản dữ liệu cho các xã (và/hoặc danh mục đơn vị) vừa thay đổi.
+    Chạy trong transaction của nơi gọi, không tự commit: phiên bản chỉ tăng khi dữ liệu thực sự được lưu.
+    """
+    keys = sorted({xa_version_key(xa_id) for xa_id in (xa_ids or []) if xa_id is not None})
+    if don_vi:
+        keys.append(DON_VI_KEY)
+    if not keys:
+        return
+    sql = text("""
+        INSERT INTO phien_ban_du_lieu (khoa, phien_ban, cap_nhat_luc) VALUES (:khoa, 1, :now)
+        ON CONFLICT (khoa) DO UPDATE SET phien_ban = phien_ban_du_lieu.phien_ban + 1, cap_nhat_luc = :now
+    """)
+    now = datetime.now()
+    db_session.execute(sql, [{"khoa": key, "now": now} for key in keys])
+
+
+def get_data_version(db_session: Session, xa_ids) -> int:
+    """
+    Phiên bản tổng hợp của dữ liệu các xã cùng danh mục đơn vị.
+    Các số phiên bản chỉ tăng nên tổng của chúng đổi mỗi khi có bất kỳ xã nào trong phạm vi thay đổi.
+    """
+    keys = [xa_version_key(xa_id) for xa_id in xa_ids] + [DON_VI_KEY]
+    total = db_session.query(func.coalesce(func.sum(PhienBanDuLieu.phien_ban), 0)).filter(PhienBanDuLieu.khoa.in_(keys)).scalar()
+    return int(total)
+
+
+def get_don_vi_version(db_session: Session) -> int:
+    """Phiên bản hiện tại của danh mục đơn vị hành chính (0 nếu chưa từng thay đổi)."""
+    version = db_session.query(PhienBanDuLieu.phien_ban).filter(PhienBanDuLieu.khoa == DON_VI_KEY).scalar()
+    return int(version or 0)
@@ -1,9 +1,9 @@
 # file: core/database_setup.py (Phiên bản đã cập nhật hoàn chỉnh)
 
-from sqlalchemy import (create_engine, Column, Integer, String, Date, 
-                        ForeignKey, Text, Boolean, UniqueConstraint)
+from sqlalchemy import (create_engine, Column, Integer, String, Date, DateTime, Float,
+                        ForeignKey, Text, Boolean, UniqueConstraint, Index, inspect, text)
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
-from datetime import date
+from datetime import date, datetime
 
 Base = declarative_base()
 
@@ -95,11 +95,124 @@ class CaBenh(Base):
     o_dich_id = Column(Integer, ForeignKey('o_dich.id'), nullable=True, index=True) # <<< THÊM INDEX
     o_dich = relationship("O_Dich", back_populates="ca_benh_lien_quan")
 
+    # Lượt import đã thêm ca bệnh này (NULL: nhập tay hoặc import trước khi có theo dõi lượt import)
+    lo_import_id = Column(Integer, ForeignKey('lo_import.id'), nullable=True, index=True)
+
     # === THAY ĐỔI 3: Thêm ràng buộc UNIQUE kết hợp ở cấp độ bảng ===
     __table_args__ = (
         UniqueConstraint('ma_so_benh_nhan', 'ngay_khoi_phat', 'chan_doan_chinh', name='_ma_so_ngay_khoi_phat_chan_doan_uc'),
     )
 
+class PhienBanDuLieu(Base):
+    """
+    Số phiên bản dữ liệu theo phạm vi, tăng mỗi khi dữ liệu trong phạm vi thay đổi.
+    khoa: 'xa:<id>' cho ca bệnh/ổ dịch của một xã, 'don_vi' cho danh mục đơn vị hành chính.
+    """
+    __tablename__ = 'phien_ban_du_lieu'
+    khoa = Column(String(100), primary_key=True)
+    phien_ban = Column(Integer, nullable=False, default=0)
+    cap_nhat_luc = Column(DateTime, default=datetime.now)
+
+class TongHopCaBenh(Base):
+    """
+    Bảng tổng hợp số ca bệnh theo (xã, ấp, chẩn đoán, phân độ, ngày khởi phát, ngày import, tử vong, ≤15 tuổi).
+    Được cập nhật cùng transaction với mọi thay đổi trên ca_benh (xem case_rollup.py); báo cáo đọc bảng này
+    thay vì quét lại toàn bộ ca bệnh từ đầu năm.
+    """
+    __tablename__ = 'tong_hop_ca_benh'
+    id = Column(Integer, primary_key=True)
+    xa_id = Column(Integer, nullable=False)
+    dia_chi_ap = Column(String(500))
+    chan_doan_chinh = Column(String(500))
+    phan_do_benh = Column(String(500))
+    ngay_khoi_phat = Column(Date, nullable=False)
+    ngay_import = Column(Date)
+    is_death = Column(Boolean, nullable=False, default=False)
+    is_under_15 = Column(Boolean, nullable=False, default=False)
+    so_ca = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_tong_hop_ca_benh_xa_ngay', 'xa_id', 'ngay_khoi_phat'),
+    )
+
+class LoImport(Base):
+    """
+    Một lượt import file: mã băm nội dung file (nhận ra file đã import), người import, số liệu và thời gian xử lý.
+    Các ca bệnh do lượt import thêm vào mang lo_import_id để hoàn tác cả lượt bằng một câu lệnh xóa.
+    trang_thai: 'dang_xu_ly', 'hoan_thanh', 'loi', 'da_hoan_tac'.
+    """
+    __tablename__ = 'lo_import'
+    id = Column(Integer, primary_key=True)
+    ma_bam = Column(String(64), nullable=False, index=True)  # SHA-256 nội dung file
+    ten_file = Column(String(255))
+    nguoi_import_id = Column(Integer, index=True)  # Không đặt khóa ngoại để xóa người dùng không bị chặn
+    trang_thai = Column(String(20), nullable=False, default='dang_xu_ly')
+    thong_bao = Column(Text)
+    so_dong = Column(Integer, nullable=False, default=0)
+    so_ca_them = Column(Integer, nullable=False, default=0)
+    so_ca_bo_qua = Column(Integer, nullable=False, default=0)
+    so_ca_cap_nhat = Column(Integer, default=0)  # Ca đã có được cập nhật diễn biến bệnh (không bị hoàn tác)
+    cap_nhat_ca_da_co = Column(Boolean, default=False)  # Lượt import ở chế độ cập nhật ca đã có
+    so_dong_loi = Column(Integer, nullable=False, default=0)
+    thoi_gian_xu_ly = Column(Float)  # giây
+    tao_luc = Column(DateTime, nullable=False, default=datetime.now, index=True)
+    hoan_thanh_luc = Column(DateTime)
+    hoan_tac_luc = Column(DateTime)
+
+class TepBaoCao(Base):
+    """Chỉ mục các file báo cáo trong REPORT_FOLDER (dùng để dọn dẹp mà không phải quét thư mục)."""
+    __tablename__ = 'tep_bao_cao'
+    ten_file = Column(String(255), primary_key=True)
+    nguoi_tao_id = Column(Integer, index=True)  # Không đặt khóa ngoại để xóa người dùng không bị chặn
+    mau_bao_cao = Column(String(250))
+    kich_thuoc = Column(Integer, nullable=False, default=0)
+    tao_luc = Column(DateTime, nullable=False, default=datetime.now, index=True)
+    truy_cap_luc = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+# Cột được thêm vào bảng đã có sẵn (create_all chỉ tạo bảng mới, không thêm cột): (model, tên cột)
+ADDED_COLUMNS = [
+    (CaBenh, 'lo_import_id'),
+    (LoImport, 'so_ca_cap_nhat'),
+    (LoImport, 'cap_nhat_ca_da_co'),
+]
+
+# Khóa advisory (PostgreSQL) để các tiến trình web khởi động cùng lúc nâng cấp cấu trúc CSDL lần lượt
+_SCHEMA_LOCK_ID = 72310700
+
+def _add_missing_columns(conn):
+    dialect = conn.dialect
+    inspector = inspect(conn)
+    for model, column_name in ADDED_COLUMNS:
+        table = model.__table__
+        if column_name in {col['name'] for col in inspector.get_columns(table.name)}:
+            continue
+        column = table.c[column_name]
+        column_type = column.type.compile(dialect=dialect)
+        references = ''.join(f" REFERENCES {fk.column.table.name}({fk.column.name})" for fk in column.foreign_keys)
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}{references}"))
+        for index in table.indexes:
+            if [col.name for col in index.columns] == [column_name]:
+                index.create(conn, checkfirst=True)
+
+def add_missing_columns(engine):
+    """
+    Thêm các cột trong ADDED_COLUMNS còn thiếu ở CSDL đang chạy (kèm chỉ mục nếu có), an toàn khi chạy lại.
+    Gọi sau Base.metadata.create_all.
+    """
+    with engine.begin() as conn:
+        _add_missing_columns(conn)
+
+def upgrade_schema(engine):
+    """
+    Đưa CSDL đang chạy lên cấu trúc hiện tại: tạo bảng mới và thêm các cột mới vào bảng đã có.
+    Chạy khi ứng dụng khởi động, an toàn khi chạy lại.
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": _SCHEMA_LOCK_ID})
+        Base.metadata.create_all(conn)
+        _add_missing_columns(conn)
+
 def create_db():
     engine = create_engine('sqlite:///app.db') 
     print("Đang tạo các bảng trong CSDL...")
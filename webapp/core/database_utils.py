@@ -1,8 +1,11 @@
 # file: webapp/core/database_utils.py (PHIÊN BẢN ĐÃ SỬA LỖI HOÀN CHỈNH)
 
 import os
+import threading
+from contextlib import contextmanager
 from sqlalchemy import create_engine, event
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
 
 # Tải các biến môi trường từ file .env
@@ -23,12 +26,59 @@ if DATABASE_URL.startswith("sqlite"):
     connect_args = {"timeout": 15}
 # =========================================================================
 
+# =========================================================================
+# POOL KẾT NỐI
+# =========================================================================
+# Mỗi request dùng một session (g.db) nên số kết nối cần gần bằng số luồng phục vụ (waitress threads)
+# cộng các công việc nền (báo cáo, import). pre_ping kiểm tra kết nối trước khi dùng để bỏ các kết nối
+# đã bị máy chủ CSDL đóng (khởi động lại, hết thời gian chờ); recycle thay kết nối cũ định kỳ.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+
+pool_args = {"pool_pre_ping": DB_POOL_PRE_PING}
+if not DATABASE_URL.startswith("sqlite"):
+    # SQLite dùng pool mặc định của SQLAlchemy (không có giới hạn kết nối phía máy chủ)
+    pool_args.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+
 # Tạo engine kết nối tới CSDL với connect_args đã được cấu hình
 engine = create_engine(
     DATABASE_URL,
-    connect_args=connect_args
+    connect_args=connect_args,
+    **pool_args
 )
 
+# Số lần mở kết nối mới / lấy kết nối từ pool kể từ khi khởi động (xem get_pool_status)
+_pool_counters = {'connects': 0, 'checkouts': 0}
+_pool_counters_lock = threading.Lock()
+
+
+@event.listens_for(engine, "connect")
+def _count_connect(dbapi_connection, connection_record):
+    with _pool_counters_lock:
+        _pool_counters['connects'] += 1
+
+
+@event.listens_for(engine, "checkout")
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _pool_counters_lock:
+        _pool_counters['checkouts'] += 1
+
+
+def get_pool_status() -> dict:
+    """Thống kê pool kết nối: cấu hình, số kết nối đang rảnh / đang dùng / vượt mức và số lần mở / lấy kết nối."""
+    pool = engine.pool
+    status = {'pool': type(pool).__name__, 'pre_ping': DB_POOL_PRE_PING}
+    # Chỉ QueuePool (PostgreSQL, SQLite dạng file) có các số liệu này
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_in=pool.checkedin(), checked_out=pool.checkedout(),
+                      overflow=pool.overflow(), max_overflow=DB_MAX_OVERFLOW, timeout=pool.timeout())
+    with _pool_counters_lock:
+        status.update(_pool_counters)
+    return status
+
 # =========================================================================
 # SỬA LỖI 2: XỬ LÝ TÌM KIẾM UNICODE (TIẾNG VIỆT) CHO SQLITE
 # =========================================================================
@@ -48,4 +98,21 @@ def get_db_session():
     """
     Hàm tiện ích để tạo và trả về một session CSDL mới.
     """
-    return SessionLocal()
\ No newline at end of file
+    return SessionLocal()
+
+
+@contextmanager
+def session_scope(db_session: Session = None):
+    """
+    Session cho các hàm tiện ích trong webapp/core. Session được truyền vào (thường là g.db của request) được
+    dùng lại và không bị đóng, nên một request chỉ giữ một kết nối và các đơn vị đã nạp nằm sẵn trong identity map.
+    Không truyền (công việc nền, script): mở session mới và đóng khi xong.
+    """
+    if db_session is not None:
+        yield db_session
+        return
+    db = get_db_session()
+    try:
+        yield db
+    finally:
+        db.close()
\ No newline at end of file
@@ -0,0 +1,112 @@
+# file: webapp/core/import_batches.py
+
+import hashlib
+from datetime import datetime
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import Session
+
+from .database_setup import CaBenh, LoImport
+from .data_version import bump_data_version
+from .case_rollup import refresh_case_rollup
+
+# ==============================================================================
+# THEO DÕI LƯỢT IMPORT
+# ==============================================================================
+# Mỗi lượt import được ghi vào lo_import (mã băm nội dung file, người import, số liệu, thời gian xử lý);
+# các ca bệnh được thêm mang lo_import_id. Nhờ đó:
+# - tải lại đúng file đã import thành công được nhận ra ngay từ mã băm, không phải đọc và kiểm tra lại;
+# - một lượt import nhầm được hoàn tác bằng một câu lệnh DELETE theo lo_import_id.
+
+
+def file_sha256(filepath: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_imported_batch(db_session: Session, content_hash: str, update_existing: bool = False):
+    """
+    Lượt import thành công gần nhất của file có cùng nội dung và cùng chế độ (`update_existing`), hoặc None.
+    Chỉ tính các lượt hoàn thành sau lần hoàn tác gần nhất của file đó: sau khi hoàn tác,
+    các lượt "import lại" trước đó chỉ chứa phần ca còn thiếu nên không đại diện cho cả file.
+    """
+    last_rollback = db_session.query(func.max(LoImport.hoan_tac_luc)).filter(LoImport.ma_bam == content_hash).scalar()
+    # Lượt cũ (trước khi có cột cap_nhat_ca_da_co) mang giá trị NULL, tức chế độ thêm mới
+    mode = LoImport.cap_nhat_ca_da_co.is_(True) if update_existing else LoImport.cap_nhat_ca_da_co.isnot(True)
+    query = db_session.query(LoImport).filter(LoImport.ma_bam == content_hash, LoImport.trang_thai == 'hoan_thanh', mode)
+    if last_rollback is not None:
+        query = query.filter(LoImport.hoan_thanh_luc > last_rollback)
+    return query.order_by(LoImport.id.desc()).first()
+
+
+def start_import_batch(db_session: Session, content_hash: str, ten_file: str = None, nguoi_import_id: int = None,
+                       update_existing: bool = False) -> int:
+    """Ghi nhận lượt import mới (đang xử lý) và commit để các ca được chèn sau đó tham chiếu được. Trả về id."""
+    batch = LoImport(ma_bam=content_hash, ten_file=ten_file, nguoi_import_id=nguoi_import_id, trang_thai='dang_xu_ly',
+                     cap_nhat_ca_da_co=update_existing)
+    db_session.add(batch)
+    db_session.commit()
+    return batch.id
+
+
+def finish_import_batch(db_session: Session, lo_import_id: int, result: dict, seconds: float):
+    """Cập nhật kết quả của lượt import. Lượt lỗi vẫn có thể đã lưu một phần (import theo từng phần) và hoàn tác được."""
+    batch = db_session.get(LoImport, lo_import_id)
+    if not batch:
+        return
+    inserted = result.get('inserted', 0)
+    skipped = result.get('skipped', 0)
+    updated = result.get('updated', 0)
+    if not result.get('success'):
+        # Import theo từng phần dừng giữa chừng: đếm số ca đã thực sự lưu
+        inserted = db_session.query(CaBenh.id).filter(CaBenh.lo_import_id == lo_import_id).count()
+    batch.trang_thai = 'hoan_thanh' if result.get('success') else 'loi'
+    batch.thong_bao = result.get('message')
+    batch.so_ca_them = inserted
+    batch.so_ca_bo_qua = skipped
+    batch.so_ca_cap_nhat = updated
+    batch.so_dong = inserted + updated + skipped
+    batch.so_dong_loi = len(result.get('errors') or [])
+    batch.thoi_gian_xu_ly = round(seconds, 3)
+    batch.hoan_thanh_luc = datetime.now()
+    db_session.commit()
+
+
+def get_recent_import_batches(db_session: Session, nguoi_import_id: int = None, limit: int = 20):
+    """Các lượt import gần nhất (của một người dùng nếu có `nguoi_import_id`)."""
+    query = db_session.query(LoImport)
+    if nguoi_import_id is not None:
+        query = query.filter(LoImport.nguoi_import_id == nguoi_import_id)
+    return query.order_by(LoImport.id.desc()).limit(limit).all()
+
+
+def rollback_import_batch(db_session: Session, lo_import_id: int) -> dict:
+    """
+    Xóa toàn bộ ca bệnh do lượt import thêm vào (một câu lệnh DELETE), cập nhật phiên bản dữ liệu
+    và bảng tổng hợp của các xã liên quan trong cùng transaction, rồi đánh dấu lượt import đã hoàn tác.
+    Các ca đã có được lượt import cập nhật (chế độ cập nhật) giữ nguyên giá trị mới.
+    """
+    batch = db_session.get(LoImport, lo_import_id)
+    if not batch:
+        return {"success": False, "message": "Không tìm thấy lượt import."}
+    if batch.trang_thai == 'da_hoan_tac':
+        return {"success": False, "message": f"Lượt import #{lo_import_id} đã được hoàn tác trước đó."}
+    if batch.trang_thai == 'dang_xu_ly':
+        return {"success": False, "message": f"Lượt import #{lo_import_id} đang được xử lý, vui lòng chờ hoàn tất."}
+    try:
+        keys = db_session.execute(
+            select(CaBenh.xa_id, CaBenh.ngay_khoi_phat).where(CaBenh.lo_import_id == lo_import_id).distinct()
+        ).all()
+        deleted = db_session.execute(delete(CaBenh).where(CaBenh.lo_import_id == lo_import_id)).rowcount
+        if keys:
+            bump_data_version(db_session, {xa_id for xa_id, _ in keys})
+            refresh_case_rollup(db_session, keys)
+        batch.trang_thai = 'da_hoan_tac'
+        batch.hoan_tac_luc = datetime.now()
+        db_session.commit()
+        return {"success": True, "message": f"Đã hoàn tác lượt import #{lo_import_id}: xóa {deleted} ca bệnh.", "deleted": deleted}
+    except Exception as e:
+        db_session.rollback()
+        return {"success": False, "message": f"Lỗi CSDL: {e}"}
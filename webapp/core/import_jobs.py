@@ -0,0 +1,191 @@
+# file: webapp/core/import_jobs.py
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .data_importer import import_data_from_excel, import_data_from_files, import_prepared, is_multi_source_upload, preview_import
+from .database_utils import get_db_session
+from .import_batches import file_sha256, find_imported_batch, start_import_batch, finish_import_batch
+from .jobs import JobManager
+from .report_prerender import notify_data_changed
+from .report_store import register_report_file
+
+# Số file import được xử lý đồng thời (các lượt import cùng ghi vào ca_benh và bảng tổng hợp)
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "1"))
+# Bản xem trước (dữ liệu đã đọc và kiểm tra) được giữ trong bộ nhớ của tiến trình đến khi xác nhận hoặc hết hạn.
+# Mỗi bản giữ cả DataFrame của file nên chỉ giữ IMPORT_PREVIEW_MAX bản gần nhất.
+IMPORT_PREVIEW_TTL_SECONDS = int(os.getenv("IMPORT_PREVIEW_TTL_SECONDS", "1800"))
+IMPORT_PREVIEW_MAX = int(os.getenv("IMPORT_PREVIEW_MAX", "4"))
+
+import_job_manager = JobManager(max_workers=IMPORT_WORKERS, name='import')
+
+_previews = OrderedDict()
+_previews_lock = threading.Lock()
+
+
+def _store_preview(entry: dict) -> str:
+    """Lưu bản xem trước, bỏ các bản hết hạn hoặc cũ nhất khi vượt IMPORT_PREVIEW_MAX. Trả về token."""
+    token = uuid.uuid4().hex
+    now = time.time()
+    with _previews_lock:
+        for expired in [key for key, value in _previews.items() if now - value['created_at'] > IMPORT_PREVIEW_TTL_SECONDS]:
+            del _previews[expired]
+        _previews[token] = dict(entry, created_at=now)
+        while len(_previews) > IMPORT_PREVIEW_MAX:
+            _previews.popitem(last=False)
+    return token
+
+
+def take_preview(token: str, owner_id=None):
+    """Lấy và bỏ khỏi bộ nhớ bản xem trước của người dùng; None nếu không có, đã hết hạn hoặc của người khác."""
+    with _previews_lock:
+        entry = _previews.get(token)
+        if not entry or entry['owner_id'] != owner_id or time.time() - entry['created_at'] > IMPORT_PREVIEW_TTL_SECONDS:
+            return None
+        return _previews.pop(token)
+
+
+def _run_import_batch(content_hash: str, display_name: str, owner_id, report_folder: str, run_import, update_existing: bool = False):
+    """
+    Ghi nhận lượt import, chạy `run_import(lo_import_id, error_workbook)` và luôn đóng lượt import lại.
+    Các dòng bị loại khi kiểm tra được ghi ra file lỗi trong `report_folder` (dọn dẹp như file báo cáo).
+    """
+    db_session = get_db_session()
+    try:
+        lo_import_id = start_import_batch(db_session, content_hash, display_name, owner_id, update_existing)
+    finally:
+        db_session.close()
+
+    error_workbook = os.path.join(report_folder, f"loi_import_{lo_import_id}_{uuid.uuid4().hex[:8]}.xlsx") if report_folder else None
+    started = time.perf_counter()
+    # Lượt import luôn được đóng lại (kể cả khi lỗi bất ngờ) để có thể hoàn tác phần đã lưu
+    result = {"success": False, "message": "Import bị gián đoạn do lỗi không xác định.", "errors": []}
+    try:
+        result = run_import(lo_import_id, error_workbook)
+    finally:
+        db_session = get_db_session()
+        try:
+            finish_import_batch(db_session, lo_import_id, result, time.perf_counter() - started)
+        finally:
+            db_session.close()
+    result['lo_import_id'] = lo_import_id
+    if result.get('error_workbook'):
+        register_report_file(report_folder, result['error_workbook'], owner_id=owner_id, report_template='loi_import')
+    if result.get('success'):
+        # Dữ liệu nhập muộn: báo cáo đã tạo trước của các xã liên quan cần được tạo lại
+        notify_data_changed()
+    return result
+
+
+def _run_import_job(filepath: str, user_xa_id: int = None, display_name: str = None, owner_id=None, force: bool = False,
+                    update_existing: bool = False, report_folder: str = None):
+    """
+    Chạy trong luồng nền: import file, ghi tiến độ vào công việc và luôn xóa file tạm khi xong.
+    File có cùng nội dung với một lượt import thêm mới thành công trước đó được bỏ qua ngay, trừ khi `force`,
+    `update_existing` (diễn biến bệnh có thể đã thay đổi trong CSDL) hoặc lượt trước có dòng bị loại
+    (dòng đó có thể hợp lệ sau khi danh mục đơn vị được bổ sung).
+    `update_existing`: cập nhật diễn biến bệnh của các ca đã có thay vì bỏ qua (xem data_importer.CASE_UPDATE_COLUMNS).
+    """
+    try:
+        content_hash = file_sha256(filepath)
+        previous = None
+        if not force and not update_existing:
+            db_session = get_db_session()
+            try:
+                previous = find_imported_batch(db_session, content_hash)
+            finally:
+                db_session.close()
+        if previous and not previous.so_dong_loi:
+            import_job_manager.report_progress(stage='done')
+            message = (f"File này đã được import lúc {previous.tao_luc:%H:%M %d/%m/%Y} (lượt #{previous.id}: "
+                       f"thêm {previous.so_ca_them} ca), không import lại. Chọn \"Import lại\" nếu cần đọc lại file.")
+            return {"success": True, "message": message, "errors": [], "inserted": 0, "skipped": 0, "lo_import_id": previous.id, "already_imported": True}
+
+        def run_import(lo_import_id, error_workbook):
+            if is_multi_source_upload(filepath, display_name):
+                # File zip hoặc workbook nhiều sheet: đọc song song, gộp và ghi một lần
+                return import_data_from_files(filepath, user_xa_id, display_name=display_name, progress_callback=import_job_manager.report_progress,
+                                              lo_import_id=lo_import_id, update_existing=update_existing, error_workbook=error_workbook)
+            return import_data_from_excel(filepath, user_xa_id, progress_callback=import_job_manager.report_progress,
+                                          lo_import_id=lo_import_id, update_existing=update_existing, error_workbook=error_workbook)
+
+        return _run_import_batch(content_hash, display_name, owner_id, report_folder, run_import, update_existing)
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+
+def _run_preview_job(filepath: str, user_xa_id: int = None, display_name: str = None, owner_id=None,
+                     update_existing: bool = False, report_folder: str = None):
+    """
+    Chạy trong luồng nền: xem trước import (không ghi CSDL) và giữ dữ liệu đã chuẩn bị theo token để xác nhận sau.
+    File tạm luôn bị xóa khi xong: lượt xác nhận dùng dữ liệu trong bộ nhớ, không đọc lại file.
+    """
+    try:
+        content_hash = file_sha256(filepath)
+        db_session = get_db_session()
+        try:
+            previous = find_imported_batch(db_session, content_hash, update_existing)
+        finally:
+            db_session.close()
+
+        error_workbook = os.path.join(report_folder, f"loi_import_xem_truoc_{uuid.uuid4().hex[:8]}.xlsx") if report_folder else None
+        result, prepared = preview_import(filepath, user_xa_id, display_name=display_name, update_existing=update_existing,
+                                          progress_callback=import_job_manager.report_progress, error_workbook=error_workbook)
+        if result.get('error_workbook'):
+            register_report_file(report_folder, result['error_workbook'], owner_id=owner_id, report_template='loi_import')
+        if previous:
+            result['message'] += (f" Lưu ý: file này đã được import lúc {previous.tao_luc:%H:%M %d/%m/%Y} "
+                                  f"(lượt #{previous.id}: thêm {previous.so_ca_them} ca).")
+        if prepared is not None:
+            result['preview_token'] = _store_preview({
+                'prepared': prepared, 'owner_id': owner_id, 'display_name': display_name,
+                'content_hash': content_hash, 'update_existing': update_existing,
+            })
+            result['preview_ttl_seconds'] = IMPORT_PREVIEW_TTL_SECONDS
+        return result
+    finally:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+
+def _run_preview_confirm_job(entry: dict, report_folder: str = None):
+    """Chạy trong luồng nền: ghi dữ liệu của một bản xem trước đã được xác nhận thành một lượt import."""
+    def run_import(lo_import_id, error_workbook):
+        return import_prepared(entry['prepared'], progress_callback=import_job_manager.report_progress, lo_import_id=lo_import_id,
+                               update_existing=entry['update_existing'], error_workbook=error_workbook)
+
+    return _run_import_batch(entry['content_hash'], entry['display_name'], entry['owner_id'], report_folder, run_import,
+                             entry['update_existing'])
+
+
+def submit_import_job(filepath: str, user_xa_id: int = None, owner_id=None, display_name: str = None, force: bool = False,
+                      update_existing: bool = False, report_folder: str = None) -> str:
+    """
+    Đưa file đã lưu tạm vào hàng đợi import và trả về job_id ngay.
+    File tạm thuộc về công việc từ lúc này và bị xóa sau khi import xong.
+    """
+    return import_job_manager.submit(
+        _run_import_job, filepath, user_xa_id, display_name, owner_id, force, update_existing, report_folder,
+        owner_id=owner_id, meta={'display_name': display_name}
+    )
+
+
+def submit_preview_job(filepath: str, user_xa_id: int = None, owner_id=None, display_name: str = None,
+                       update_existing: bool = False, report_folder: str = None) -> str:
+    """Đưa file đã lưu tạm vào hàng đợi xem trước import và trả về job_id ngay (file tạm bị xóa khi xong)."""
+    return import_job_manager.submit(
+        _run_preview_job, filepath, user_xa_id, display_name, owner_id, update_existing, report_folder,
+        owner_id=owner_id, meta={'display_name': display_name, 'preview': True}
+    )
+
+
+def submit_preview_confirm_job(entry: dict, report_folder: str = None) -> str:
+    """Đưa bản xem trước đã xác nhận (lấy bằng take_preview) vào hàng đợi import và trả về job_id ngay."""
+    return import_job_manager.submit(
+        _run_preview_confirm_job, entry, report_folder,
+        owner_id=entry['owner_id'], meta={'display_name': entry['display_name']}
+    )
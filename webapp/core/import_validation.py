@@ -0,0 +1,121 @@
+# file: webapp/core/import_validation.py
+
+from datetime import date
+import numpy as np
+import pandas as pd
+
+from .case_options import CASE_OPTIONS, GIOI_TINH_OPTIONS
+
+# ==============================================================================
+# KIỂM TRA DỮ LIỆU IMPORT
+# ==============================================================================
+# Mỗi quy tắc là một mặt nạ vector hóa trên cả DataFrame (không duyệt từng dòng). Các mặt nạ ghép thành
+# ma trận lỗi (dòng x quy tắc); dòng vi phạm bất kỳ quy tắc nào bị loại khỏi import, kèm thông báo
+# và danh sách ô lỗi để báo lại cho người dùng. Chỉ các dòng lỗi mới được duyệt để tạo thông báo.
+
+DATE_COLUMNS = ['ngay_sinh', 'ngay_khoi_phat', 'ngay_nhap_vien', 'ngay_ra_vien']
+
+_PHAN_DO_OPTIONS = [option for options in CASE_OPTIONS['phan_do_benh'].values() for option in options]
+_PHAN_DO_PAIRS = pd.MultiIndex.from_tuples(
+    [(chan_doan, option) for chan_doan, options in CASE_OPTIONS['phan_do_benh'].items() for option in options]
+)
+
+
+def _canonical(series: pd.Series, options: list) -> pd.Series:
+    """Đưa giá trị về đúng cách viết trong danh mục (không phân biệt hoa thường); giá trị ngoài danh mục giữ nguyên."""
+    lookup = {option.lower(): option for option in options}
+    mapped = series.astype(str).str.strip().str.lower().map(lookup)
+    return mapped.where(mapped.notna(), series)
+
+
+def _outside(series: pd.Series, options: list) -> pd.Series:
+    return series.notna() & ~series.isin(options)
+
+
+def _invalid_phan_do(df: pd.DataFrame, context: dict) -> pd.Series:
+    """Phân độ chỉ được kiểm tra với các bệnh có danh mục phân độ (vd. SXH, TCM)."""
+    has_levels = df['chan_doan_chinh'].isin(CASE_OPTIONS['phan_do_benh'].keys()) & df['phan_do_benh'].notna()
+    pairs = pd.MultiIndex.from_arrays([df['chan_doan_chinh'], df['phan_do_benh']])
+    return has_levels & ~pairs.isin(_PHAN_DO_PAIRS)
+
+
+def _future(column: str):
+    return lambda df, context: context['dates'][column] > context['today']
+
+
+# (các cột bị đánh dấu, thông báo, hàm trả về mặt nạ các dòng vi phạm)
+# Thông báo có thể dùng {value}: giá trị ô đầu tiên trong danh sách cột.
+IMPORT_RULES = [
+    (['ten_xa'], "Tên xã '{value}' không hợp lệ.", lambda df, context: df['xa_id'].isna()),
+    (['ten_xa'], "Bạn chỉ có quyền import dữ liệu cho xã của mình.",
+     lambda df, context: df['xa_id'].notna() & (df['xa_id'] != context['user_xa_id']) if context['user_xa_id'] is not None else False),
+    (['chan_doan_chinh'], "Thiếu chẩn đoán chính.", lambda df, context: df['chan_doan_chinh'].isna()),
+    (['chan_doan_chinh'], "Chẩn đoán '{value}' không có trong danh mục.",
+     lambda df, context: _outside(df['chan_doan_chinh'], CASE_OPTIONS['chan_doan_chinh'])),
+    (['phan_do_benh'], "Phân độ '{value}' không phù hợp với chẩn đoán.", _invalid_phan_do),
+    (['tinh_trang_hien_nay'], "Tình trạng '{value}' không có trong danh mục.",
+     lambda df, context: _outside(df['tinh_trang_hien_nay'], CASE_OPTIONS['tinh_trang_hien_nay'])),
+    (['gioi_tinh'], "Giới tính '{value}' không hợp lệ (Nam, Nữ, Khác).", lambda df, context: _outside(df['gioi_tinh'], GIOI_TINH_OPTIONS)),
+    (['ngay_khoi_phat', 'ngay_sinh'], "Ngày khởi phát trước ngày sinh.",
+     lambda df, context: context['dates']['ngay_khoi_phat'] < context['dates']['ngay_sinh']),
+    (['ngay_ra_vien', 'ngay_nhap_vien'], "Ngày ra viện trước ngày nhập viện.",
+     lambda df, context: context['dates']['ngay_ra_vien'] < context['dates']['ngay_nhap_vien']),
+    (['ngay_sinh'], "Ngày sinh ở tương lai.", _future('ngay_sinh')),
+    (['ngay_khoi_phat'], "Ngày khởi phát ở tương lai.", _future('ngay_khoi_phat')),
+    (['ngay_nhap_vien'], "Ngày nhập viện ở tương lai.", _future('ngay_nhap_vien')),
+    (['ngay_ra_vien'], "Ngày ra viện ở tương lai.", _future('ngay_ra_vien')),
+]
+
+
+def normalize_options(df: pd.DataFrame) -> pd.DataFrame:
+    """Chuẩn hóa cách viết của các cột có danh mục (chẩn đoán, phân độ, tình trạng, giới tính)."""
+    return df.assign(
+        chan_doan_chinh=_canonical(df['chan_doan_chinh'], CASE_OPTIONS['chan_doan_chinh']),
+        phan_do_benh=_canonical(df['phan_do_benh'], _PHAN_DO_OPTIONS),
+        tinh_trang_hien_nay=_canonical(df['tinh_trang_hien_nay'], CASE_OPTIONS['tinh_trang_hien_nay']),
+        gioi_tinh=_canonical(df['gioi_tinh'], GIOI_TINH_OPTIONS),
+    )
+
+
+def error_matrix(df: pd.DataFrame, user_xa_id: int = None, today: date = None) -> np.ndarray:
+    """Ma trận lỗi kiểu bool (số dòng x số quy tắc trong IMPORT_RULES). `df` đã có cột xa_id (NaN nếu xã không hợp lệ)."""
+    context = {
+        'user_xa_id': user_xa_id,
+        'today': pd.Timestamp(today or date.today()),
+        'dates': {col: pd.to_datetime(df[col], errors='coerce') for col in DATE_COLUMNS},
+    }
+    matrix = np.zeros((len(df), len(IMPORT_RULES)), dtype=bool)
+    for index, (_, _, check) in enumerate(IMPORT_RULES):
+        matrix[:, index] = np.asarray(check(df, context), dtype=bool)
+    return matrix
+
+
+def validate_cases(df: pd.DataFrame, place_index, user_xa_id: int = None, today: date = None):
+    """
+    Chuẩn hóa, gán xa_id theo tên xã (place_names.PlaceNameIndex) và áp dụng IMPORT_RULES.
+    Trả về (các dòng hợp lệ với xa_id kiểu int và tên ấp đã chuẩn hóa, các dòng bị loại). Các dòng bị loại có thêm cột
+    '_loi' (thông báo, ngăn cách bằng '; ') và '_cot_loi' (các cột có ô lỗi).
+    """
+    df = normalize_options(df).assign(xa_id=place_index.xa_ids(df['ten_xa']))
+    matrix = error_matrix(df, user_xa_id, today)
+    rejected_mask = matrix.any(axis=1)
+
+    valid = df[~rejected_mask]
+    valid = place_index.resolve_ap(valid.assign(xa_id=valid['xa_id'].astype(int)))
+    rejected = df[rejected_mask]
+    messages, columns = [], []
+    values = {col: rejected[col].to_numpy() for rule_columns, _, _ in IMPORT_RULES for col in rule_columns[:1]}
+    for position, row_errors in enumerate(matrix[rejected_mask]):
+        row_messages, row_columns = [], []
+        for index in np.flatnonzero(row_errors):
+            rule_columns, message, _ = IMPORT_RULES[index]
+            row_messages.append(message.format(value=values[rule_columns[0]][position]))
+            row_columns.extend(col for col in rule_columns if col not in row_columns)
+        messages.append('; '.join(row_messages))
+        columns.append(row_columns)
+    return valid, rejected.assign(_loi=messages, _cot_loi=columns)
+
+
+def rejected_errors(rejected: pd.DataFrame) -> list:
+    """Danh sách lỗi dạng {'row': số dòng Excel, 'error': thông báo} của các dòng bị loại."""
+    return [{'row': index + 2, 'error': message} for index, message in zip(rejected.index, rejected['_loi'])]
@@ -0,0 +1,137 @@
+# file: webapp/core/jobs.py
+
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+
+class JobManager:
+    """
+    Hàng đợi công việc chạy nền với số luồng xử lý giới hạn.
+    Mỗi công việc có trạng thái: queued -> running -> done/failed, kèm thời gian xếp hàng và xử lý.
+    Hàm đang chạy có thể ghi tiến độ bằng `report_progress(...)` (ví dụ số dòng đã xử lý) để nơi gọi theo dõi.
+    Trạng thái được giữ trong bộ nhớ của tiến trình và tự dọn sau `retention_seconds`.
+    """
+    def __init__(self, max_workers: int = 2, name: str = 'job', retention_seconds: int = 3600):
+        self.name = name
+        self.max_workers = max(1, int(max_workers))
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # job_id của công việc đang chạy trong từng luồng xử lý (dùng cho report_progress)
+        self._current = threading.local()
+
+    def submit(self, func, *args, owner_id=None, meta: dict = None, **kwargs) -> str:
+        """Đưa một công việc vào hàng đợi và trả về job_id ngay lập tức."""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'status': 'queued',
+                'owner_id': owner_id,
+                'meta': dict(meta or {}),
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'result': None,
+                'error': None,
+                'progress': {},
+            }
+        self._executor.submit(self._run, job_id, func, args, kwargs)
+        return job_id
+
+    def add_done(self, result, owner_id=None, meta: dict = None) -> str:
+        """Ghi nhận một công việc đã có sẵn kết quả (vd. lấy từ bộ nhớ đệm) mà không cần xếp hàng."""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'status': 'done',
+                'owner_id': owner_id,
+                'meta': dict(meta or {}),
+                'created_at': now,
+                'started_at': now,
+                'finished_at': now,
+                'result': result,
+                'error': None,
+                'progress': {},
+            }
+        return job_id
+
+    def get(self, job_id: str):
+        """Trả về bản sao trạng thái của công việc (hoặc None nếu không tồn tại)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job, meta=dict(job['meta']), progress=dict(job['progress'])) if job else None
+
+    def report_progress(self, **fields):
+        """Cập nhật tiến độ của công việc đang chạy trong luồng hiện tại (bỏ qua nếu gọi ngoài công việc nền)."""
+        job_id = getattr(self._current, 'job_id', None)
+        if job_id is None:
+            return
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id]['progress'].update(fields)
+
+    def to_status_dict(self, job_id: str):
+        """Trạng thái công việc ở dạng có thể trả về qua JSON, kèm thời gian xếp hàng/xử lý."""
+        job = self.get(job_id)
+        return self.status_dict(job) if job else None
+
+    @staticmethod
+    def status_dict(job: dict) -> dict:
+        """
+        Như to_status_dict nhưng từ bản sao đã lấy bằng get(): nơi gọi kiểm tra quyền (owner_id) và dựng trạng thái
+        trên cùng một bản, không phụ thuộc công việc còn trong bộ nhớ giữa hai lần đọc.
+        """
+        now = time.time()
+        started, finished = job['started_at'], job['finished_at']
+        return {
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'meta': job['meta'],
+            'created_at': _to_iso(job['created_at']),
+            'started_at': _to_iso(started),
+            'finished_at': _to_iso(finished),
+            'queue_seconds': round((started or now) - job['created_at'], 3),
+            'run_seconds': round((finished or now) - started, 3) if started else None,
+            'progress': job['progress'],
+            'result': job['result'],
+            'error': job['error'],
+        }
+
+    def _set(self, job_id: str, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _run(self, job_id: str, func, args, kwargs):
+        self._set(job_id, status='running', started_at=time.time())
+        self._current.job_id = job_id
+        try:
+            result = func(*args, **kwargs)
+            self._set(job_id, status='done', result=result, finished_at=time.time())
+        except Exception as e:
+            print(f"Lỗi khi chạy công việc nền '{self.name}' {job_id}: {e}\n{traceback.format_exc()}")
+            self._set(job_id, status='failed', error=str(e), finished_at=time.time())
+        finally:
+            self._current.job_id = None
+
+    def _prune(self):
+        """Xóa các công việc đã kết thúc quá lâu để giới hạn bộ nhớ."""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+def _to_iso(timestamp):
+    return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds') if timestamp else None
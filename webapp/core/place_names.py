@@ -0,0 +1,146 @@
+# file: webapp/core/place_names.py
+
+import re
+import threading
+import unicodedata
+import pandas as pd
+from sqlalchemy.orm import Session
+from unidecode import unidecode
+
+from .database_setup import DonViHanhChinh
+from .data_version import get_don_vi_version
+
+# ==============================================================================
+# NHẬN DẠNG TÊN XÃ / ẤP KHI IMPORT
+# ==============================================================================
+# Tên trong file thường khác tên trong danh mục ở dấu ("Hòa"/"Hoà"), hoa thường, tiền tố ("Xã Mỹ Hòa") hoặc
+# số 0 ở đầu ("Ấp 01"). Tên được "gấp" về dạng không dấu, chữ thường để so khớp; tên gấp trùng nhau
+# giữa nhiều đơn vị (cùng phạm vi) không được dùng để tránh gán nhầm, khi đó chỉ tên viết đúng mới khớp.
+# Tiền tố được bỏ dần từng cái ("P. Tô Châu" -> "to chau"), và dạng còn giữ tiền tố được so với tên đầy đủ trong
+# danh mục trước dạng đã bỏ, nên tên có chữ đầu trùng tiền tố ("Tô Châu", ấp "Tổ 3") vẫn khớp đúng.
+# Chỉ mục được dựng một lần từ don_vi_hanh_chinh và dựng lại khi phiên bản danh mục (data_version.DON_VI_KEY)
+# thay đổi, tức là sau mỗi lần admin sửa đơn vị hành chính.
+
+XA_PREFIXES = ('thi tran', 'tt', 'phuong', 'p', 'xa')
+AP_PREFIXES = ('khu pho', 'kp', 'khom', 'ap', 'to')
+
+_index_lock = threading.Lock()
+_cached_index = {'version': None, 'index': None}
+
+
+def fold_name(name) -> str:
+    """Dạng so khớp của một tên: chuẩn hóa Unicode, bỏ dấu, chữ thường, chỉ giữ chữ/số, bỏ số 0 ở đầu."""
+    if name is None or (isinstance(name, float) and name != name):
+        return ''
+    text = unidecode(unicodedata.normalize('NFC', str(name))).lower()
+    text = re.sub(r'[^a-z0-9]+', ' ', text).strip()
+    return re.sub(r'\b0+(\d)', r'\1', text)
+
+
+def prefix_forms(folded: str, prefixes: tuple) -> list:
+    """Tên đã gấp và các dạng bỏ dần từng tiền tố ở đầu, vd. 'p to chau' -> ['p to chau', 'to chau']."""
+    forms = [folded]
+    while True:
+        for prefix in prefixes:
+            if forms[-1].startswith(prefix + ' '):
+                forms.append(forms[-1][len(prefix) + 1:])
+                break
+        else:
+            return forms
+
+
+def _unambiguous(pairs) -> dict:
+    """Từ điển khóa -> giá trị, bỏ các khóa ứng với nhiều giá trị khác nhau."""
+    values = {}
+    for key, value in pairs:
+        values.setdefault(key, set()).add(value)
+    return {key: next(iter(found)) for key, found in values.items() if len(found) == 1}
+
+
+def _match(forms: list, full: dict, stripped: dict, scope=None):
+    """Giá trị của dạng tên đầu tiên khớp một tên đầy đủ trong danh mục, nếu không có thì khớp một tên đã bỏ tiền tố."""
+    for lookup in (full, stripped):
+        for form in forms:
+            value = lookup.get(form if scope is None else (scope, form))
+            if value is not None:
+                return value
+    return None
+
+
+class PlaceNameIndex:
+    """
+    Chỉ mục tên xã (toàn tỉnh) và tên ấp (theo từng xã) để nhận dạng tên trong file import.
+    Các hàm nhận cả cột và chỉ xử lý từng giá trị khác nhau một lần, rồi map lại cho cả cột.
+    """
+    def __init__(self, xa_rows: list, ap_rows: list):
+        # xa_rows: [(id, ten_don_vi)] của các xã; ap_rows: [(xa_id, ten_don_vi)] của các ấp
+        self.xa_exact = {name: xa_id for xa_id, name in xa_rows}
+        self.xa_names = {xa_id: name for xa_id, name in xa_rows}
+        xa_forms = [(xa_id, prefix_forms(fold_name(name), XA_PREFIXES)) for xa_id, name in xa_rows]
+        self.xa_folded = _unambiguous((forms[0], xa_id) for xa_id, forms in xa_forms)
+        self.xa_stripped = _unambiguous((form, xa_id) for xa_id, forms in xa_forms for form in forms[1:])
+        self.ap_exact = {(xa_id, name): name for xa_id, name in ap_rows}
+        ap_forms = [(xa_id, name, prefix_forms(fold_name(name), AP_PREFIXES)) for xa_id, name in ap_rows]
+        self.ap_folded = _unambiguous(((xa_id, forms[0]), name) for xa_id, name, forms in ap_forms)
+        self.ap_stripped = _unambiguous(((xa_id, form), name) for xa_id, name, forms in ap_forms for form in forms[1:])
+
+        # Tìm tên ấp trong địa chỉ chi tiết: dùng tên gấp còn giữ tiền tố ("ap 1"), nên "số 1" không bị nhận nhầm là "Ấp 1"
+        full_names = {}
+        for xa_id, name in ap_rows:
+            full_names.setdefault(xa_id, []).append((fold_name(name), name))
+        self.ap_in_address = {}
+        for xa_id, names in full_names.items():
+            lookup = _unambiguous(name for name in names if name[0])
+            if lookup:
+                alternatives = '|'.join(re.escape(key) for key in sorted(lookup, key=len, reverse=True))
+                self.ap_in_address[xa_id] = (re.compile(rf'\b({alternatives})\b'), lookup)
+
+    def _xa_id(self, name):
+        xa_id = self.xa_exact.get(name)
+        return xa_id if xa_id is not None else _match(prefix_forms(fold_name(name), XA_PREFIXES), self.xa_folded, self.xa_stripped)
+
+    def _ap_name(self, xa_id, name):
+        exact = self.ap_exact.get((xa_id, name))
+        if exact is not None:
+            return exact
+        return _match(prefix_forms(fold_name(name), AP_PREFIXES), self.ap_folded, self.ap_stripped, scope=xa_id)
+
+    def xa_ids(self, names: pd.Series) -> pd.Series:
+        """xa_id theo tên xã cho cả cột (NaN nếu không nhận dạng được)."""
+        lookup = {name: self._xa_id(name) for name in names.dropna().unique()}
+        return names.map(lookup).astype(float)
+
+    def resolve_ap(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Chuẩn hóa dia_chi_ap về đúng tên ấp trong danh mục của xã (df đã có xa_id).
+        Dòng không ghi ấp được tìm tên ấp trong dia_chi_chi_tiet; tên ấp không nhận dạng được giữ nguyên.
+        """
+        if df.empty or not self.ap_exact:
+            return df
+        ap = df['dia_chi_ap']
+        pairs = df[['xa_id', 'dia_chi_ap']].dropna().drop_duplicates()
+        lookup = {(xa_id, name): self._ap_name(xa_id, name) for xa_id, name in pairs.itertuples(index=False)}
+        resolved = pd.Series(pd.MultiIndex.from_frame(df[['xa_id', 'dia_chi_ap']]).map(lookup), index=df.index)
+        ap = resolved.where(resolved.notna(), ap)
+
+        missing = ap.isna() & df['dia_chi_chi_tiet'].notna()
+        for xa_id, rows in df.loc[missing, ['xa_id', 'dia_chi_chi_tiet']].groupby('xa_id'):
+            if xa_id not in self.ap_in_address:
+                continue
+            pattern, names = self.ap_in_address[xa_id]
+            found = rows['dia_chi_chi_tiet'].map(fold_name).str.extract(pattern, expand=False).map(names).dropna()
+            ap.loc[found.index] = found
+        return df.assign(dia_chi_ap=ap.where(ap.notna(), None))
+
+
+def get_place_index(db_session: Session) -> PlaceNameIndex:
+    """Chỉ mục tên đơn vị, dựng lại khi danh mục đơn vị hành chính có phiên bản mới."""
+    version = get_don_vi_version(db_session)
+    with _index_lock:
+        if _cached_index['index'] is not None and _cached_index['version'] == version:
+            return _cached_index['index']
+        xa_rows = db_session.query(DonViHanhChinh.id, DonViHanhChinh.ten_don_vi).filter(DonViHanhChinh.cap_don_vi == 'Xã').all()
+        ap_rows = db_session.query(DonViHanhChinh.parent_id, DonViHanhChinh.ten_don_vi).filter(DonViHanhChinh.cap_don_vi == 'Ấp').all()
+        index = PlaceNameIndex([tuple(row) for row in xa_rows], [tuple(row) for row in ap_rows])
+        _cached_index.update(version=version, index=index)
+        return index
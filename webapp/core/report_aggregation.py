@@ -0,0 +1,361 @@
+# file: webapp/core/report_aggregation.py
+
+import calendar
+from datetime import date, timedelta
+import pandas as pd
+from sqlalchemy import select, func, null
+from sqlalchemy.orm import Session
+
+from .database_setup import CaBenh, DonViHanhChinh, O_Dich, TongHopCaBenh
+from .week_calendar import WeekCalendar
+from .utils import get_all_child_xa_ids
+from .case_rollup import use_case_rollup
+from .sql_compat import age_years
+
+# ==============================================================================
+# TỔNG HỢP DỮ LIỆU DÙNG CHUNG CHO CÁC BÁO CÁO ĐỊNH KỲ CỦA MỘT ĐƠN VỊ
+# ==============================================================================
+# Thay vì mỗi báo cáo (BTN, SXH, Ổ dịch) tự quét lại bảng ca_benh / o_dich,
+# `build_report_aggregates` đọc mỗi bảng đúng một lần cho (đơn vị, kỳ báo cáo),
+# các hàm bên dưới suy ra số liệu cho từng báo cáo từ kết quả đó bằng pandas.
+
+SXH_KEYWORD = 'Sốt xuất huyết'
+SXH_NANG = 'Sốt xuất huyết Dengue nặng'
+
+
+def get_report_periods(year: int, period_type: str, period_number: int) -> dict:
+    """Các mốc thời gian của một kỳ báo cáo (tuần theo WeekCalendar hoặc tháng dương lịch)."""
+    if period_type == 'week':
+        calendar_obj = WeekCalendar(year)
+        current_details = calendar_obj.get_week_details(period_number)
+        if current_details is None:
+            raise ValueError(f"Không tìm thấy tuần {period_number}.")
+        prev_details = calendar_obj.get_week_details(period_number - 1)
+        start, end = current_details['ngay_bat_dau'].date(), current_details['ngay_ket_thuc'].date()
+        prev_period = (prev_details['ngay_bat_dau'].date(), prev_details['ngay_ket_thuc'].date()) if prev_details is not None else None
+        ytd_start = calendar_obj.first_day.date()
+    elif period_type == 'month':
+        _, num_days = calendar.monthrange(year, period_number)
+        start, end = date(year, period_number, 1), date(year, period_number, num_days)
+        prev_month, prev_year = (period_number - 1, year) if period_number > 1 else (12, year - 1)
+        _, prev_num_days = calendar.monthrange(prev_year, prev_month)
+        prev_period = (date(prev_year, prev_month, 1), date(prev_year, prev_month, prev_num_days))
+        ytd_start = date(year, 1, 1)
+    else:
+        raise ValueError("Loại kỳ báo cáo không hợp lệ.")
+
+    return {
+        'period_type': period_type,
+        'year': year,
+        'period_number': period_number,
+        'start': start,
+        'end': end,
+        'prev_period': prev_period,
+        'start_of_year': date(year, 1, 1),  # Mốc cộng dồn của báo cáo BTN
+        'ytd_start': ytd_start,  # Mốc cộng dồn của báo cáo SXH và Ổ dịch
+        'last_year': (date(year - 1, 1, 1), end.replace(year=year - 1)),
+    }
+
+
+def get_custom_periods(start: date, end: date) -> dict:
+    """
+    Các mốc thời gian của một khoảng ngày tùy chỉnh, cùng cấu trúc với `get_report_periods`.
+    Kỳ trước là khoảng cùng độ dài liền trước; mốc cộng dồn là đầu năm của ngày bắt đầu.
+    """
+    if start > end:
+        raise ValueError("Ngày bắt đầu không được lớn hơn ngày kết thúc.")
+    length = end - start
+    prev_end = start - timedelta(days=1)
+    return {
+        'period_type': 'custom',
+        'year': start.year,
+        'period_number': None,
+        'start': start,
+        'end': end,
+        'prev_period': (prev_end - length, prev_end),
+        'start_of_year': date(start.year, 1, 1),
+        'ytd_start': date(start.year, 1, 1),
+    }
+
+
+def load_outbreaks(db_session: Session, xa_ids, end: date, loai_benh=('SXH', 'TCM')) -> pd.DataFrame:
+    """Danh sách ổ dịch (theo thứ tự nhập) của các xã, phát hiện đến hết ngày `end`, trong một truy vấn."""
+    stmt = (
+        select(
+            O_Dich.xa_id, DonViHanhChinh.ten_don_vi.label('ten_xa'), O_Dich.dia_chi_ap, O_Dich.loai_benh,
+            O_Dich.ngay_phat_hien, O_Dich.ngay_xu_ly, O_Dich.noi_phat_hien_tcm, O_Dich.dia_diem_xu_ly
+        )
+        .join(DonViHanhChinh, O_Dich.xa_id == DonViHanhChinh.id)
+        .where(O_Dich.xa_id.in_(list(xa_ids)), O_Dich.loai_benh.in_(list(loai_benh)), O_Dich.ngay_phat_hien <= end)
+        .order_by(O_Dich.id)
+    )
+    df_o_dich = pd.read_sql_query(stmt, db_session.bind)
+    df_o_dich['ngay_phat_hien'] = pd.to_datetime(df_o_dich['ngay_phat_hien'], errors='coerce')
+    df_o_dich['ngay_xu_ly'] = pd.to_datetime(df_o_dich['ngay_xu_ly'], errors='coerce')
+    return df_o_dich
+
+
+def build_report_aggregates(db_session: Session, user_don_vi: DonViHanhChinh, year: int, period_type: str, period_number: int, include_o_dich: bool = True):
+    """
+    Đọc số liệu ca bệnh (gom nhóm theo xã/ấp, chẩn đoán, phân độ, tử vong, ≤15 tuổi, ngày khởi phát, bổ sung)
+    và danh sách ổ dịch của đơn vị trong một lượt cho mỗi bảng.
+    Số liệu ca bệnh lấy từ bảng tổng hợp tong_hop_ca_benh nếu đã dựng, ngược lại quét trực tiếp ca_benh.
+    Trả về None nếu đơn vị không có xã nào.
+    """
+    xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
+    if not xa_ids_to_query:
+        return None
+
+    periods = get_report_periods(year, period_type, period_number)
+    group_by_ap = (user_don_vi.cap_don_vi == 'Xã')
+    min_start = min([periods['last_year'][0], periods['ytd_start']] + ([periods['prev_period'][0]] if periods['prev_period'] else []))
+    start, end = periods['start'], periods['end']
+
+    if use_case_rollup(db_session):
+        src = TongHopCaBenh
+        is_death, is_under_15, so_ca = src.is_death, src.is_under_15, func.sum(src.so_ca)
+    else:
+        src = CaBenh
+        is_death = func.coalesce(CaBenh.tinh_trang_hien_nay == 'Tử vong', False)
+        is_under_15 = func.coalesce(age_years(CaBenh.ngay_khoi_phat, CaBenh.ngay_sinh) <= 15, False)
+        so_ca = func.count()
+    is_bs = func.coalesce(src.ngay_import.between(start, end) & (src.ngay_khoi_phat < start), False)
+    group_cols = [
+        src.xa_id, DonViHanhChinh.ten_don_vi, src.chan_doan_chinh, src.phan_do_benh,
+        src.ngay_khoi_phat, is_death, is_under_15, is_bs
+    ] + ([src.dia_chi_ap] if group_by_ap else [])
+    stmt = (
+        select(
+            src.xa_id, DonViHanhChinh.ten_don_vi.label('ten_xa'), (src.dia_chi_ap if group_by_ap else null()).label('dia_chi_ap'),
+            src.chan_doan_chinh, src.phan_do_benh, src.ngay_khoi_phat,
+            is_death.label('is_death'), is_under_15.label('is_under_15'), is_bs.label('is_bs'),
+            so_ca.label('so_ca')
+        )
+        .join(DonViHanhChinh, src.xa_id == DonViHanhChinh.id)
+        .where(
+            src.xa_id.in_(xa_ids_to_query),
+            src.ngay_khoi_phat.between(min_start, end) | (src.ngay_import.between(start, end) & (src.ngay_khoi_phat < start))
+        )
+        .group_by(*group_cols)
+    )
+    df_ca_benh = pd.read_sql_query(stmt, db_session.bind)
+    df_ca_benh['ngay_khoi_phat'] = pd.to_datetime(df_ca_benh['ngay_khoi_phat'], errors='coerce')
+    df_ca_benh['so_ca'] = df_ca_benh['so_ca'].astype('int64')
+    # SQLite trả cột logic dưới dạng 0/1
+    df_ca_benh[['is_death', 'is_under_15', 'is_bs']] = df_ca_benh[['is_death', 'is_under_15', 'is_bs']].astype(bool)
+
+    df_o_dich = None
+    if include_o_dich:
+        # Không giới hạn đầu kỳ: số liệu lũy kế trong phần nhận xét ổ dịch tính trên toàn bộ ổ dịch đến cuối kỳ
+        df_o_dich = load_outbreaks(db_session, xa_ids_to_query, periods['end'])
+
+    return {'periods': periods, 'group_by_ap': group_by_ap, 'ca_benh': df_ca_benh, 'o_dich': df_o_dich}
+
+
+def _between(series: pd.Series, start: date, end: date) -> pd.Series:
+    return (series >= pd.Timestamp(start)) & (series <= pd.Timestamp(end))
+
+
+def _top_locations(df: pd.DataFrame, value_col: str = None) -> pd.Series:
+    """Tổng số theo tên xã, sắp giảm dần (cùng số thì theo tên)."""
+    counts = df.groupby('ten_xa')[value_col].sum() if value_col else df.groupby('ten_xa').size()
+    return counts.sort_values(ascending=False, kind='stable')
+
+
+# ------------------------------------------------------------------------------
+# Báo cáo Bệnh truyền nhiễm
+# ------------------------------------------------------------------------------
+def btn_unit_results(aggregates: dict, disease_list: list[str]) -> pd.DataFrame:
+    """Số mắc/chết theo đơn vị và nhãn p (trong kỳ), bs (bổ sung), cd (cộng dồn từ 01/01) cho danh sách bệnh."""
+    df, periods = aggregates['ca_benh'], aggregates['periods']
+    unit_col = 'dia_chi_ap' if aggregates['group_by_ap'] else 'xa_id'
+    columns = ['label', 'unit_id'] + [f"{benh}_mac" for benh in disease_list] + [f"{benh}_chet" for benh in disease_list]
+    label_masks = {
+        'p': _between(df['ngay_khoi_phat'], periods['start'], periods['end']),
+        'bs': df['is_bs'],
+        'cd': _between(df['ngay_khoi_phat'], periods['start_of_year'], periods['end']),
+    }
+    frames = []
+    for label, mask in label_masks.items():
+        rows = df[mask & df[unit_col].notna()]
+        if rows.empty:
+            continue
+        data = {f"{benh}_mac": rows['so_ca'].where(rows['chan_doan_chinh'] == benh, 0) for benh in disease_list}
+        data.update({f"{benh}_chet": rows['so_ca'].where((rows['chan_doan_chinh'] == benh) & rows['is_death'], 0) for benh in disease_list})
+        grouped = pd.DataFrame(data).groupby(rows[unit_col]).sum().rename_axis('unit_id').reset_index()
+        grouped.insert(0, 'label', label)
+        frames.append(grouped)
+    return pd.concat(frames, ignore_index=True)[columns] if frames else pd.DataFrame(columns=columns)
+
+
+def btn_analysis(aggregates: dict) -> dict:
+    """Số liệu cho phần nhận xét báo cáo BTN (tương đương `_generate_btn_analysis_data`)."""
+    df, periods = aggregates['ca_benh'], aggregates['periods']
+    is_current = _between(df['ngay_khoi_phat'], periods['start'], periods['end'])
+    is_prev = _between(df['ngay_khoi_phat'], *periods['prev_period']) if periods['prev_period'] else pd.Series(False, index=df.index)
+    analysis = {
+        'total_ts': int(df.loc[is_current, 'so_ca'].sum()),
+        'deaths_ts': int(df.loc[is_current & df['is_death'], 'so_ca'].sum()),
+        'total_bs': int(df.loc[df['is_bs'], 'so_ca'].sum()),
+        'total_prev': int(df.loc[is_prev, 'so_ca'].sum()),
+    }
+
+    top_diseases = df[is_current].groupby('chan_doan_chinh', dropna=False)['so_ca'].sum().sort_values(ascending=False, kind='stable').head(3)
+    analysis['top_diseases'] = {(None if pd.isna(name) else name): int(count) for name, count in top_diseases.items()}
+
+    df_loc = df[is_current | df['is_bs']]
+    if not df_loc.empty:
+        top_loc = _top_locations(df_loc, 'so_ca')
+        name = top_loc.index[0]
+        by_disease = df_loc[df_loc['ten_xa'] == name].groupby('chan_doan_chinh')['so_ca'].sum()
+        analysis['top_location'] = {'name': name, 'count': int(top_loc.iloc[0]), 'disease': by_disease.idxmax() if not by_disease.empty else None}
+    else:
+        analysis['top_location'] = None
+
+    df_bs = df[df['is_bs']]
+    if periods['period_type'] == 'week':
+        iso = df_bs['ngay_khoi_phat'].dt.isocalendar()
+        original_year, original_period = iso['year'], iso['week']
+    else:
+        original_year, original_period = df_bs['ngay_khoi_phat'].dt.year, df_bs['ngay_khoi_phat'].dt.month
+    df_bs_details = (
+        df_bs.assign(original_year=original_year, original_period=original_period)
+        .groupby(['chan_doan_chinh', 'original_year', 'original_period'], dropna=False)['so_ca'].sum()
+        .reset_index(name='count')
+        .sort_values('count', ascending=False, kind='stable')
+    )
+    analysis['bs_details'] = df_bs_details.to_dict('records')
+    return analysis
+
+
+# ------------------------------------------------------------------------------
+# Báo cáo Sốt xuất huyết
+# ------------------------------------------------------------------------------
+def _sxh_cases(df: pd.DataFrame) -> pd.DataFrame:
+    return df[df['chan_doan_chinh'].str.contains(SXH_KEYWORD, regex=False, na=False)]
+
+
+def sxh_unit_results(aggregates: dict) -> pd.DataFrame:
+    """Bảng số liệu SXH theo đơn vị (index unit_id), cùng cột với truy vấn của `_generate_sxh_report_base`."""
+    df, periods = aggregates['ca_benh'], aggregates['periods']
+    unit_col = 'dia_chi_ap' if aggregates['group_by_ap'] else 'xa_id'
+    sxh = _sxh_cases(df)
+    sxh = sxh[_between(sxh['ngay_khoi_phat'], periods['ytd_start'], periods['end']) & sxh[unit_col].notna()]
+
+    so_ca = sxh['so_ca']
+    in_period = sxh['ngay_khoi_phat'] >= pd.Timestamp(periods['start'])
+    is_nhe = sxh['phan_do_benh'].notna() & (sxh['phan_do_benh'] != SXH_NANG)
+    is_nang = sxh['phan_do_benh'] == SXH_NANG
+    is_u15, is_death = sxh['is_under_15'], sxh['is_death']
+    data = {
+        'mac_cb_p': so_ca.where(is_nhe & in_period, 0),
+        'mac_cb_p_15t': so_ca.where(is_nhe & in_period & is_u15, 0),
+        'mac_nang_p': so_ca.where(is_nang & in_period, 0),
+        'mac_nang_p_15t': so_ca.where(is_nang & in_period & is_u15, 0),
+        'chet_p': so_ca.where(is_death & in_period, 0),
+        'chet_p_15t': so_ca.where(is_death & in_period & is_u15, 0),
+        'mac_cb_cd': so_ca.where(is_nhe, 0),
+        'mac_nang_cd': so_ca.where(is_nang, 0),
+        'tong_mac_cd': so_ca,
+        'chet_cd': so_ca.where(is_death, 0),
+    }
+    df_results = pd.DataFrame(data).groupby(sxh[unit_col]).sum().rename_axis('unit_id')
+    df_results['tong_mac_p'] = df_results['mac_cb_p'] + df_results['mac_nang_p']
+    return df_results
+
+
+def sxh_analysis(aggregates: dict) -> dict:
+    """Số liệu cho phần nhận xét báo cáo SXH (tương đương `_generate_sxh_analysis_data`)."""
+    df, periods = aggregates['ca_benh'], aggregates['periods']
+    sxh = _sxh_cases(df)
+    onset, so_ca = sxh['ngay_khoi_phat'], sxh['so_ca']
+    is_current = _between(onset, periods['start'], periods['end'])
+    is_prev = _between(onset, *periods['prev_period']) if periods['prev_period'] else pd.Series(False, index=sxh.index)
+    data = {
+        'total_this_period': int(so_ca[is_current].sum()),
+        'warning_this_period': int(so_ca[is_current & sxh['phan_do_benh'].notna() & (sxh['phan_do_benh'] != SXH_NANG)].sum()),
+        'severe_this_period': int(so_ca[is_current & (sxh['phan_do_benh'] == SXH_NANG)].sum()),
+        'deaths_this_period': int(so_ca[is_current & sxh['is_death']].sum()),
+        'total_prev_period': int(so_ca[is_prev].sum()),
+        'cumulative_this_year': int(so_ca[_between(onset, periods['ytd_start'], periods['end'])].sum()),
+        'cumulative_last_year': int(so_ca[_between(onset, *periods['last_year'])].sum()),
+    }
+    top_loc = _top_locations(sxh[is_current], 'so_ca')
+    if not top_loc.empty:
+        max_count = int(top_loc.iloc[0])
+        data['top_locations_this_period'] = {"locations": top_loc[top_loc == max_count].index.tolist(), "count": max_count}
+    else:
+        data['top_locations_this_period'] = None
+    return data
+
+
+# ------------------------------------------------------------------------------
+# Báo cáo Ổ dịch
+# ------------------------------------------------------------------------------
+# Nơi phát hiện ổ dịch TCM: hậu tố cột -> giá trị noi_phat_hien_tcm
+ODICH_SITES = {'TH': 'Trường học', 'CĐ': 'Cộng đồng'}
+
+
+def odich_rows(aggregates: dict, loai_benh: str) -> pd.DataFrame:
+    """Các ổ dịch của loại bệnh phát hiện từ mốc cộng dồn (đầu năm) đến cuối kỳ."""
+    df, periods = aggregates['o_dich'], aggregates['periods']
+    return df[(df['loai_benh'] == loai_benh) & _between(df['ngay_phat_hien'], periods['ytd_start'], periods['end'])]
+
+
+def odich_unit_counts(aggregates: dict, loai_benh: str, group_by_col: str, by_site: bool = False) -> pd.DataFrame:
+    """
+    Số ổ dịch theo đơn vị báo cáo (`group_by_col`: 'xa_id' hoặc 'dia_chi_ap') trong một lượt groupby:
+    ph/xl - phát hiện/đã xử lý trong kỳ, ph_cd/xl_cd - cộng dồn từ đầu năm,
+    dia_diem - các địa điểm đã xử lý (theo thứ tự nhập, mỗi địa điểm một dòng).
+    by_site=True tách số đếm theo nơi phát hiện (cột 'ph_TH', 'xl_cd_CĐ'...).
+    """
+    df, periods = odich_rows(aggregates, loai_benh), aggregates['periods']
+    processed = df['ngay_xu_ly'].notna()
+    in_period = df['ngay_phat_hien'] >= pd.Timestamp(periods['start'])
+    flags = pd.DataFrame({'ph': in_period, 'xl': in_period & processed, 'ph_cd': True, 'xl_cd': processed}, index=df.index).astype('int64')
+    if by_site:
+        flags = pd.concat([flags.where(df['noi_phat_hien_tcm'] == site, 0).add_suffix(f'_{suffix}') for suffix, site in ODICH_SITES.items()], axis=1)
+    counts = flags.groupby(df[group_by_col]).sum()
+    counts['dia_diem'] = df[processed & df['dia_diem_xu_ly'].notna()].groupby(group_by_col)['dia_diem_xu_ly'].agg('\n'.join)
+    return counts
+
+
+def _odich_period_frames(aggregates: dict, loai_benh: str):
+    df, periods = aggregates['o_dich'], aggregates['periods']
+    df = df[df['loai_benh'] == loai_benh]
+    this_period = df[_between(df['ngay_phat_hien'], periods['start'], periods['end'])]
+    last_period = df[_between(df['ngay_phat_hien'], *periods['prev_period'])] if periods['prev_period'] else df.iloc[0:0]
+    return df, this_period, last_period
+
+
+def _odich_top_locations(this_period: pd.DataFrame):
+    top_loc = _top_locations(this_period)
+    if top_loc.empty:
+        return None
+    return {"locations": top_loc[top_loc == top_loc.iloc[0]].index.tolist(), "count": int(top_loc.iloc[0])}
+
+
+def odich_sxh_analysis(aggregates: dict) -> dict:
+    """Số liệu cho phần nhận xét báo cáo ổ dịch SXH (kỳ hiện tại, kỳ trước, lũy kế đến cuối kỳ)."""
+    cumulative, this_week, last_week = _odich_period_frames(aggregates, 'SXH')
+    analysis = {'new_this_week': len(this_week), 'processed_this_week': int(this_week['ngay_xu_ly'].notna().sum())}
+    analysis['pending_this_week'] = analysis['new_this_week'] - analysis['processed_this_week']
+    analysis['new_last_week'] = len(last_week)
+    analysis['cumulative_total'] = len(cumulative)
+    analysis['cumulative_processed'] = int(cumulative['ngay_xu_ly'].notna().sum())
+    analysis['top_locations'] = _odich_top_locations(this_week)
+    return analysis
+
+
+def odich_tcm_analysis(aggregates: dict) -> dict:
+    """Số liệu cho phần nhận xét báo cáo ổ dịch TCM (kỳ hiện tại, kỳ trước, lũy kế đến cuối kỳ)."""
+    cumulative, this_week, last_week = _odich_period_frames(aggregates, 'TCM')
+    analysis = {'new_total_this_week': len(this_week), 'new_school_this_week': int((this_week['noi_phat_hien_tcm'] == 'Trường học').sum())}
+    analysis['new_community_this_week'] = analysis['new_total_this_week'] - analysis['new_school_this_week']
+    analysis['processed_this_week'] = int(this_week['ngay_xu_ly'].notna().sum())
+    analysis['new_school_last_week'] = int((last_week['noi_phat_hien_tcm'] == 'Trường học').sum())
+    analysis['cumulative_total'] = len(cumulative)
+    analysis['cumulative_school'] = int((cumulative['noi_phat_hien_tcm'] == 'Trường học').sum())
+    analysis['cumulative_processed'] = int(cumulative['ngay_xu_ly'].notna().sum())
+    analysis['top_locations'] = _odich_top_locations(this_week)
+    return analysis
@@ -0,0 +1,71 @@
+# file: webapp/core/report_cache.py
+
+import hashlib
+import hmac
+import json
+import os
+import uuid
+
+from .data_version import get_data_version
+
+# Bật/tắt bộ nhớ đệm báo cáo (REPORT_CACHE_ENABLED=0 để luôn tạo lại)
+REPORT_CACHE_ENABLED = os.getenv("REPORT_CACHE_ENABLED", "1") == "1"
+
+# Phiên bản định dạng báo cáo, nằm trong khóa bộ nhớ đệm. Tăng mỗi khi sửa mẫu, bố cục hoặc cách tính
+# số liệu của báo cáo để các file đã tạo bằng mã cũ không còn được dùng lại.
+REPORT_FORMAT_VERSION = 1
+
+# Khóa bí mật trộn vào tên file để người dùng khác không đoán được tên file báo cáo của đơn vị khác
+_CACHE_SECRET = os.getenv("SECRET_KEY", "dev_secret_key_thay_the_sau").encode("utf-8")
+
+
+def get_report_cache_key(db_session, xa_ids, **scope) -> str:
+    """
+    Khóa bộ nhớ đệm của một báo cáo: băm (mẫu báo cáo, đơn vị, kỳ/khoảng thời gian...)
+    cùng phiên bản dữ liệu hiện tại của các xã trong phạm vi báo cáo.
+    Dữ liệu thay đổi -> phiên bản đổi -> khóa đổi -> báo cáo được tạo lại.
+    """
+    return make_report_cache_key(get_data_version(db_session, xa_ids), **scope)
+
+
+def make_report_cache_key(data_version: int, **scope) -> str:
+    """Khóa bộ nhớ đệm khi đã có sẵn phiên bản dữ liệu (dùng lại một phiên bản cho nhiều mẫu báo cáo)."""
+    payload = dict(scope, data_version=data_version, format_version=REPORT_FORMAT_VERSION)
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hmac.new(_CACHE_SECRET, raw.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def get_cached_report(report_folder: str, cache_key: str, ext: str):
+    """Trả về tên file đã tạo trước đó cho khóa này (nếu còn), ngược lại None."""
+    filename = f"{cache_key}{ext}"
+    return filename if os.path.exists(os.path.join(report_folder, filename)) else None
+
+
+def render_to_cache(report_folder: str, cache_key: str, ext: str, render_func):
+    """
+    Gọi `render_func(filepath)` ghi vào file tạm rồi đổi tên thành `<cache_key><ext>`,
+    để yêu cầu khác không bao giờ đọc phải file đang ghi dở. Trả về tên file, hoặc None nếu không có dữ liệu.
+    """
+    filename = f"{cache_key}{ext}"
+    temp_path = os.path.join(report_folder, f"{cache_key}.{uuid.uuid4().hex}.tmp{ext}")
+    try:
+        render_func(temp_path)
+        if not os.path.exists(temp_path):
+            return None
+        os.replace(temp_path, os.path.join(report_folder, filename))
+        return filename
+    finally:
+        if os.path.exists(temp_path): os.remove(temp_path)
+
+
+def get_or_render_report(db_session, report_folder: str, xa_ids, ext: str, render_func, **scope):
+    """
+    Trả về tên file báo cáo trong `report_folder`: dùng lại file đã tạo nếu phạm vi và dữ liệu không đổi,
+    ngược lại gọi `render_func(filepath)` để tạo mới. Trả về None nếu báo cáo không có dữ liệu để ghi.
+    """
+    if REPORT_CACHE_ENABLED:
+        cache_key = get_report_cache_key(db_session, xa_ids, **scope)
+        return get_cached_report(report_folder, cache_key, ext) or render_to_cache(report_folder, cache_key, ext, render_func)
+    filename = f"{uuid.uuid4()}{ext}"
+    render_func(os.path.join(report_folder, filename))
+    return filename if os.path.exists(os.path.join(report_folder, filename)) else None
@@ -3,16 +3,27 @@ import pandas as pd
 import calendar
 from datetime import datetime, date, timedelta
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import text, func
+from sqlalchemy import text, func, select, union_all, literal
 import os
-import uuid
-import shutil
 import zipfile
 import re
-
-from .database_setup import CaBenh, DonViHanhChinh, O_Dich
+import itertools
+import csv
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, StringIO
+
+from .database_setup import CaBenh, DonViHanhChinh, TongHopCaBenh
 from .week_calendar import WeekCalendar
 from .utils import get_all_child_xa_ids
+from .case_rollup import use_case_rollup
+from .sql_compat import age_years
+from .report_aggregation import (
+    build_report_aggregates, get_report_periods, get_custom_periods, load_outbreaks,
+    btn_unit_results, btn_analysis, sxh_unit_results, sxh_analysis,
+    odich_unit_counts, odich_sxh_analysis, odich_tcm_analysis
+)
 
 # ==============================================================================
 # 1. HẰNG SỐ VÀ CẤU HÌNH
@@ -22,12 +33,30 @@ LIST_BENH_TRUYEN_NHIEM = [
     'Tay - chân - miệng', 'Viêm màng não do Não mô cầu', 'Sởi',
     'Viêm gan cấp tính', 'Đậu mùa khỉ', 'BTN nguy hiểm mới'
 ]
+# Số tiến trình tạo song song các báo cáo con trong gói "Tất cả báo cáo" (1 = tạo tuần tự)
+REPORT_ZIP_WORKERS = int(os.getenv("REPORT_ZIP_WORKERS", "1"))
+
+# Các cột của trang chi tiết ca bệnh: thuộc tính CaBenh (hoặc 'don_vi.ten_don_vi') -> tiêu đề cột
+BTN_DETAIL_COLUMNS = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'dia_chi_chi_tiet': 'Địa chỉ chi tiết', 'chan_doan_chinh': 'Chẩn đoán', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
+SXH_DETAIL_COLUMNS = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'dia_chi_chi_tiet': 'Địa chỉ chi tiết', 'phan_do_benh': 'Phân độ', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
+# Trang chi tiết / file xuất có nhiều hơn số dòng này được ghi theo từng dòng (constant_memory của xlsxwriter)
+EXCEL_STREAMING_ROWS = int(os.getenv("EXCEL_STREAMING_ROWS", "5000"))
+# Số dòng đầu dùng để ước lượng độ rộng cột khi ghi theo từng dòng
+EXCEL_WIDTH_SAMPLE_ROWS = 500
+CUSTOM_BTN_DETAIL_COLUMNS = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'chan_doan_chinh': 'Chẩn đoán', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
 # ==============================================================================
 # 2. CÁC HÀM TRỢ GIÚP (HELPER FUNCTIONS)
 # ==============================================================================
-def _execute_sql_to_df(db_session: Session, sql_query: str, params: dict = None) -> pd.DataFrame:
-    """Thực thi SQL và trả về DataFrame một cách an toàn."""
-    return pd.read_sql_query(text(sql_query), db_session.bind, params=params)
+def _execute_sql_to_df(db_session: Session, statement, params: dict = None) -> pd.DataFrame:
+    """Thực thi truy vấn (SQLAlchemy Core hoặc chuỗi SQL) và trả về DataFrame."""
+    if isinstance(statement, str): statement = text(statement)
+    return pd.read_sql_query(statement, db_session.bind, params=params)
+
+def _get_rollup_aggregates(db_session: Session, user_don_vi: DonViHanhChinh, year: int, period_type: str, period_number: int):
+    """Số liệu ca bệnh đọc từ bảng tổng hợp (nếu đã dựng) cho báo cáo tạo riêng lẻ; None nếu phải truy vấn ca_benh."""
+    if not use_case_rollup(db_session):
+        return None
+    return build_report_aggregates(db_session, user_don_vi, year, period_type, period_number, include_o_dich=False)
 
 def _get_formatted_unit_name(user_don_vi: DonViHanhChinh) -> str:
     cap_don_vi, ten_don_vi = user_don_vi.cap_don_vi, user_don_vi.ten_don_vi
@@ -56,15 +85,14 @@ def _get_reporting_units(db_session: Session, user_don_vi: DonViHanhChinh):
     
 def _get_reporting_logic(db_session: Session, user_don_vi: DonViHanhChinh):
     """
-    **SỬA LỖI LOGIC:** Trả về đúng cấp đơn vị báo cáo và các chuỗi SQL cần thiết.
+    **SỬA LỖI LOGIC:** Trả về đúng cấp đơn vị báo cáo và cột ca bệnh dùng để nhóm theo đơn vị.
     - Tỉnh -> danh sách Xã
     - Khu vực -> danh sách Xã
     - Xã -> danh sách Ấp
     """
     reporting_units = []
     # Mặc định cho Tỉnh và Khu vực: nhóm theo xã
-    group_by_sql_col = "dvh_xa.id"
-    join_sql = "" # Không cần join thêm vì đã có dvh_xa
+    group_by_col = CaBenh.xa_id
     unit_id_map_key = 'id'
 
     if user_don_vi.cap_don_vi == 'Tỉnh':
@@ -74,10 +102,10 @@ def _get_reporting_logic(db_session: Session, user_don_vi: DonViHanhChinh):
         reporting_units = db_session.query(DonViHanhChinh).filter(DonViHanhChinh.id.in_(child_xa_ids)).order_by(DonViHanhChinh.ten_don_vi).all()
     elif user_don_vi.cap_don_vi == 'Xã':
         reporting_units = db_session.query(DonViHanhChinh).filter(DonViHanhChinh.parent_id == user_don_vi.id, DonViHanhChinh.cap_don_vi == 'Ấp').order_by(DonViHanhChinh.ten_don_vi).all()
-        group_by_sql_col = "cb.dia_chi_ap" # Nhóm theo tên ấp (text)
+        group_by_col = CaBenh.dia_chi_ap # Nhóm theo tên ấp (text)
         unit_id_map_key = 'ten_don_vi'
 
-    return reporting_units, join_sql, group_by_sql_col, unit_id_map_key
+    return reporting_units, group_by_col, unit_id_map_key
 
 def _create_excel_formats(workbook):
     base_font_14 = {'font_name': 'Times new Roman', 'font_size': 14}
@@ -128,22 +156,73 @@ def _draw_standard_header(worksheet, formats, user_don_vi, report_title, period_
     if date_range_subtitle:
         worksheet.merge_range(f'A8:{last_col_letter}8', date_range_subtitle, formats['sxh_italic'])
 
-def _draw_details_sheet(writer: pd.ExcelWriter, sheet_name: str, data_objects: list, column_map: dict, title: str, formats: dict):
-    if not data_objects: return
-    records = []
-    for obj in data_objects:
-        record = {}
-        for attr, header in column_map.items():
-            value = obj
-            try:
-                for part in attr.split('.'):
-                    value = getattr(value, part, None)
-                    if value is None: break
-                record[header] = value
-            except AttributeError:
-                record[header] = None
-        records.append(record)
-    df_details = pd.DataFrame(records)
+def _query_case_details(db_session: Session, column_map: dict, *criteria, order_by=None) -> pd.DataFrame:
+    """
+    Lấy danh sách ca bệnh cho trang chi tiết bằng một truy vấn chỉ gồm các cột cần hiển thị
+    (tên xã lấy bằng JOIN), đọc thẳng vào DataFrame với tên cột là tiêu đề trong `column_map`.
+    """
+    columns = [
+        (DonViHanhChinh.ten_don_vi if attr == 'don_vi.ten_don_vi' else getattr(CaBenh, attr)).label(f"c{i}")
+        for i, attr in enumerate(column_map)
+    ]
+    stmt = (
+        select(*columns)
+        .select_from(CaBenh)
+        .outerjoin(DonViHanhChinh, CaBenh.xa_id == DonViHanhChinh.id)
+        .where(*criteria)
+        .order_by(*(order_by if order_by is not None else [CaBenh.id]))
+    )
+    df_details = pd.read_sql_query(stmt, db_session.bind)
+    df_details.columns = list(column_map.values())
+    return df_details
+
+def _add_streaming_worksheet(workbook, sheet_name: str):
+    """
+    Thêm một sheet ở chế độ constant_memory (chỉ riêng sheet này, các sheet khác của file không đổi):
+    mỗi dòng được ghi thẳng ra file tạm khi chuyển sang dòng sau, nên phải ghi các dòng theo thứ tự tăng dần.
+    """
+    previous = workbook.constant_memory
+    workbook.constant_memory = True
+    try:
+        return workbook.add_worksheet(sheet_name)
+    finally:
+        workbook.constant_memory = previous
+
+def _estimate_column_widths(headers: list, sample_rows) -> list[int]:
+    """Độ rộng cột theo tiêu đề và các dòng mẫu (cùng cách tính với phần tự căn độ rộng cột của trang chi tiết)."""
+    widths = [len(str(header)) for header in headers]
+    for row in sample_rows:
+        for idx, value in enumerate(row):
+            widths[idx] = max(widths[idx], len(str(value)))
+    return [width + 2 for width in widths]
+
+def _write_rows_streaming(workbook, worksheet, headers: list, rows, start_row: int):
+    """Ghi dòng tiêu đề (cùng kiểu với pandas.to_excel) rồi lần lượt từng dòng dữ liệu, không giữ lại dòng nào trong bộ nhớ."""
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    worksheet.write_row(start_row, 0, headers, header_format)
+    for row_idx, row in enumerate(rows, start=start_row + 1):
+        for col_idx, value in enumerate(row):
+            if value is None or pd.isna(value):
+                continue
+            if isinstance(value, date):
+                worksheet.write_datetime(row_idx, col_idx, value, date_format)
+            else:
+                worksheet.write(row_idx, col_idx, value)
+
+def _draw_details_sheet(writer: pd.ExcelWriter, sheet_name: str, df_details: pd.DataFrame, title: str, formats: dict):
+    if df_details is None or df_details.empty: return
+    if len(df_details) > EXCEL_STREAMING_ROWS:
+        # Danh sách lớn: ghi theo từng dòng, độ rộng cột ước lượng từ các dòng đầu
+        workbook = writer.book
+        worksheet = _add_streaming_worksheet(workbook, sheet_name)
+        headers = list(df_details.columns)
+        widths = _estimate_column_widths(headers, df_details.head(EXCEL_WIDTH_SAMPLE_ROWS).itertuples(index=False, name=None))
+        for idx, width in enumerate(widths):
+            worksheet.set_column(idx, idx, width)
+        worksheet.merge_range(f'A1:{chr(ord("A") + len(headers) - 1)}1', title, formats['title'])
+        _write_rows_streaming(workbook, worksheet, headers, df_details.itertuples(index=False, name=None), start_row=2)
+        return
     df_details.to_excel(writer, sheet_name=sheet_name, index=False, startrow=2)
     worksheet = writer.sheets[sheet_name]
     num_cols = len(df_details.columns)
@@ -160,7 +239,7 @@ def _draw_details_sheet(writer: pd.ExcelWriter, sheet_name: str, data_objects: l
 def _generate_custom_btn_report_core(
     filepath: str, user_don_vi: DonViHanhChinh, start_date: date, end_date: date,
     reporting_units: list[DonViHanhChinh], df_results: pd.DataFrame,
-    dynamic_disease_list: list[str], list_cases_for_details_sheet: list
+    dynamic_disease_list: list[str], df_cases_for_details_sheet: pd.DataFrame
 ):
     """Vẽ file Excel cho báo cáo BTN tùy chỉnh với cấu trúc đơn giản."""
     with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
@@ -237,91 +316,40 @@ def _generate_custom_btn_report_core(
         worksheet.merge_range(f'{sign_col_start_letter}{title_line_row}:{last_col_letter}{title_line_row}', chuc_danh_map.get(user_don_vi.cap_don_vi, 'THỦ TRƯỞNG ĐƠN VỊ'), formats['org_header'])
         
         # Trang chi tiết ca bệnh
-        cabenh_column_map = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'chan_doan_chinh': 'Chẩn đoán', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
-        _draw_details_sheet(writer, 'ChiTiet_CaBenh', list_cases_for_details_sheet, cabenh_column_map, f"DANH SÁCH CA BỆNH GHI NHẬN", formats)
+        _draw_details_sheet(writer, 'ChiTiet_CaBenh', df_cases_for_details_sheet, f"DANH SÁCH CA BỆNH GHI NHẬN", formats)
 
 
 # ==============================================================================
 # 3. BÁO CÁO BỆNH TRUYỀN NHIỄM
 # ==============================================================================
 def _generate_btn_analysis_data(db_session: Session, user_don_vi: DonViHanhChinh, current_period: tuple, prev_period: tuple, period_type: str, **kwargs):
-    analysis = {}
     xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
     if not xa_ids_to_query: return None
 
-    sql_summary_query = """
-    SELECT 
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :current_start AND :current_end) as total_ts,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :current_start AND :current_end AND tinh_trang_hien_nay = 'Tử vong') as deaths_ts,
-        COUNT(*) FILTER (WHERE ngay_import BETWEEN :current_start AND :current_end AND ngay_khoi_phat < :current_start) as total_bs,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :prev_start AND :prev_end) as total_prev
-    FROM ca_benh WHERE xa_id IN :xa_ids;
-    """
-    params_summary = {
-        "xa_ids": tuple(xa_ids_to_query),
-        "current_start": current_period[0], "current_end": current_period[1],
-        "prev_start": prev_period[0] if prev_period else date(1900, 1, 1),
-        "prev_end": prev_period[1] if prev_period else date(1900, 1, 1),
-    }
-    summary = _execute_sql_to_df(db_session, sql_summary_query, params_summary).iloc[0]
-    analysis.update(summary.to_dict())
-
-    top_diseases_sql = """
-        SELECT chan_doan_chinh, COUNT(id) as so_ca FROM ca_benh 
-        WHERE xa_id IN :xa_ids AND ngay_khoi_phat BETWEEN :start AND :end
-        GROUP BY chan_doan_chinh ORDER BY so_ca DESC LIMIT 3;
-    """
-    df_top_diseases = _execute_sql_to_df(db_session, top_diseases_sql, {"xa_ids": tuple(xa_ids_to_query), "start": current_period[0], "end": current_period[1]})
-    analysis['top_diseases'] = pd.Series(df_top_diseases.so_ca.values, index=df_top_diseases.chan_doan_chinh).to_dict()
-
-    top_loc_sql = """
-        SELECT dv.ten_don_vi, COUNT(cb.id) as so_ca, mode() WITHIN GROUP (ORDER BY cb.chan_doan_chinh) as top_disease
-        FROM ca_benh cb JOIN don_vi_hanh_chinh dv ON cb.xa_id = dv.id
-        WHERE cb.xa_id IN :xa_ids AND (
-            (cb.ngay_khoi_phat BETWEEN :start AND :end) OR
-            (cb.ngay_import BETWEEN :start AND :end AND cb.ngay_khoi_phat < :start)
-        ) GROUP BY dv.ten_don_vi ORDER BY so_ca DESC LIMIT 1;
-    """
-    df_top_loc = _execute_sql_to_df(db_session, top_loc_sql, {"xa_ids": tuple(xa_ids_to_query), "start": current_period[0], "end": current_period[1]})
-    if not df_top_loc.empty:
-        top_loc = df_top_loc.iloc[0]
-        analysis['top_location'] = {'name': top_loc['ten_don_vi'], 'count': int(top_loc['so_ca']), 'disease': top_loc['top_disease']}
-    else:
-        analysis['top_location'] = None
-
-    if period_type == 'week':
-        sql_bs_details = """
-        SELECT 
-            chan_doan_chinh, 
-            EXTRACT(isoyear FROM ngay_khoi_phat) as original_year,
-            EXTRACT(week FROM ngay_khoi_phat) as original_period,
-            COUNT(id) as count
-        FROM ca_benh
-        WHERE xa_id IN :xa_ids AND ngay_import BETWEEN :start AND :end AND ngay_khoi_phat < :start
-        GROUP BY chan_doan_chinh, original_year, original_period
-        ORDER BY count DESC;
-        """
-    else: # month
-        sql_bs_details = """
-        SELECT 
-            chan_doan_chinh, 
-            EXTRACT(year FROM ngay_khoi_phat) as original_year,
-            EXTRACT(month FROM ngay_khoi_phat) as original_period,
-            COUNT(id) as count
-        FROM ca_benh
-        WHERE xa_id IN :xa_ids AND ngay_import BETWEEN :start AND :end AND ngay_khoi_phat < :start
-        GROUP BY chan_doan_chinh, original_year, original_period
-        ORDER BY count DESC;
-        """
-    params_bs_details = {
-        "xa_ids": tuple(xa_ids_to_query),
-        "start": current_period[0],
-        "end": current_period[1]
-    }
-    df_bs_details = _execute_sql_to_df(db_session, sql_bs_details, params_bs_details)
-    analysis['bs_details'] = df_bs_details.to_dict('records')
-    
-    return analysis
+    # Một truy vấn duy nhất: số ca trong phạm vi (kỳ này, kỳ trước, bổ sung) gom theo xã, bệnh, ngày khởi phát;
+    # tổng hợp, top 3 bệnh, địa phương nhiều ca nhất và chi tiết ca bổ sung được suy ra bằng `btn_analysis`.
+    current_start, current_end = current_period
+    is_current = CaBenh.ngay_khoi_phat.between(current_start, current_end)
+    is_bs = CaBenh.ngay_import.between(current_start, current_end) & (CaBenh.ngay_khoi_phat < current_start)
+    scope = is_current | is_bs
+    if prev_period: scope = scope | CaBenh.ngay_khoi_phat.between(*prev_period)
+    is_death = func.coalesce(CaBenh.tinh_trang_hien_nay == 'Tử vong', False)
+    is_bs = func.coalesce(is_bs, False)
+    group_cols = [DonViHanhChinh.ten_don_vi, CaBenh.chan_doan_chinh, CaBenh.ngay_khoi_phat, is_death, is_bs]
+    stmt = (
+        select(
+            DonViHanhChinh.ten_don_vi.label('ten_xa'), CaBenh.chan_doan_chinh, CaBenh.ngay_khoi_phat,
+            is_death.label('is_death'), is_bs.label('is_bs'), func.count().label('so_ca')
+        )
+        .join(DonViHanhChinh, CaBenh.xa_id == DonViHanhChinh.id)
+        .where(CaBenh.xa_id.in_(xa_ids_to_query), scope)
+        .group_by(*group_cols)
+    )
+    df_cases = _execute_sql_to_df(db_session, stmt)
+    df_cases['ngay_khoi_phat'] = pd.to_datetime(df_cases['ngay_khoi_phat'], errors='coerce')
+    df_cases[['is_death', 'is_bs']] = df_cases[['is_death', 'is_bs']].astype(bool)
+    periods = {'period_type': period_type, 'start': current_start, 'end': current_end, 'prev_period': prev_period}
+    return btn_analysis({'ca_benh': df_cases, 'periods': periods})
 
 def _generate_btn_comments(analysis: dict, period_type: str, period_number: int, prev_period_number: int, user_don_vi: DonViHanhChinh):
     if not analysis: return ["- Không có dữ liệu để tạo nhận xét."]
@@ -344,7 +372,7 @@ def _generate_btn_comments(analysis: dict, period_type: str, period_number: int,
 def _generate_btn_report_core(
     filepath: str, user_don_vi: DonViHanhChinh, report_title: str, period_name: str,
     date_range_subtitle: str, end_of_period_dt: date, reporting_units: list[DonViHanhChinh],
-    df_results: pd.DataFrame, list_cases_for_details_sheet: list, period_label: str, note_text: str, comments: list, analysis_data: dict | None,
+    df_results: pd.DataFrame, df_cases_for_details_sheet: pd.DataFrame, period_label: str, note_text: str, comments: list, analysis_data: dict | None,
     unit_id_map_key: str = 'id'
 ):
     with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
@@ -424,8 +452,7 @@ def _generate_btn_report_core(
         worksheet.merge_range(f'A{title_line_row}:D{title_line_row}', 'NGƯỜI BÁO CÁO', formats['org_header'])
         worksheet.merge_range(f'A{recipient_line_row}:D{recipient_line_row}', 'Nơi nhận:', formats['noinhan'])
 
-        cabenh_column_map = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'dia_chi_chi_tiet': 'Địa chỉ chi tiết', 'chan_doan_chinh': 'Chẩn đoán', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
-        _draw_details_sheet(writer, 'ChiTiet_CaBenh', list_cases_for_details_sheet, cabenh_column_map, f"DANH SÁCH CA BỆNH GHI NHẬN TRONG {period_name.upper()}", formats)
+        _draw_details_sheet(writer, 'ChiTiet_CaBenh', df_cases_for_details_sheet, f"DANH SÁCH CA BỆNH GHI NHẬN TRONG {period_name.upper()}", formats)
 
         if analysis_data and analysis_data.get('bs_details'):
             worksheet_bs = workbook.add_worksheet('ChiTiet_CaBoSung')
@@ -454,9 +481,35 @@ def _generate_btn_report_core(
 
 
 
+def _query_btn_unit_results(db_session: Session, user_don_vi: DonViHanhChinh, xa_ids_to_query: list, start_of_year_dt: date, start_of_period_dt: date, end_of_period_dt: date) -> pd.DataFrame:
+    """Số mắc/chết theo đơn vị và nhãn p/bs/cd cho báo cáo BTN, truy vấn trực tiếp từ ca_benh."""
+    is_group_by_ap = (user_don_vi.cap_don_vi == 'Xã')
+    unit_col = CaBenh.dia_chi_ap if is_group_by_ap else CaBenh.xa_id  # Sửa lỗi group by ấp
+
+    counts = [func.count().filter(CaBenh.chan_doan_chinh == benh).label(f"{benh}_mac") for benh in LIST_BENH_TRUYEN_NHIEM]
+    counts += [func.count().filter((CaBenh.chan_doan_chinh == benh) & (CaBenh.tinh_trang_hien_nay == 'Tử vong')).label(f"{benh}_chet") for benh in LIST_BENH_TRUYEN_NHIEM]
+    label_filters = [
+        ('p', CaBenh.ngay_khoi_phat.between(start_of_period_dt, end_of_period_dt)),
+        ('bs', CaBenh.ngay_import.between(start_of_period_dt, end_of_period_dt) & (CaBenh.ngay_khoi_phat < start_of_period_dt)),
+        ('cd', (CaBenh.ngay_khoi_phat >= start_of_year_dt) & (CaBenh.ngay_khoi_phat <= end_of_period_dt)),
+    ]
+    sql_query = union_all(*[
+        select(literal(label).label('label'), unit_col.label('unit_id'), *counts)
+        .where(CaBenh.xa_id.in_(xa_ids_to_query), condition, unit_col.isnot(None))
+        .group_by(unit_col)
+        for label, condition in label_filters
+    ])
+    df_results = _execute_sql_to_df(db_session, sql_query)
+
+    # Ánh xạ ID sang Tên cho cấp Khu vực và Tỉnh
+    if not is_group_by_ap and not df_results.empty:
+        don_vi_map = {d.id: d.ten_don_vi for d in db_session.query(DonViHanhChinh).filter(DonViHanhChinh.id.in_(df_results['unit_id'].unique().tolist())).all()}
+        df_results['unit_name'] = df_results['unit_id'].map(don_vi_map)
+    return df_results
+
 def _generate_benh_truyen_nhiem_report_base(
     db_session: Session, user_don_vi: DonViHanhChinh, filepath: str,
-    year: int, period_type: str, period_number: int
+    year: int, period_type: str, period_number: int, aggregates: dict = None
 ):
     # GIAI ĐOẠN 1: CHUẨN BỊ THAM SỐ
     start_of_year_dt = date(year, 1, 1)
@@ -500,48 +553,6 @@ def _generate_benh_truyen_nhiem_report_base(
         return
 
     # GIAI ĐOẠN 2: TÍNH TOÁN DỮ LIỆU
-    is_group_by_ap = (user_don_vi.cap_don_vi == 'Xã')
-    group_by_unit_id = "dv.id" if not is_group_by_ap else "cb.dia_chi_ap"  # Sửa lỗi group by ấp
-    unit_name_col = "dvh_unit.ten_don_vi"
-    if is_group_by_ap:
-        unit_name_col = "cb.dia_chi_ap"
-    unit_id_mapping = {unit.id: unit.ten_don_vi for unit in reporting_units}
-
-    mac_cases = "\n".join([f", COUNT(*) FILTER (WHERE cb.chan_doan_chinh = '{benh}') AS \"{benh}_mac\"" for benh in LIST_BENH_TRUYEN_NHIEM])
-    chet_cases = "\n".join([f", COUNT(*) FILTER (WHERE cb.chan_doan_chinh = '{benh}' AND cb.tinh_trang_hien_nay = 'Tử vong') AS \"{benh}_chet\"" for benh in LIST_BENH_TRUYEN_NHIEM])
-
-    sql_query = f"""
-    WITH base_query AS (
-        SELECT 'p' as label, {group_by_unit_id} as unit_id {mac_cases} {chet_cases}
-        FROM ca_benh cb JOIN don_vi_hanh_chinh dv ON cb.xa_id = dv.id
-        WHERE cb.xa_id IN :xa_ids AND cb.ngay_khoi_phat BETWEEN :start_of_period AND :end_of_period
-        GROUP BY unit_id
-        UNION ALL
-        SELECT 'bs' as label, {group_by_unit_id} as unit_id {mac_cases} {chet_cases}
-        FROM ca_benh cb JOIN don_vi_hanh_chinh dv ON cb.xa_id = dv.id
-        WHERE cb.xa_id IN :xa_ids AND cb.ngay_import BETWEEN :start_of_period AND :end_of_period AND cb.ngay_khoi_phat < :start_of_period
-        GROUP BY unit_id
-        UNION ALL
-        SELECT 'cd' as label, {group_by_unit_id} as unit_id {mac_cases} {chet_cases}
-        FROM ca_benh cb JOIN don_vi_hanh_chinh dv ON cb.xa_id = dv.id
-        WHERE cb.xa_id IN :xa_ids AND cb.ngay_khoi_phat >= :start_of_year AND cb.ngay_khoi_phat <= :end_of_period
-        GROUP BY unit_id
-    )
-    SELECT * FROM base_query WHERE unit_id IS NOT NULL;
-    """
-    params = {
-        "xa_ids": tuple(xa_ids_to_query),
-        "start_of_period": start_of_period_dt,
-        "end_of_period": end_of_period_dt,
-        "start_of_year": start_of_year_dt
-    }
-    df_results = _execute_sql_to_df(db_session, sql_query, params)
-
-    # Ánh xạ ID sang Tên cho cấp Khu vực và Tỉnh
-    if not is_group_by_ap and not df_results.empty:
-        don_vi_map = {d.id: d.ten_don_vi for d in db_session.query(DonViHanhChinh).filter(DonViHanhChinh.id.in_(df_results['unit_id'].unique().tolist())).all()}
-        df_results['unit_name'] = df_results['unit_id'].map(don_vi_map)
-
     analysis_periods = {"current_period": (start_of_period_dt, end_of_period_dt), "prev_period": prev_period}
     comment_details = {
         "period_type": period_type,
@@ -549,20 +560,24 @@ def _generate_benh_truyen_nhiem_report_base(
         "prev_period_number": (period_number - 1 if period_type == 'week' else prev_month),
         "user_don_vi": user_don_vi
     }
-    analysis_data = _generate_btn_analysis_data(db_session, user_don_vi, period_type=period_type, **analysis_periods)
+    if aggregates is None:
+        aggregates = _get_rollup_aggregates(db_session, user_don_vi, year, period_type, period_number)
+    if aggregates is not None:
+        # Dùng số liệu đã tổng hợp một lượt cho cả gói báo cáo (xem report_aggregation.py)
+        df_results = btn_unit_results(aggregates, LIST_BENH_TRUYEN_NHIEM)
+        analysis_data = btn_analysis(aggregates)
+    else:
+        df_results = _query_btn_unit_results(db_session, user_don_vi, xa_ids_to_query, start_of_year_dt, start_of_period_dt, end_of_period_dt)
+        analysis_data = _generate_btn_analysis_data(db_session, user_don_vi, period_type=period_type, **analysis_periods)
     comments = _generate_btn_comments(analysis_data, **comment_details)
 
-    list_cases_for_details_sheet = (
-        db_session.query(CaBenh)
-        .options(joinedload(CaBenh.don_vi))
-        .filter(
-            CaBenh.xa_id.in_(xa_ids_to_query),
-            (
-                (CaBenh.ngay_khoi_phat.between(start_of_period_dt, end_of_period_dt)) |
-                ((CaBenh.ngay_import.between(start_of_period_dt, end_of_period_dt)) & (CaBenh.ngay_khoi_phat < start_of_period_dt))
-            )
+    df_cases_for_details_sheet = _query_case_details(
+        db_session, BTN_DETAIL_COLUMNS,
+        CaBenh.xa_id.in_(xa_ids_to_query),
+        (
+            (CaBenh.ngay_khoi_phat.between(start_of_period_dt, end_of_period_dt)) |
+            ((CaBenh.ngay_import.between(start_of_period_dt, end_of_period_dt)) & (CaBenh.ngay_khoi_phat < start_of_period_dt))
         )
-        .all()
     )
 
     # GIAI ĐOẠN 3: KẾT XUẤT
@@ -575,7 +590,7 @@ def _generate_benh_truyen_nhiem_report_base(
         end_of_period_dt=end_of_period_dt,
         reporting_units=reporting_units,
         df_results=df_results,
-        list_cases_for_details_sheet=list_cases_for_details_sheet,
+        df_cases_for_details_sheet=df_cases_for_details_sheet,
         period_label=period_label,
         note_text=note_text,
         comments=comments,
@@ -585,21 +600,21 @@ def _generate_benh_truyen_nhiem_report_base(
 
 def generate_benh_truyen_nhiem_report(
     db_session: Session, calendar_obj: WeekCalendar, week_number: int,
-    user_don_vi: DonViHanhChinh, filepath: str
+    user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None
 ):
     _generate_benh_truyen_nhiem_report_base(
         db_session, user_don_vi, filepath,
-        year=calendar_obj.year, period_type='week', period_number=week_number
+        year=calendar_obj.year, period_type='week', period_number=week_number, aggregates=aggregates
     )
 
 
 def generate_benh_truyen_nhiem_report_monthly(
     db_session: Session, year: int, month: int,
-    user_don_vi: DonViHanhChinh, filepath: str
+    user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None
 ):
     _generate_benh_truyen_nhiem_report_base(
         db_session, user_don_vi, filepath,
-        year=year, period_type='month', period_number=month
+        year=year, period_type='month', period_number=month, aggregates=aggregates
     )
 
 # ==============================================================================
@@ -609,30 +624,27 @@ def _generate_sxh_analysis_data(db_session: Session, user_don_vi: DonViHanhChinh
     data = {}
     xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
     if not xa_ids_to_query: return None
-    sql_query = """
-    SELECT
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :c_start AND :c_end) as total_this_period,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :c_start AND :c_end AND phan_do_benh != 'Sốt xuất huyết Dengue nặng') as warning_this_period,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :c_start AND :c_end AND phan_do_benh = 'Sốt xuất huyết Dengue nặng') as severe_this_period,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :c_start AND :c_end AND tinh_trang_hien_nay = 'Tử vong') as deaths_this_period,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :p_start AND :p_end) as total_prev_period,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :cty_start AND :cty_end) as cumulative_this_year,
-        COUNT(*) FILTER (WHERE ngay_khoi_phat BETWEEN :cly_start AND :cly_end) as cumulative_last_year
-    FROM ca_benh WHERE xa_id IN :xa_ids AND chan_doan_chinh LIKE '%%Sốt xuất huyết%%'
-    """
-    params = {
-        "xa_ids": tuple(xa_ids_to_query), "c_start": current_period[0], "c_end": current_period[1],
-        "p_start": prev_period[0] if prev_period else date(1900,1,1), "p_end": prev_period[1] if prev_period else date(1900,1,1),
-        "cty_start": cumulative_this_year[0], "cty_end": cumulative_this_year[1],
-        "cly_start": cumulative_last_year[0], "cly_end": cumulative_last_year[1],
-    }
-    data = _execute_sql_to_df(db_session, sql_query, params).iloc[0].to_dict()
-    top_loc_sql = """
-        SELECT dv.ten_don_vi, COUNT(cb.id) as so_ca FROM ca_benh cb JOIN don_vi_hanh_chinh dv ON cb.xa_id = dv.id
-        WHERE cb.xa_id IN :xa_ids AND cb.chan_doan_chinh LIKE '%%Sốt xuất huyết%%' AND cb.ngay_khoi_phat BETWEEN :start AND :end
-        GROUP BY dv.ten_don_vi ORDER BY so_ca DESC;
-    """
-    df_top_loc = _execute_sql_to_df(db_session, top_loc_sql, {"xa_ids": tuple(xa_ids_to_query), "start": current_period[0], "end": current_period[1]})
+    onset = CaBenh.ngay_khoi_phat
+    in_current = onset.between(*current_period)
+    in_prev = onset.between(*prev_period) if prev_period else onset.between(date(1900, 1, 1), date(1900, 1, 1))
+    is_sxh = [CaBenh.xa_id.in_(xa_ids_to_query), CaBenh.chan_doan_chinh.like('%Sốt xuất huyết%')]
+    sql_query = select(
+        func.count().filter(in_current).label('total_this_period'),
+        func.count().filter(in_current & (CaBenh.phan_do_benh != 'Sốt xuất huyết Dengue nặng')).label('warning_this_period'),
+        func.count().filter(in_current & (CaBenh.phan_do_benh == 'Sốt xuất huyết Dengue nặng')).label('severe_this_period'),
+        func.count().filter(in_current & (CaBenh.tinh_trang_hien_nay == 'Tử vong')).label('deaths_this_period'),
+        func.count().filter(in_prev).label('total_prev_period'),
+        func.count().filter(onset.between(*cumulative_this_year)).label('cumulative_this_year'),
+        func.count().filter(onset.between(*cumulative_last_year)).label('cumulative_last_year'),
+    ).where(*is_sxh)
+    data = _execute_sql_to_df(db_session, sql_query).iloc[0].to_dict()
+    top_loc_sql = (
+        select(DonViHanhChinh.ten_don_vi, func.count(CaBenh.id).label('so_ca'))
+        .join(DonViHanhChinh, CaBenh.xa_id == DonViHanhChinh.id)
+        .where(*is_sxh, in_current)
+        .group_by(DonViHanhChinh.ten_don_vi).order_by(func.count(CaBenh.id).desc())
+    )
+    df_top_loc = _execute_sql_to_df(db_session, top_loc_sql)
     if not df_top_loc.empty:
         max_count = df_top_loc.iloc[0]['so_ca']
         top_locations = df_top_loc[df_top_loc['so_ca'] == max_count]['ten_don_vi'].tolist()
@@ -659,50 +671,53 @@ def _generate_sxh_comments(data: dict, period_type: str, period_number: int, pre
     else: comments.append(f"- Trong {period_type_lower} không ghi nhận ca mắc SXHD nào.")
     return comments
 
-def _generate_sxh_report_base(db_session: Session, start_of_year_dt: date, end_of_period_dt: date, start_of_period_dt: date, user_don_vi: DonViHanhChinh, filepath: str, period_name: str, year: int, analysis_periods: dict = None, comment_details: dict = None):
-    reporting_units, join_sql, group_by_sql_col, unit_id_map_key = _get_reporting_logic(db_session, user_don_vi)
+def _generate_sxh_report_base(db_session: Session, start_of_year_dt: date, end_of_period_dt: date, start_of_period_dt: date, user_don_vi: DonViHanhChinh, filepath: str, period_name: str, year: int, analysis_periods: dict = None, comment_details: dict = None, aggregates: dict = None):
+    reporting_units, unit_col, unit_id_map_key = _get_reporting_logic(db_session, user_don_vi)
     if not reporting_units: return
     
     xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
     if not xa_ids_to_query: return
     
-    sql_query = f"""
-    WITH sxh_cases AS (
-        SELECT
-            cb.phan_do_benh, cb.tinh_trang_hien_nay, cb.ngay_khoi_phat,
-            (EXTRACT(YEAR FROM age(cb.ngay_khoi_phat, cb.ngay_sinh)) <= 15) as is_under_15,
-            {group_by_sql_col} as unit_id
-        FROM ca_benh cb JOIN don_vi_hanh_chinh dvh_xa ON cb.xa_id = dvh_xa.id {join_sql}
-        WHERE cb.xa_id IN :xa_ids AND cb.chan_doan_chinh LIKE '%%Sốt xuất huyết%%'
-        AND cb.ngay_khoi_phat BETWEEN :start_of_year AND :end_of_period
+    in_period = CaBenh.ngay_khoi_phat >= start_of_period_dt
+    is_under_15 = age_years(CaBenh.ngay_khoi_phat, CaBenh.ngay_sinh) <= 15
+    is_nhe, is_nang = CaBenh.phan_do_benh != 'Sốt xuất huyết Dengue nặng', CaBenh.phan_do_benh == 'Sốt xuất huyết Dengue nặng'
+    is_death = CaBenh.tinh_trang_hien_nay == 'Tử vong'
+    sql_query = (
+        select(
+            unit_col.label('unit_id'),
+            func.count().filter(is_nhe & in_period).label('mac_cb_p'),
+            func.count().filter(is_nhe & in_period & is_under_15).label('mac_cb_p_15t'),
+            func.count().filter(is_nang & in_period).label('mac_nang_p'),
+            func.count().filter(is_nang & in_period & is_under_15).label('mac_nang_p_15t'),
+            func.count().filter(is_death & in_period).label('chet_p'),
+            func.count().filter(is_death & in_period & is_under_15).label('chet_p_15t'),
+            func.count().filter(is_nhe).label('mac_cb_cd'),
+            func.count().filter(is_nang).label('mac_nang_cd'),
+            func.count().label('tong_mac_cd'),
+            func.count().filter(is_death).label('chet_cd'),
+        )
+        .where(
+            CaBenh.xa_id.in_(xa_ids_to_query), CaBenh.chan_doan_chinh.like('%Sốt xuất huyết%'),
+            CaBenh.ngay_khoi_phat.between(start_of_year_dt, end_of_period_dt), unit_col.isnot(None)
+        )
+        .group_by(unit_col)
     )
-    SELECT
-        unit_id,
-        COUNT(*) FILTER (WHERE phan_do_benh != 'Sốt xuất huyết Dengue nặng' AND ngay_khoi_phat >= :start_of_period) as mac_cb_p,
-        COUNT(*) FILTER (WHERE phan_do_benh != 'Sốt xuất huyết Dengue nặng' AND ngay_khoi_phat >= :start_of_period AND is_under_15) as mac_cb_p_15t,
-        COUNT(*) FILTER (WHERE phan_do_benh = 'Sốt xuất huyết Dengue nặng' AND ngay_khoi_phat >= :start_of_period) as mac_nang_p,
-        COUNT(*) FILTER (WHERE phan_do_benh = 'Sốt xuất huyết Dengue nặng' AND ngay_khoi_phat >= :start_of_period AND is_under_15) as mac_nang_p_15t,
-        COUNT(*) FILTER (WHERE tinh_trang_hien_nay = 'Tử vong' AND ngay_khoi_phat >= :start_of_period) as chet_p,
-        COUNT(*) FILTER (WHERE tinh_trang_hien_nay = 'Tử vong' AND ngay_khoi_phat >= :start_of_period AND is_under_15) as chet_p_15t,
-        COUNT(*) FILTER (WHERE phan_do_benh != 'Sốt xuất huyết Dengue nặng') as mac_cb_cd,
-        COUNT(*) FILTER (WHERE phan_do_benh = 'Sốt xuất huyết Dengue nặng') as mac_nang_cd,
-        COUNT(*) as tong_mac_cd,
-        COUNT(*) FILTER (WHERE tinh_trang_hien_nay = 'Tử vong') as chet_cd
-    FROM sxh_cases WHERE unit_id IS NOT NULL GROUP BY unit_id;
-    """
-    params = {"xa_ids": tuple(xa_ids_to_query), "start_of_year": start_of_year_dt, "start_of_period": start_of_period_dt, "end_of_period": end_of_period_dt}
-    df_results = _execute_sql_to_df(db_session, sql_query, params)
-    
-    if not df_results.empty:
-        df_results['tong_mac_p'] = df_results['mac_cb_p'] + df_results['mac_nang_p']
-        df_results = df_results.set_index('unit_id')
+    if aggregates is not None:
+        # Dùng số liệu đã tổng hợp một lượt cho cả gói báo cáo (xem report_aggregation.py)
+        df_results = sxh_unit_results(aggregates)
+    else:
+        df_results = _execute_sql_to_df(db_session, sql_query)
+        
+        if not df_results.empty:
+            df_results['tong_mac_p'] = df_results['mac_cb_p'] + df_results['mac_nang_p']
+            df_results = df_results.set_index('unit_id')
 
     comments = []
     if analysis_periods and comment_details:
-        analysis_data = _generate_sxh_analysis_data(db_session, user_don_vi, **analysis_periods)
+        analysis_data = sxh_analysis(aggregates) if aggregates is not None else _generate_sxh_analysis_data(db_session, user_don_vi, **analysis_periods)
         comments = _generate_sxh_comments(analysis_data, **comment_details)
         
-    list_cases_for_details_sheet = db_session.query(CaBenh).options(joinedload(CaBenh.don_vi)).filter(CaBenh.xa_id.in_(xa_ids_to_query), CaBenh.chan_doan_chinh.like('%Sốt xuất huyết%'), CaBenh.ngay_khoi_phat.between(start_of_period_dt, end_of_period_dt)).all()
+    df_cases_for_details_sheet = _query_case_details(db_session, SXH_DETAIL_COLUMNS, CaBenh.xa_id.in_(xa_ids_to_query), CaBenh.chan_doan_chinh.like('%Sốt xuất huyết%'), CaBenh.ngay_khoi_phat.between(start_of_period_dt, end_of_period_dt))
 
     with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
         workbook, worksheet = writer.book, writer.book.add_worksheet('BaoCaoSXH')
@@ -739,10 +754,9 @@ def _generate_sxh_report_base(db_session: Session, start_of_year_dt: date, end_o
         worksheet.merge_range(f'A{title_line_row}:C{title_line_row}', 'NGƯỜI BÁO CÁO', formats['sxh_org_header_bold'])
         worksheet.merge_range(f'A{recipient_line_row}:C{recipient_line_row}', 'Nơi nhận:', formats['sxh_noi_nhan'])
 
-        sxh_column_map = {'ho_ten': 'Họ và tên', 'ngay_sinh': 'Ngày sinh', 'don_vi.ten_don_vi': 'Xã/Phường', 'dia_chi_ap': 'Ấp/Khu vực', 'dia_chi_chi_tiet': 'Địa chỉ chi tiết', 'phan_do_benh': 'Phân độ', 'ngay_khoi_phat': 'Ngày khởi phát', 'tinh_trang_hien_nay': 'Tình trạng'}
-        _draw_details_sheet(writer, 'ChiTiet_CaBenh_SXH', list_cases_for_details_sheet, sxh_column_map, f"DANH SÁCH CA BỆNH SỐT XUẤT HUYẾT TRONG {period_name.upper()}", formats)
+        _draw_details_sheet(writer, 'ChiTiet_CaBenh_SXH', df_cases_for_details_sheet, f"DANH SÁCH CA BỆNH SỐT XUẤT HUYẾT TRONG {period_name.upper()}", formats)
 
-def generate_sxh_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str):
+def generate_sxh_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
     week_details = calendar_obj.get_week_details(week_number)
     if week_details is None: raise ValueError(f"Không tìm thấy tuần {week_number}.")
     prev_week_details = calendar_obj.get_week_details(week_number - 1)
@@ -750,9 +764,11 @@ def generate_sxh_report(db_session: Session, calendar_obj: WeekCalendar, week_nu
     year = calendar_obj.year
     analysis_periods = {"current_period": (week_details['ngay_bat_dau'].date(), week_details['ngay_ket_thuc'].date()), "prev_period": (prev_week_details['ngay_bat_dau'].date(), prev_week_details['ngay_ket_thuc'].date()) if prev_week_details is not None else None, "cumulative_this_year": (start_of_year_dt.date(), end_of_week_dt.date()), "cumulative_last_year": (date(year - 1, 1, 1), end_of_week_dt.date().replace(year=year - 1))}
     comment_details = {"period_type": "week", "period_number": week_number, "prev_period_number": week_number - 1, "year": year, "end_of_period_dt": end_of_week_dt.date()}
-    _generate_sxh_report_base(db_session, start_of_year_dt.date(), end_of_week_dt.date(), week_details['ngay_bat_dau'].date(), user_don_vi, filepath, f"Tuần {week_number} năm {year}", year, analysis_periods=analysis_periods, comment_details=comment_details)
+    if aggregates is None:
+        aggregates = _get_rollup_aggregates(db_session, user_don_vi, year, 'week', week_number)
+    _generate_sxh_report_base(db_session, start_of_year_dt.date(), end_of_week_dt.date(), week_details['ngay_bat_dau'].date(), user_don_vi, filepath, f"Tuần {week_number} năm {year}", year, analysis_periods=analysis_periods, comment_details=comment_details, aggregates=aggregates)
 
-def generate_sxh_report_monthly(db_session: Session, year: int, month: int, user_don_vi: DonViHanhChinh, filepath: str):
+def generate_sxh_report_monthly(db_session: Session, year: int, month: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
     _, num_days = calendar.monthrange(year, month)
     start_of_month, end_of_month = date(year, month, 1), date(year, month, num_days)
     start_of_year = date(year, 1, 1)
@@ -761,90 +777,71 @@ def generate_sxh_report_monthly(db_session: Session, year: int, month: int, user
     start_of_prev_month, end_of_prev_month = date(prev_year, prev_month, 1), date(prev_year, prev_month, prev_num_days)
     analysis_periods = {"current_period": (start_of_month, end_of_month), "prev_period": (start_of_prev_month, end_of_prev_month), "cumulative_this_year": (start_of_year, end_of_month), "cumulative_last_year": (date(year - 1, 1, 1), end_of_month.replace(year=year - 1))}
     comment_details = {"period_type": "month", "period_number": month, "prev_period_number": prev_month, "year": year, "end_of_period_dt": end_of_month}
-    _generate_sxh_report_base(db_session, start_of_year, end_of_month, start_of_month, user_don_vi, filepath, f"Tháng {month} năm {year}", year, analysis_periods=analysis_periods, comment_details=comment_details)
+    if aggregates is None:
+        aggregates = _get_rollup_aggregates(db_session, user_don_vi, year, 'month', month)
+    _generate_sxh_report_base(db_session, start_of_year, end_of_month, start_of_month, user_don_vi, filepath, f"Tháng {month} năm {year}", year, analysis_periods=analysis_periods, comment_details=comment_details, aggregates=aggregates)
 
 # ==============================================================================
 # 5. BÁO CÁO Ổ DỊCH
 # ==============================================================================
-def _generate_odich_sxh_analysis_data(db_session: Session, user_don_vi: DonViHanhChinh, calendar_obj: WeekCalendar, week_number: int):
-    analysis = {}
-    week_details = calendar_obj.get_week_details(week_number)
-    if week_details is None: raise ValueError(f"Không tìm thấy dữ liệu cho tuần {week_number}")
-    prev_week_details = calendar_obj.get_week_details(week_number - 1)
-    start_of_this_week, end_of_this_week = week_details['ngay_bat_dau'].date(), week_details['ngay_ket_thuc'].date()
-    start_of_prev_week, end_of_prev_week = (prev_week_details['ngay_bat_dau'].date(), prev_week_details['ngay_ket_thuc'].date()) if prev_week_details is not None else (None, None)
+# Tên kỳ dùng trong tiêu đề cột và phần nhận xét của báo cáo ổ dịch
+ODICH_PERIOD_LABELS = {'week': 'tuần', 'month': 'tháng', 'custom': 'kỳ'}
+
+def _get_odich_aggregates(db_session: Session, user_don_vi: DonViHanhChinh, periods: dict, loai_benh: str):
+    """Danh sách ổ dịch cho báo cáo tạo riêng lẻ (cùng cấu trúc với `build_report_aggregates`); None nếu đơn vị không có xã."""
     xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
     if not xa_ids_to_query: return None
-    base_query = db_session.query(O_Dich).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'SXH')
-    odich_this_week = base_query.filter(O_Dich.ngay_phat_hien.between(start_of_this_week, end_of_this_week)).all()
-    analysis['new_this_week'] = len(odich_this_week)
-    analysis['processed_this_week'] = sum(1 for od in odich_this_week if od.ngay_xu_ly is not None)
-    analysis['pending_this_week'] = analysis['new_this_week'] - analysis['processed_this_week']
-    analysis['new_last_week'] = base_query.filter(O_Dich.ngay_phat_hien.between(start_of_prev_week, end_of_prev_week)).count() if start_of_prev_week else 0
-    odich_cumulative = base_query.filter(O_Dich.ngay_phat_hien <= end_of_this_week).all()
-    analysis['cumulative_total'] = len(odich_cumulative)
-    analysis['cumulative_processed'] = sum(1 for od in odich_cumulative if od.ngay_xu_ly is not None)
-    top_locations = db_session.query(DonViHanhChinh.ten_don_vi, func.count(O_Dich.id).label('so_od')).join(O_Dich, O_Dich.xa_id == DonViHanhChinh.id).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'SXH', O_Dich.ngay_phat_hien.between(start_of_this_week, end_of_this_week)).group_by(DonViHanhChinh.ten_don_vi).order_by(func.count(O_Dich.id).desc()).all()
-    if top_locations: analysis['top_locations'] = {"locations": [loc.ten_don_vi for loc in top_locations if loc.so_od == top_locations[0].so_od], "count": top_locations[0].so_od}
-    else: analysis['top_locations'] = None
-    return analysis
-
-def _generate_odich_sxh_comments(analysis: dict, user_don_vi: DonViHanhChinh):
+    return {'periods': periods, 'o_dich': load_outbreaks(db_session, xa_ids_to_query, periods['end'], (loai_benh,))}
+
+def _get_odich_unit_table(db_session: Session, user_don_vi: DonViHanhChinh, aggregates: dict, loai_benh: str, by_site: bool = False) -> pd.DataFrame:
+    """Số ổ dịch của từng đơn vị báo cáo (theo thứ tự tên), đơn vị không có ổ dịch được điền 0."""
+    reporting_units, group_by_col = _get_reporting_units(db_session, user_don_vi)
+    if not reporting_units or not group_by_col: reporting_units, group_by_col = [user_don_vi], 'xa_id'
+    unit_keys = [unit.id if group_by_col == 'xa_id' else unit.ten_don_vi for unit in reporting_units]
+    table = odich_unit_counts(aggregates, loai_benh, group_by_col, by_site=by_site).reindex(unit_keys)
+    count_cols = table.columns.drop('dia_diem')
+    table[count_cols] = table[count_cols].fillna(0).astype('int64')
+    table['dia_diem'] = table['dia_diem'].fillna('')
+    table.insert(0, 'ten_don_vi', [unit.ten_don_vi for unit in reporting_units])
+    return table.reset_index(drop=True)
+
+def _generate_odich_sxh_comments(analysis: dict, user_don_vi: DonViHanhChinh, period_label: str = 'tuần'):
     if not analysis: return ["- Không có dữ liệu để tạo nhận xét."]
     comments = []
     process_rate = (analysis['processed_this_week'] / analysis['new_this_week'] * 100) if analysis['new_this_week'] > 0 else 100
-    comments.append(f"- Trong tuần, phát hiện mới {analysis['new_this_week']} ổ dịch SXH, đã xử lý {analysis['processed_this_week']} ổ dịch, đạt tỷ lệ {process_rate:.0f}%. Hiện còn tồn {analysis['pending_this_week']} ổ dịch chưa xử lý.")
+    comments.append(f"- Trong {period_label}, phát hiện mới {analysis['new_this_week']} ổ dịch SXH, đã xử lý {analysis['processed_this_week']} ổ dịch, đạt tỷ lệ {process_rate:.0f}%. Hiện còn tồn {analysis['pending_this_week']} ổ dịch chưa xử lý.")
     diff_vs_last_week = analysis['new_this_week'] - analysis['new_last_week']
     comparison_text, trend_text = "không đổi", "ổn định"
     if diff_vs_last_week > 0: comparison_text, trend_text = f"tăng {diff_vs_last_week} ổ", "đang có nguy cơ bùng phát dịch"
     elif diff_vs_last_week < 0: comparison_text, trend_text = f"giảm {abs(diff_vs_last_week)} ổ", "đang được kiểm soát"
-    comments.append(f"- Số ổ dịch phát hiện mới ({analysis['new_this_week']} ổ) {comparison_text} so với tuần trước ({analysis['new_last_week']} ổ), cho thấy tình hình dịch {trend_text}.")
+    comments.append(f"- Số ổ dịch phát hiện mới ({analysis['new_this_week']} ổ) {comparison_text} so với {period_label} trước ({analysis['new_last_week']} ổ), cho thấy tình hình dịch {trend_text}.")
     cumulative_rate = (analysis['cumulative_processed'] / analysis['cumulative_total'] * 100) if analysis['cumulative_total'] > 0 else 100
     comments.append(f"- Tính từ đầu năm, đã ghi nhận tổng cộng {analysis['cumulative_total']} ổ dịch, trong đó đã xử lý {analysis['cumulative_processed']} ổ, đạt tỷ lệ chung là {cumulative_rate:.0f}%.")
-    if analysis.get('top_locations') and analysis['top_locations']['count'] > 0: comments.append(f"- {', '.join(analysis['top_locations']['locations'])} là địa phương có số ổ dịch phát sinh cao nhất trong tuần với {analysis['top_locations']['count']} ổ dịch mới.")
+    if analysis.get('top_locations') and analysis['top_locations']['count'] > 0: comments.append(f"- {', '.join(analysis['top_locations']['locations'])} là địa phương có số ổ dịch phát sinh cao nhất trong {period_label} với {analysis['top_locations']['count']} ổ dịch mới.")
     if analysis['pending_this_week'] > 0: comments.append(f"- Đề nghị {user_don_vi.ten_don_vi} tập trung nguồn lực xử lý dứt điểm {analysis['pending_this_week']} ổ dịch còn tồn đọng và tăng cường hoạt động diệt lăng quăng tại các khu vực có nguy cơ cao.")
     return comments
 
-def generate_odich_sxh_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str):
-    week_details = calendar_obj.get_week_details(week_number)
-    if week_details is None: raise ValueError(f"Không tìm thấy tuần {week_number}.")
-    start_of_year_dt, end_of_week_dt_obj = calendar_obj.get_ytd_range(week_number)
-    end_of_week_dt, start_of_week_dt = end_of_week_dt_obj.date(), week_details['ngay_bat_dau'].date()
-    reporting_units, group_by_col = _get_reporting_units(db_session, user_don_vi)
-    if not reporting_units or not group_by_col: reporting_units, group_by_col = [user_don_vi], 'xa_id'
-
-    xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
-    if not xa_ids_to_query: return
+def _generate_odich_sxh_report_base(db_session: Session, user_don_vi: DonViHanhChinh, filepath: str, periods: dict, period_name: str, date_range_subtitle: str, aggregates: dict = None):
+    if aggregates is None:
+        aggregates = _get_odich_aggregates(db_session, user_don_vi, periods, 'SXH')
+        if aggregates is None: return
+    periods = aggregates['periods']
+    end_of_period_dt, period_label = periods['end'], ODICH_PERIOD_LABELS[periods['period_type']]
 
-    query = db_session.query(O_Dich).options(joinedload(O_Dich.don_vi)).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'SXH', O_Dich.ngay_phat_hien >= start_of_year_dt.date(), O_Dich.ngay_phat_hien <= end_of_week_dt)
-    all_outbreaks = query.all()
-    df_raw = pd.DataFrame([{'xa_id': c.xa_id, 'dia_chi_ap': c.dia_chi_ap, 'ngay_phat_hien': c.ngay_phat_hien, 'ngay_xu_ly': c.ngay_xu_ly, 'dia_diem_xu_ly': c.dia_diem_xu_ly} for c in all_outbreaks]) if all_outbreaks else pd.DataFrame(columns=['xa_id', 'dia_chi_ap', 'ngay_phat_hien', 'ngay_xu_ly', 'dia_diem_xu_ly'])
-    if not df_raw.empty:
-        df_raw['ngay_phat_hien'] = pd.to_datetime(df_raw['ngay_phat_hien'], errors='coerce')
-        df_raw['ngay_xu_ly'] = pd.to_datetime(df_raw['ngay_xu_ly'], errors='coerce')
-
-    results_list = []
-    for i, unit in enumerate(reporting_units):
-        filter_value = unit.id if group_by_col == 'xa_id' else unit.ten_don_vi
-        df_unit = df_raw[df_raw[group_by_col] == filter_value]
-        df_tuan = df_unit[df_unit['ngay_phat_hien'] >= pd.to_datetime(start_of_week_dt)]
-        dia_diem_list = df_unit.dropna(subset=['ngay_xu_ly', 'dia_diem_xu_ly'])['dia_diem_xu_ly'].tolist()
-        results_list.append({'STT': i + 1, 'Địa Phương': unit.ten_don_vi, 'Phát hiện': len(df_tuan), 'Xử lý': len(df_tuan.dropna(subset=['ngay_xu_ly'])), 'Phát hiện C.dồn': len(df_unit), 'Xử lý C.dồn': len(df_unit.dropna(subset=['ngay_xu_ly'])), 'Địa điểm xử lý': '\n'.join(dia_diem_list)})
-    
-    df_to_write = pd.DataFrame(results_list)
+    table = _get_odich_unit_table(db_session, user_don_vi, aggregates, 'SXH')
+    df_to_write = pd.DataFrame({'STT': range(1, len(table) + 1), 'Địa Phương': table['ten_don_vi'], 'Phát hiện': table['ph'], 'Xử lý': table['xl'], 'Phát hiện C.dồn': table['ph_cd'], 'Xử lý C.dồn': table['xl_cd'], 'Địa điểm xử lý': table['dia_diem']})
     if not df_to_write.empty:
         total_row = df_to_write.drop(columns=['STT', 'Địa Phương']).sum().to_dict(); total_row['Địa Phương'] = 'Tổng cộng'
         df_to_write = pd.concat([df_to_write, pd.DataFrame([total_row])], ignore_index=True)
     df_to_write = df_to_write.fillna(0)
     
-    analysis_data = _generate_odich_sxh_analysis_data(db_session, user_don_vi, calendar_obj, week_number)
-    comments = _generate_odich_sxh_comments(analysis_data, user_don_vi)
+    comments = _generate_odich_sxh_comments(odich_sxh_analysis(aggregates), user_don_vi, period_label)
     
     with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
         workbook, worksheet = writer.book, writer.book.add_worksheet('BaoCaoOD_SXH')
         formats = _create_excel_formats(workbook)
         worksheet.set_column('A:A', 5); worksheet.set_column('B:B', 25); worksheet.set_column('C:F', 12); worksheet.set_column('G:G', 40)
-        _draw_standard_header(worksheet, formats, user_don_vi, 'BÁO CÁO HOẠT ĐỘNG PHÒNG CHỐNG SỐT XUẤT HUYẾT DENGUE', f"Tuần {week_number} năm {calendar_obj.year}", f"Từ ngày {start_of_week_dt.strftime('%d/%m/%Y')} đến ngày {end_of_week_dt.strftime('%d/%m/%Y')}", 'G')
+        _draw_standard_header(worksheet, formats, user_don_vi, 'BÁO CÁO HOẠT ĐỘNG PHÒNG CHỐNG SỐT XUẤT HUYẾT DENGUE', period_name, date_range_subtitle, 'G')
         h_row = 9
         worksheet.merge_range(h_row, 0, h_row + 1, 0, 'STT', formats['sxh_header']); worksheet.merge_range(h_row, 1, h_row + 1, 1, 'Địa Phương', formats['sxh_header']); worksheet.merge_range(h_row, 2, h_row, 3, 'Số OD', formats['sxh_header']); worksheet.merge_range(h_row, 4, h_row, 5, 'Số OD cộng dồn', formats['sxh_header']); worksheet.merge_range(h_row, 6, h_row + 1, 6, 'Địa điểm xử lý', formats['sxh_header'])
         for col, label in [(2, 'Phát hiện'), (3, 'Xử lý'), (4, 'Phát hiện'), (5, 'Xử lý')]: worksheet.write(h_row + 1, col, label, formats['sxh_header'])
@@ -867,96 +864,69 @@ def generate_odich_sxh_report(db_session: Session, calendar_obj: WeekCalendar, w
         
         chuc_danh_map = {'Tỉnh': 'GIÁM ĐỐC', 'Khu vực': 'GIÁM ĐỐC', 'Xã': 'TRƯỞNG TRẠM'}
         date_line_row, title_line_row, recipient_line_row = footer_base_row + 2, footer_base_row + 3, footer_base_row + 9
-        worksheet.merge_range(f'E{date_line_row}:G{date_line_row}', f"{user_don_vi.ten_don_vi}, ngày {end_of_week_dt.day} tháng {end_of_week_dt.month} năm {end_of_week_dt.year}", formats['sxh_italic'])
+        worksheet.merge_range(f'E{date_line_row}:G{date_line_row}', f"{user_don_vi.ten_don_vi}, ngày {end_of_period_dt.day} tháng {end_of_period_dt.month} năm {end_of_period_dt.year}", formats['sxh_italic'])
         worksheet.merge_range(f'E{title_line_row}:G{title_line_row}', chuc_danh_map.get(user_don_vi.cap_don_vi, 'THỦ TRƯỞNG ĐƠN VỊ'), formats['sxh_org_header_bold'])
         worksheet.merge_range(f'A{title_line_row}:C{title_line_row}', 'NGƯỜI BÁO CÁO', formats['sxh_org_header_bold'])
         worksheet.merge_range(f'A{recipient_line_row}:C{recipient_line_row}', 'Nơi nhận:', formats['sxh_noi_nhan'])
 
-def _generate_odich_tcm_analysis_data(db_session: Session, user_don_vi: DonViHanhChinh, calendar_obj: WeekCalendar, week_number: int):
-    analysis = {}
-    week_details = calendar_obj.get_week_details(week_number)
-    if week_details is None: raise ValueError(f"Không tìm thấy dữ liệu cho tuần {week_number}")
-    prev_week_details = calendar_obj.get_week_details(week_number - 1)
-    start_of_this_week, end_of_this_week = week_details['ngay_bat_dau'].date(), week_details['ngay_ket_thuc'].date()
-    start_of_prev_week, end_of_prev_week = (prev_week_details['ngay_bat_dau'].date(), prev_week_details['ngay_ket_thuc'].date()) if prev_week_details is not None else (None, None)
-    xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
-    if not xa_ids_to_query: return None
-    base_query = db_session.query(O_Dich).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'TCM')
-    odich_this_week = base_query.filter(O_Dich.ngay_phat_hien.between(start_of_this_week, end_of_this_week)).all()
-    analysis['new_total_this_week'] = len(odich_this_week)
-    analysis['new_school_this_week'] = sum(1 for od in odich_this_week if od.noi_phat_hien_tcm == 'Trường học')
-    analysis['new_community_this_week'] = analysis['new_total_this_week'] - analysis['new_school_this_week']
-    analysis['processed_this_week'] = sum(1 for od in odich_this_week if od.ngay_xu_ly is not None)
-    if start_of_prev_week: analysis['new_school_last_week'] = base_query.filter(O_Dich.ngay_phat_hien.between(start_of_prev_week, end_of_prev_week), O_Dich.noi_phat_hien_tcm == 'Trường học').count()
-    else: analysis['new_school_last_week'] = 0
-    odich_cumulative = base_query.filter(O_Dich.ngay_phat_hien <= end_of_this_week).all()
-    analysis['cumulative_total'] = len(odich_cumulative)
-    analysis['cumulative_school'] = sum(1 for od in odich_cumulative if od.noi_phat_hien_tcm == 'Trường học')
-    analysis['cumulative_processed'] = sum(1 for od in odich_cumulative if od.ngay_xu_ly is not None)
-    top_locations = db_session.query(DonViHanhChinh.ten_don_vi, func.count(O_Dich.id).label('so_od')).join(O_Dich, O_Dich.xa_id == DonViHanhChinh.id).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'TCM', O_Dich.ngay_phat_hien.between(start_of_this_week, end_of_this_week)).group_by(DonViHanhChinh.ten_don_vi).order_by(func.count(O_Dich.id).desc()).all()
-    if top_locations: analysis['top_locations'] = {"locations": [loc.ten_don_vi for loc in top_locations if loc.so_od == top_locations[0].so_od], "count": top_locations[0].so_od}
-    else: analysis['top_locations'] = None
-    return analysis
-
-def _generate_odich_tcm_comments(analysis: dict):
+def generate_odich_sxh_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
+    periods = get_report_periods(calendar_obj.year, 'week', week_number)
+    date_range_subtitle = f"Từ ngày {periods['start'].strftime('%d/%m/%Y')} đến ngày {periods['end'].strftime('%d/%m/%Y')}"
+    _generate_odich_sxh_report_base(db_session, user_don_vi, filepath, periods, f"Tuần {week_number} năm {calendar_obj.year}", date_range_subtitle, aggregates=aggregates)
+
+def generate_odich_sxh_report_monthly(db_session: Session, year: int, month: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
+    periods = get_report_periods(year, 'month', month)
+    date_range_subtitle = f"Từ ngày {periods['start'].strftime('%d/%m/%Y')} đến ngày {periods['end'].strftime('%d/%m/%Y')}"
+    _generate_odich_sxh_report_base(db_session, user_don_vi, filepath, periods, f"Tháng {month} năm {year}", date_range_subtitle, aggregates=aggregates)
+
+def generate_odich_sxh_report_custom(db_session: Session, user_don_vi: DonViHanhChinh, start_date: date, end_date: date, filepath: str):
+    periods = get_custom_periods(start_date, end_date)
+    _generate_odich_sxh_report_base(db_session, user_don_vi, filepath, periods, f"Thời gian từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}", None)
+
+def _generate_odich_tcm_comments(analysis: dict, period_label: str = 'tuần'):
     if not analysis: return ["- Không có dữ liệu để tạo nhận xét."]
     comments = []
     process_rate = (analysis['processed_this_week'] / analysis['new_total_this_week'] * 100) if analysis['new_total_this_week'] > 0 else 100
-    comments.append(f"- Trong tuần, ghi nhận {analysis['new_total_this_week']} ổ dịch TCM mới, trong đó có {analysis['new_school_this_week']} ổ dịch tại trường học và {analysis['new_community_this_week']} ổ dịch tại cộng đồng. Đã xử lý {analysis['processed_this_week']} ổ dịch, đạt tỷ lệ {process_rate:.0f}%.")
+    comments.append(f"- Trong {period_label}, ghi nhận {analysis['new_total_this_week']} ổ dịch TCM mới, trong đó có {analysis['new_school_this_week']} ổ dịch tại trường học và {analysis['new_community_this_week']} ổ dịch tại cộng đồng. Đã xử lý {analysis['processed_this_week']} ổ dịch, đạt tỷ lệ {process_rate:.0f}%.")
     diff_school = analysis['new_school_this_week'] - analysis['new_school_last_week']
     comparison_text, recommend_text = "không đổi", "duy trì"
     if diff_school > 0: comparison_text, recommend_text = f"tăng {diff_school} ổ", "tăng cường"
     elif diff_school < 0: comparison_text, recommend_text = f"giảm {abs(diff_school)} ổ", "tiếp tục duy trì tốt"
-    comments.append(f"- Tình hình dịch trong trường học có xu hướng {comparison_text} (ghi nhận {analysis['new_school_this_week']} ổ so với {analysis['new_school_last_week']} ổ tuần trước), cho thấy cần {recommend_text} các biện pháp khử khuẩn tại các cơ sở giáo dục.")
+    comments.append(f"- Tình hình dịch trong trường học có xu hướng {comparison_text} (ghi nhận {analysis['new_school_this_week']} ổ so với {analysis['new_school_last_week']} ổ {period_label} trước), cho thấy cần {recommend_text} các biện pháp khử khuẩn tại các cơ sở giáo dục.")
     cumulative_rate = (analysis['cumulative_processed'] / analysis['cumulative_total'] * 100) if analysis['cumulative_total'] > 0 else 100
     school_percent = (analysis['cumulative_school'] / analysis['cumulative_total'] * 100) if analysis['cumulative_total'] > 0 else 0
     comments.append(f"- Lũy kế từ đầu năm, đã ghi nhận {analysis['cumulative_total']} ổ dịch TCM, trong đó {school_percent:.0f}% xảy ra tại trường học. Tỷ lệ xử lý chung đạt {cumulative_rate:.0f}%.")
-    if analysis.get('top_locations') and analysis['top_locations']['count'] > 0: comments.append(f"- {', '.join(analysis['top_locations']['locations'])} là địa phương cần chú ý nhất trong tuần, với {analysis['top_locations']['count']} ổ dịch mới.")
+    if analysis.get('top_locations') and analysis['top_locations']['count'] > 0: comments.append(f"- {', '.join(analysis['top_locations']['locations'])} là địa phương cần chú ý nhất trong {period_label}, với {analysis['top_locations']['count']} ổ dịch mới.")
     return comments
 
-def generate_odich_tcm_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str):
-    week_details = calendar_obj.get_week_details(week_number)
-    if week_details is None: raise ValueError(f"Không tìm thấy tuần {week_number}.")
-    start_of_year_dt, end_of_week_dt_obj = calendar_obj.get_ytd_range(week_number)
-    end_of_week_dt, start_of_week_dt = end_of_week_dt_obj.date(), week_details['ngay_bat_dau'].date()
-    reporting_units, group_by_col = _get_reporting_units(db_session, user_don_vi)
-    if not reporting_units or not group_by_col: reporting_units, group_by_col = [user_don_vi], 'xa_id'
-
-    xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
-    if not xa_ids_to_query: return
-
-    query = db_session.query(O_Dich).options(joinedload(O_Dich.don_vi)).filter(O_Dich.xa_id.in_(xa_ids_to_query), O_Dich.loai_benh == 'TCM', O_Dich.ngay_phat_hien >= start_of_year_dt.date(), O_Dich.ngay_phat_hien <= end_of_week_dt)
-    all_outbreaks = query.all()
-    df_raw = pd.DataFrame([{'xa_id': c.xa_id, 'dia_chi_ap': c.dia_chi_ap, 'ngay_phat_hien': c.ngay_phat_hien, 'ngay_xu_ly': c.ngay_xu_ly, 'noi_phat_hien_tcm': c.noi_phat_hien_tcm, 'dia_diem_xu_ly': c.dia_diem_xu_ly} for c in all_outbreaks]) if all_outbreaks else pd.DataFrame(columns=['xa_id', 'dia_chi_ap', 'ngay_phat_hien', 'ngay_xu_ly', 'noi_phat_hien_tcm', 'dia_diem_xu_ly'])
-    if not df_raw.empty:
-        df_raw['ngay_phat_hien'] = pd.to_datetime(df_raw['ngay_phat_hien'], errors='coerce')
-        df_raw['ngay_xu_ly'] = pd.to_datetime(df_raw['ngay_xu_ly'], errors='coerce')
-
-    results_list = []
-    for i, unit in enumerate(reporting_units):
-        filter_value = unit.id if group_by_col == 'xa_id' else unit.ten_don_vi
-        df_unit = df_raw[df_raw[group_by_col] == filter_value]
-        df_unit_th, df_unit_cd = df_unit[df_unit['noi_phat_hien_tcm'] == 'Trường học'], df_unit[df_unit['noi_phat_hien_tcm'] == 'Cộng đồng']
-        df_tuan_th, df_tuan_cd = df_unit_th[df_unit_th['ngay_phat_hien'] >= pd.to_datetime(start_of_week_dt)], df_unit_cd[df_unit_cd['ngay_phat_hien'] >= pd.to_datetime(start_of_week_dt)]
-        dia_diem_list = df_unit.dropna(subset=['ngay_xu_ly', 'dia_diem_xu_ly'])['dia_diem_xu_ly'].tolist()
-        results_list.append({'STT': i + 1, 'Địa phương': unit.ten_don_vi, 'PH Tuần TH': len(df_tuan_th), 'XL Tuần TH': len(df_tuan_th.dropna(subset=['ngay_xu_ly'])), 'PH Tuần CĐ': len(df_tuan_cd), 'XL Tuần CĐ': len(df_tuan_cd.dropna(subset=['ngay_xu_ly'])), 'PH CD TH': len(df_unit_th), 'XL CD TH': len(df_unit_th.dropna(subset=['ngay_xu_ly'])), 'PH CD CĐ': len(df_unit_cd), 'XL CD CĐ': len(df_unit_cd.dropna(subset=['ngay_xu_ly'])), 'Địa điểm xử lý': '\n'.join(dia_diem_list)})
-    
-    df_to_write = pd.DataFrame(results_list)
+def _generate_odich_tcm_report_base(db_session: Session, user_don_vi: DonViHanhChinh, filepath: str, periods: dict, period_name: str, date_range_subtitle: str, aggregates: dict = None):
+    if aggregates is None:
+        aggregates = _get_odich_aggregates(db_session, user_don_vi, periods, 'TCM')
+        if aggregates is None: return
+    periods = aggregates['periods']
+    end_of_period_dt, period_label = periods['end'], ODICH_PERIOD_LABELS[periods['period_type']]
+
+    table = _get_odich_unit_table(db_session, user_don_vi, aggregates, 'TCM', by_site=True)
+    df_to_write = pd.DataFrame({
+        'STT': range(1, len(table) + 1), 'Địa phương': table['ten_don_vi'],
+        'PH Tuần TH': table['ph_TH'], 'XL Tuần TH': table['xl_TH'], 'PH Tuần CĐ': table['ph_CĐ'], 'XL Tuần CĐ': table['xl_CĐ'],
+        'PH CD TH': table['ph_cd_TH'], 'XL CD TH': table['xl_cd_TH'], 'PH CD CĐ': table['ph_cd_CĐ'], 'XL CD CĐ': table['xl_cd_CĐ'],
+        'Địa điểm xử lý': table['dia_diem']
+    })
     if not df_to_write.empty:
         total_row = df_to_write.drop(columns=['STT', 'Địa phương']).sum().to_dict(); total_row['Địa phương'] = 'Tổng cộng'
         df_to_write = pd.concat([df_to_write, pd.DataFrame([total_row])], ignore_index=True)
     df_to_write = df_to_write.fillna(0)
     
-    analysis_data = _generate_odich_tcm_analysis_data(db_session, user_don_vi, calendar_obj, week_number)
-    comments = _generate_odich_tcm_comments(analysis_data)
+    comments = _generate_odich_tcm_comments(odich_tcm_analysis(aggregates), period_label)
     
     with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
         workbook, worksheet = writer.book, writer.book.add_worksheet('BaoCaoOD_TCM')
         formats = _create_excel_formats(workbook)
         worksheet.set_column('A:A', 5); worksheet.set_column('B:B', 25); worksheet.set_column('C:J', 9); worksheet.set_column('K:K', 35)
-        _draw_standard_header(worksheet, formats, user_don_vi, 'BÁO CÁO HOẠT ĐỘNG PHÒNG CHỐNG BỆNH TAY CHÂN MIỆNG', f"Tuần {week_number} năm {calendar_obj.year}", f"Từ ngày {start_of_week_dt.strftime('%d/%m/%Y')} đến ngày {end_of_week_dt.strftime('%d/%m/%Y')}", 'K')
+        _draw_standard_header(worksheet, formats, user_don_vi, 'BÁO CÁO HOẠT ĐỘNG PHÒNG CHỐNG BỆNH TAY CHÂN MIỆNG', period_name, date_range_subtitle, 'K')
         h1, h2, h3 = 9, 10, 11
-        worksheet.merge_range(h1, 0, h3, 0, 'STT', formats['sxh_header']); worksheet.merge_range(h1, 1, h3, 1, 'Địa phương', formats['sxh_header']); worksheet.merge_range(h1, 2, h1, 5, 'Số OD trong tuần', formats['sxh_header']); worksheet.merge_range(h1, 6, h1, 9, 'Số OD cộng dồn', formats['sxh_header']); worksheet.merge_range(h1, 10, h3, 10, 'Địa điểm xử lý', formats['sxh_header'])
+        worksheet.merge_range(h1, 0, h3, 0, 'STT', formats['sxh_header']); worksheet.merge_range(h1, 1, h3, 1, 'Địa phương', formats['sxh_header']); worksheet.merge_range(h1, 2, h1, 5, f'Số OD trong {period_label}', formats['sxh_header']); worksheet.merge_range(h1, 6, h1, 9, 'Số OD cộng dồn', formats['sxh_header']); worksheet.merge_range(h1, 10, h3, 10, 'Địa điểm xử lý', formats['sxh_header'])
         worksheet.merge_range(h2, 2, h2, 3, 'Trường học', formats['sxh_header']); worksheet.merge_range(h2, 4, h2, 5, 'Cộng đồng', formats['sxh_header']); worksheet.merge_range(h2, 6, h2, 7, 'Trường học', formats['sxh_header']); worksheet.merge_range(h2, 8, h2, 9, 'Cộng đồng', formats['sxh_header'])
         for col in [2, 4, 6, 8]: worksheet.write(h3, col, 'Phát hiện', formats['sxh_header']); worksheet.write(h3, col + 1, 'Xử lý', formats['sxh_header'])
         data_start_row = h3 + 1
@@ -976,48 +946,112 @@ def generate_odich_tcm_report(db_session: Session, calendar_obj: WeekCalendar, w
             footer_base_row = comment_start_row + len(comments)
         chuc_danh_map = {'Tỉnh': 'GIÁM ĐỐC', 'Khu vực': 'GIÁM ĐỐC', 'Xã': 'TRƯỞNG TRẠM'}
         date_line_row, title_line_row, recipient_line_row = footer_base_row + 2, footer_base_row + 3, footer_base_row + 9
-        worksheet.merge_range(f'H{date_line_row}:K{date_line_row}', f"{user_don_vi.ten_don_vi}, ngày {end_of_week_dt.day} tháng {end_of_week_dt.month} năm {end_of_week_dt.year}", formats['sxh_italic'])
+        worksheet.merge_range(f'H{date_line_row}:K{date_line_row}', f"{user_don_vi.ten_don_vi}, ngày {end_of_period_dt.day} tháng {end_of_period_dt.month} năm {end_of_period_dt.year}", formats['sxh_italic'])
         worksheet.merge_range(f'H{title_line_row}:K{title_line_row}', chuc_danh_map.get(user_don_vi.cap_don_vi, 'THỦ TRƯỞNG ĐƠN VỊ'), formats['sxh_org_header_bold'])
         worksheet.merge_range(f'A{title_line_row}:D{title_line_row}', 'NGƯỜI BÁO CÁO', formats['sxh_org_header_bold'])
         worksheet.merge_range(f'A{recipient_line_row}:D{recipient_line_row}', 'Nơi nhận:', formats['sxh_noi_nhan'])
 
+def generate_odich_tcm_report(db_session: Session, calendar_obj: WeekCalendar, week_number: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
+    periods = get_report_periods(calendar_obj.year, 'week', week_number)
+    date_range_subtitle = f"Từ ngày {periods['start'].strftime('%d/%m/%Y')} đến ngày {periods['end'].strftime('%d/%m/%Y')}"
+    _generate_odich_tcm_report_base(db_session, user_don_vi, filepath, periods, f"Tuần {week_number} năm {calendar_obj.year}", date_range_subtitle, aggregates=aggregates)
+
+def generate_odich_tcm_report_monthly(db_session: Session, year: int, month: int, user_don_vi: DonViHanhChinh, filepath: str, aggregates: dict = None):
+    periods = get_report_periods(year, 'month', month)
+    date_range_subtitle = f"Từ ngày {periods['start'].strftime('%d/%m/%Y')} đến ngày {periods['end'].strftime('%d/%m/%Y')}"
+    _generate_odich_tcm_report_base(db_session, user_don_vi, filepath, periods, f"Tháng {month} năm {year}", date_range_subtitle, aggregates=aggregates)
+
+def generate_odich_tcm_report_custom(db_session: Session, user_don_vi: DonViHanhChinh, start_date: date, end_date: date, filepath: str):
+    periods = get_custom_periods(start_date, end_date)
+    _generate_odich_tcm_report_base(db_session, user_don_vi, filepath, periods, f"Thời gian từ {start_date.strftime('%d/%m/%Y')} đến {end_date.strftime('%d/%m/%Y')}", None)
+
 # ==============================================================================
 # 6. HÀM TỔNG HỢP XUẤT TẤT CẢ BÁO CÁO
 # ==============================================================================
-def generate_all_reports_zip(db_session: Session, user_don_vi: DonViHanhChinh, year: int, period_type: str, period_number: int, zip_filepath: str):
-    temp_dir = os.path.join(os.path.dirname(zip_filepath), str(uuid.uuid4()))
-    os.makedirs(temp_dir, exist_ok=True)
+def _run_report_in_process(func, don_vi_id: int, period_arg, period_number: int, aggregates: dict = None) -> bytes:
+    """Chạy một hàm tạo báo cáo trong tiến trình con với session CSDL riêng, trả về nội dung file."""
+    from .database_utils import get_db_session
+    db_session = get_db_session()
     try:
-        calendar_obj = WeekCalendar(year) if period_type == 'week' else None
-        period_name_part = f"Tuan{period_number}" if period_type == 'week' else f"Thang{period_number}"
-        
+        user_don_vi = db_session.query(DonViHanhChinh).options(
+            joinedload(DonViHanhChinh.children).joinedload(DonViHanhChinh.children),
+            joinedload(DonViHanhChinh.parent)
+        ).get(don_vi_id)
+        output = BytesIO()
+        func(db_session, period_arg, period_number, user_don_vi, output, aggregates=aggregates)
+        return output.getvalue()
+    finally:
+        db_session.close()
+
+
+def _render_all_reports(db_session: Session, user_don_vi: DonViHanhChinh, year: int, period_type: str, period_number: int, max_workers: int = None):
+    """
+    Tạo lần lượt các báo cáo con của kỳ trong bộ nhớ, trả về (tên file, nội dung) theo thứ tự cố định.
+    Báo cáo nào không có dữ liệu (không ghi gì) sẽ bị bỏ qua.
+    Số liệu ca bệnh/ổ dịch được tổng hợp một lần (`build_report_aggregates`) rồi dùng chung cho mọi báo cáo con.
+    Nếu `max_workers` (mặc định REPORT_ZIP_WORKERS) > 1, các báo cáo con được tạo song song
+    trong các tiến trình riêng, mỗi tiến trình dùng một session CSDL riêng.
+    """
+    max_workers = REPORT_ZIP_WORKERS if max_workers is None else max_workers
+    period_arg = WeekCalendar(year) if period_type == 'week' else year
+    period_name_part = f"Tuan{period_number}" if period_type == 'week' else f"Thang{period_number}"
+    
+    if period_type == 'week':
         report_jobs = [
-            {'func': generate_benh_truyen_nhiem_report if period_type == 'week' else generate_benh_truyen_nhiem_report_monthly, 'args': (db_session, calendar_obj if period_type == 'week' else year, period_number, user_don_vi), 'filename': f"BaoCao_BTN_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"},
-            {'func': generate_sxh_report if period_type == 'week' else generate_sxh_report_monthly, 'args': (db_session, calendar_obj if period_type == 'week' else year, period_number, user_don_vi), 'filename': f"BaoCao_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"}
+            (generate_benh_truyen_nhiem_report, f"BaoCao_BTN_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_sxh_report, f"BaoCao_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_odich_sxh_report, f"BaoCao_ODich_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_odich_tcm_report, f"BaoCao_ODich_TCM_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
         ]
-        if period_type == 'week':
-            report_jobs.extend([
-                {'func': generate_odich_sxh_report, 'args': (db_session, calendar_obj, period_number, user_don_vi), 'filename': f"BaoCao_ODich_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"},
-                {'func': generate_odich_tcm_report, 'args': (db_session, calendar_obj, period_number, user_don_vi), 'filename': f"BaoCao_ODich_TCM_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"}
-            ])
-        
-        for job in report_jobs:
+    else:
+        report_jobs = [
+            (generate_benh_truyen_nhiem_report_monthly, f"BaoCao_BTN_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_sxh_report_monthly, f"BaoCao_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_odich_sxh_report_monthly, f"BaoCao_ODich_SXH_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+            (generate_odich_tcm_report_monthly, f"BaoCao_ODich_TCM_{user_don_vi.ten_don_vi}_{year}_{period_name_part}.xlsx"),
+        ]
+    
+    aggregates = build_report_aggregates(db_session, user_don_vi, year, period_type, period_number)
+    workers = min(max_workers, len(report_jobs))
+    if workers > 1:
+        # 'spawn': tiến trình con không kế thừa các luồng, khóa và kết nối CSDL của ứng dụng web (như data_importer)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [
+                (executor.submit(_run_report_in_process, func, user_don_vi.id, period_arg, period_number, aggregates), filename)
+                for func, filename in report_jobs
+            ]
+            for future, filename in futures:
+                try:
+                    content = future.result()
+                except Exception as e:
+                    print(f"Lỗi khi tạo file '{filename}': {e}")
+                    raise e # Ném lại lỗi để dễ debug
+                if content:
+                    yield filename, content
+    else:
+        for func, filename in report_jobs:
+            output = BytesIO()
             try:
-                output_path = os.path.join(temp_dir, job['filename'])
-                args_list = list(job['args'])
-                if period_type == 'month' and isinstance(args_list[1], WeekCalendar):
-                    args_list[1] = year
-                job['func'](*args_list, output_path)
+                func(db_session, period_arg, period_number, user_don_vi, output, aggregates=aggregates)
             except Exception as e:
-                print(f"Lỗi khi tạo file '{job['filename']}': {e}")
+                print(f"Lỗi khi tạo file '{filename}': {e}")
                 raise e # Ném lại lỗi để dễ debug
-        
+            if output.getbuffer().nbytes:
+                yield filename, output.getvalue()
+
+
+def generate_all_reports_zip(db_session: Session, user_don_vi: DonViHanhChinh, year: int, period_type: str, period_number: int, zip_filepath: str, max_workers: int = None):
+    """Tạo tất cả báo cáo của kỳ và nén thẳng từ bộ nhớ vào file zip (không qua thư mục tạm)."""
+    try:
         with zipfile.ZipFile(zip_filepath, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    zipf.write(os.path.join(root, file), arcname=file)
-    finally:
-        if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
+            for filename, content in _render_all_reports(db_session, user_don_vi, year, period_type, period_number, max_workers):
+                zipf.writestr(filename, content)
+    except Exception:
+        # Không để lại file zip dở dang khi một báo cáo con bị lỗi
+        if os.path.exists(zip_filepath): os.remove(zip_filepath)
+        raise
+
 
 # ==============================================================================
 # 7. BÁO CÁO TÙY CHỈNH
@@ -1049,27 +1083,24 @@ def generate_custom_btn_report(db_session: Session, user_don_vi: DonViHanhChinh,
         raise ValueError("Các đơn vị được chọn không có đơn vị cấp Xã nào.")
 
     # --- PHẦN 2: TRUY VẤN VÀ XỬ LÝ DỮ LIỆU ---
-    sql_query = """
-    SELECT
-        dvh_xa.parent_id as unit_id,
-        cb.chan_doan_chinh,
-        COUNT(cb.id) as so_mac,
-        COUNT(cb.id) FILTER (WHERE cb.tinh_trang_hien_nay = 'Tử vong') as so_chet
-    FROM ca_benh cb
-    JOIN don_vi_hanh_chinh dvh_xa ON cb.xa_id = dvh_xa.id
-    WHERE
-        cb.xa_id IN :xa_ids
-        AND cb.ngay_khoi_phat BETWEEN :start_date AND :end_date
-        AND cb.chan_doan_chinh IS NOT NULL AND cb.chan_doan_chinh != ''
-    GROUP BY
-        dvh_xa.parent_id, cb.chan_doan_chinh;
-    """
-    params = {
-        "xa_ids": tuple(all_xa_ids_to_query),
-        "start_date": start_date,
-        "end_date": end_date,
-    }
-    df_long = _execute_sql_to_df(db_session, sql_query, params)
+    if use_case_rollup(db_session):
+        # Đọc từ bảng tổng hợp theo ngày thay vì quét toàn bộ ca bệnh trong khoảng thời gian
+        src = TongHopCaBenh
+        so_mac, so_chet = func.sum(src.so_ca), func.coalesce(func.sum(src.so_ca).filter(src.is_death), 0)
+    else:
+        src = CaBenh
+        so_mac, so_chet = func.count(src.id), func.count(src.id).filter(src.tinh_trang_hien_nay == 'Tử vong')
+    sql_query = (
+        select(DonViHanhChinh.parent_id.label('unit_id'), src.chan_doan_chinh, so_mac.label('so_mac'), so_chet.label('so_chet'))
+        .join(DonViHanhChinh, src.xa_id == DonViHanhChinh.id)
+        .where(
+            src.xa_id.in_(list(all_xa_ids_to_query)),
+            src.ngay_khoi_phat.between(start_date, end_date),
+            src.chan_doan_chinh.isnot(None), src.chan_doan_chinh != ''
+        )
+        .group_by(DonViHanhChinh.parent_id, src.chan_doan_chinh)
+    )
+    df_long = _execute_sql_to_df(db_session, sql_query)
     
     df_results = pd.DataFrame()
     dynamic_disease_list = []
@@ -1100,10 +1131,12 @@ def generate_custom_btn_report(db_session: Session, user_don_vi: DonViHanhChinh,
         df_results = df_results.reset_index()
 
     # --- PHẦN 3: LẤY DỮ LIỆU CHO TRANG CHI TIẾT ---
-    list_cases_for_details_sheet = db_session.query(CaBenh).options(joinedload(CaBenh.don_vi)).filter(
+    df_cases_for_details_sheet = _query_case_details(
+        db_session, CUSTOM_BTN_DETAIL_COLUMNS,
         CaBenh.xa_id.in_(list(all_xa_ids_to_query)),
-        CaBenh.ngay_khoi_phat.between(start_date, end_date)
-    ).order_by(CaBenh.ngay_khoi_phat).all()
+        CaBenh.ngay_khoi_phat.between(start_date, end_date),
+        order_by=[CaBenh.ngay_khoi_phat, CaBenh.id]
+    )
 
     # --- PHẦN 4: KẾT XUẤT RA EXCEL ---
     _generate_custom_btn_report_core(
@@ -1114,34 +1147,66 @@ def generate_custom_btn_report(db_session: Session, user_don_vi: DonViHanhChinh,
         reporting_units=selected_units,
         df_results=df_results,
         dynamic_disease_list=dynamic_disease_list,
-        list_cases_for_details_sheet=list_cases_for_details_sheet
+        df_cases_for_details_sheet=df_cases_for_details_sheet
     )
 
 # ==============================================================================
 # 8. HÀM XUẤT DANH SÁCH CA BỆNH RA EXCEL
 # ==============================================================================
-from io import BytesIO
-
-def generate_cases_export(cases: list[CaBenh]) -> BytesIO:
-    data_to_export = []
-    for case in cases:
-        data_to_export.append({
-            'ID': case.id, 'Mã BN': case.ma_so_benh_nhan, 'Họ và tên': case.ho_ten,
-            'Ngày sinh': case.ngay_sinh.strftime('%d/%m/%Y') if case.ngay_sinh else '', 'Giới tính': case.gioi_tinh,
-            'Xã/Phường': case.don_vi.ten_don_vi if case.don_vi else '', 'Ấp/Khu phố': case.dia_chi_ap,
-            'Địa chỉ chi tiết': case.dia_chi_chi_tiet,
-            'Ngày khởi phát': case.ngay_khoi_phat.strftime('%d/%m/%Y') if case.ngay_khoi_phat else '',
-            'Chẩn đoán chính': case.chan_doan_chinh, 'Phân độ bệnh': case.phan_do_benh,
-            'Tình trạng hiện nay': case.tinh_trang_hien_nay, 'ID Ổ dịch': case.o_dich_id if case.o_dich_id else ''
-        })
-    df = pd.DataFrame(data_to_export)
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, sheet_name='DanhSachCaBenh', index=False)
-        worksheet = writer.sheets['DanhSachCaBenh']
-        for idx, col in enumerate(df.columns):
-            series = df[col]
-            max_len = max((series.astype(str).map(len).max(), len(str(series.name)))) + 2
-            worksheet.set_column(idx, idx, max_len)
-    output.seek(0)
-    return output
+CASE_EXPORT_HEADERS = [
+    'ID', 'Mã BN', 'Họ và tên', 'Ngày sinh', 'Giới tính', 'Xã/Phường', 'Ấp/Khu phố', 'Địa chỉ chi tiết',
+    'Ngày khởi phát', 'Chẩn đoán chính', 'Phân độ bệnh', 'Tình trạng hiện nay', 'ID Ổ dịch'
+]
+
+# Số dòng gom lại thành một đoạn khi trả file CSV/NDJSON theo luồng
+CASE_EXPORT_CHUNK_ROWS = 500
+
+def _case_export_row(case) -> tuple:
+    """Một dòng của file xuất từ dòng truy vấn CASE_EXPORT_COLUMNS (admin_utils.iter_cases_for_export)."""
+    return (
+        case.id, case.ma_so_benh_nhan, case.ho_ten,
+        case.ngay_sinh.strftime('%d/%m/%Y') if case.ngay_sinh else '', case.gioi_tinh,
+        case.ten_xa or '', case.dia_chi_ap,
+        case.dia_chi_chi_tiet,
+        case.ngay_khoi_phat.strftime('%d/%m/%Y') if case.ngay_khoi_phat else '',
+        case.chan_doan_chinh, case.phan_do_benh,
+        case.tinh_trang_hien_nay, case.o_dich_id if case.o_dich_id else ''
+    )
+
+def _batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+def generate_cases_export(cases, filepath: str):
+    """
+    Xuất danh sách ca bệnh ra Excel ở chế độ constant_memory: từng dòng được ghi thẳng ra đĩa,
+    nên bộ nhớ không tăng theo số ca. `cases` là iterator các dòng (vd. admin_utils.iter_cases_for_export);
+    độ rộng cột ước lượng từ EXCEL_WIDTH_SAMPLE_ROWS dòng đầu.
+    """
+    rows = (_case_export_row(case) for case in cases)
+    sample = list(itertools.islice(rows, EXCEL_WIDTH_SAMPLE_ROWS))
+    with pd.ExcelWriter(filepath, engine='xlsxwriter', engine_kwargs={'options': {'constant_memory': True}}) as writer:
+        workbook = writer.book
+        worksheet = workbook.add_worksheet('DanhSachCaBenh')
+        for idx, width in enumerate(_estimate_column_widths(CASE_EXPORT_HEADERS, sample)):
+            worksheet.set_column(idx, idx, width)
+        _write_rows_streaming(workbook, worksheet, CASE_EXPORT_HEADERS, itertools.chain(sample, rows), start_row=0)
+
+def stream_cases_export_csv(cases):
+    """Generator trả về từng đoạn bytes của file CSV (UTF-8 có BOM để Excel đọc đúng tiếng Việt)."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(CASE_EXPORT_HEADERS)
+    for batch in _batched(cases, CASE_EXPORT_CHUNK_ROWS):
+        writer.writerows(_case_export_row(case) for case in batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def stream_cases_export_ndjson(cases):
+    """Generator trả về từng đoạn bytes NDJSON: mỗi ca bệnh một đối tượng JSON (ngày theo ISO 8601) trên một dòng."""
+    for batch in _batched(cases, CASE_EXPORT_CHUNK_ROWS):
+        yield ''.join(json.dumps(dict(case._mapping), ensure_ascii=False, default=date.isoformat) + '\n' for case in batch).encode('utf-8')
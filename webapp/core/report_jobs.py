@@ -0,0 +1,136 @@
+# file: webapp/core/report_jobs.py
+
+import os
+from sqlalchemy.orm import Session, joinedload
+
+from .database_setup import DonViHanhChinh
+from .database_utils import get_db_session
+from .jobs import JobManager
+from .report_cache import REPORT_CACHE_ENABLED, get_report_cache_key, get_cached_report, get_or_render_report
+from .report_store import register_report_file
+from .utils import get_all_child_xa_ids
+from .week_calendar import WeekCalendar
+from .report_generator import (
+    generate_benh_truyen_nhiem_report, generate_sxh_report,
+    generate_odich_sxh_report, generate_odich_tcm_report,
+    generate_benh_truyen_nhiem_report_monthly, generate_sxh_report_monthly,
+    generate_odich_sxh_report_monthly, generate_odich_tcm_report_monthly, generate_all_reports_zip
+)
+
+# Số báo cáo được tạo đồng thời tối đa (mỗi luồng giữ 1 kết nối CSDL trong lúc tạo)
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+
+report_job_manager = JobManager(max_workers=REPORT_WORKERS, name='report')
+
+# ==============================================================================
+# DANH MỤC MẪU BÁO CÁO ĐỊNH KỲ
+# ==============================================================================
+# period: 'week' hoặc 'month'; name: tiền tố tên file tải về; ext: phần mở rộng
+REPORT_TEMPLATES = {
+    "Báo cáo Bệnh truyền nhiễm tổng hợp": {"period": "week", "name": "BaoCao_BTN", "ext": ".xlsx"},
+    "Báo cáo Sốt Xuất Huyết": {"period": "week", "name": "BaoCao_SXH", "ext": ".xlsx"},
+    "Báo cáo Ổ dịch SXH": {"period": "week", "name": "BaoCao_ODich_SXH", "ext": ".xlsx"},
+    "Báo cáo Ổ dịch TCM": {"period": "week", "name": "BaoCao_ODich_TCM", "ext": ".xlsx"},
+    "Báo cáo BTN theo tháng": {"period": "month", "name": "BaoCao_BTN_Thang", "ext": ".xlsx"},
+    "Báo cáo SXH theo tháng": {"period": "month", "name": "BaoCao_SXH_Thang", "ext": ".xlsx"},
+    "Báo cáo Ổ dịch SXH theo tháng": {"period": "month", "name": "BaoCao_ODich_SXH_Thang", "ext": ".xlsx"},
+    "Báo cáo Ổ dịch TCM theo tháng": {"period": "month", "name": "BaoCao_ODich_TCM_Thang", "ext": ".xlsx"},
+    "Tất cả báo cáo (Tuần)": {"period": "week", "name": "TatCaBaoCao", "ext": ".zip"},
+    "Tất cả báo cáo (Tháng)": {"period": "month", "name": "TatCaBaoCao", "ext": ".zip"},
+}
+
+
+def get_report_display_name(report_template: str, unit_name: str, year: int, week_number: int, month_number: int) -> str:
+    """Tên file hiển thị khi người dùng tải báo cáo về."""
+    template = REPORT_TEMPLATES[report_template]
+    period_part = f"Tuan{week_number}" if template["period"] == 'week' else f"Thang{month_number}"
+    return f"{template['name']}_{unit_name}_{year}_{period_part}{template['ext']}"
+
+
+def render_report(db_session: Session, report_template: str, user_don_vi: DonViHanhChinh,
+                  year: int, week_number: int, month_number: int, filepath: str):
+    """Gọi hàm tạo báo cáo tương ứng với mẫu đã chọn và ghi kết quả vào `filepath`."""
+    handlers = {
+        "Báo cáo Bệnh truyền nhiễm tổng hợp": lambda: generate_benh_truyen_nhiem_report(db_session, WeekCalendar(year), week_number, user_don_vi, filepath),
+        "Báo cáo Sốt Xuất Huyết": lambda: generate_sxh_report(db_session, WeekCalendar(year), week_number, user_don_vi, filepath),
+        "Báo cáo Ổ dịch SXH": lambda: generate_odich_sxh_report(db_session, WeekCalendar(year), week_number, user_don_vi, filepath),
+        "Báo cáo Ổ dịch TCM": lambda: generate_odich_tcm_report(db_session, WeekCalendar(year), week_number, user_don_vi, filepath),
+        "Báo cáo BTN theo tháng": lambda: generate_benh_truyen_nhiem_report_monthly(db_session, year, month_number, user_don_vi, filepath),
+        "Báo cáo SXH theo tháng": lambda: generate_sxh_report_monthly(db_session, year, month_number, user_don_vi, filepath),
+        "Báo cáo Ổ dịch SXH theo tháng": lambda: generate_odich_sxh_report_monthly(db_session, year, month_number, user_don_vi, filepath),
+        "Báo cáo Ổ dịch TCM theo tháng": lambda: generate_odich_tcm_report_monthly(db_session, year, month_number, user_don_vi, filepath),
+        "Tất cả báo cáo (Tuần)": lambda: generate_all_reports_zip(db_session, user_don_vi, year, 'week', week_number, filepath),
+        "Tất cả báo cáo (Tháng)": lambda: generate_all_reports_zip(db_session, user_don_vi, year, 'month', month_number, filepath),
+    }
+    handler = handlers.get(report_template)
+    if handler is None:
+        raise ValueError(f"Mẫu báo cáo '{report_template}' không hợp lệ.")
+    handler()
+
+
+def get_report_scope(report_template: str, don_vi_id: int, year: int, week_number: int, month_number: int) -> dict:
+    """Các tham số xác định nội dung một báo cáo định kỳ (dùng làm khóa bộ nhớ đệm)."""
+    template = REPORT_TEMPLATES[report_template]
+    period_number = week_number if template["period"] == 'week' else month_number
+    return {'report_template': report_template, 'don_vi_id': don_vi_id, 'year': year, 'period': template["period"], 'period_number': period_number}
+
+
+def load_report_unit(db_session: Session, don_vi_id: int):
+    """Tải đơn vị kèm các đơn vị con/cha cần cho việc tạo báo cáo trong session riêng của worker."""
+    return db_session.query(DonViHanhChinh).options(
+        joinedload(DonViHanhChinh.children).joinedload(DonViHanhChinh.children),
+        joinedload(DonViHanhChinh.parent)
+    ).get(don_vi_id)
+
+
+def _run_report_job(report_template: str, don_vi_id: int, year: int, week_number: int, month_number: int,
+                    report_folder: str, display_name: str, owner_id=None):
+    """
+    Thân công việc nền: mở session riêng, tạo báo cáo vào REPORT_FOLDER và trả về thông tin file.
+    Khi bật bộ nhớ đệm, file được đặt tên theo khóa (phạm vi + phiên bản dữ liệu) và dùng lại nếu đã có.
+    """
+    ext = REPORT_TEMPLATES[report_template]['ext']
+    db_session = get_db_session()
+    try:
+        user_don_vi = load_report_unit(db_session, don_vi_id)
+        if not user_don_vi:
+            raise ValueError("Không tìm thấy đơn vị để tạo báo cáo.")
+        filename = get_or_render_report(
+            db_session, report_folder, get_all_child_xa_ids(user_don_vi), ext,
+            lambda filepath: render_report(db_session, report_template, user_don_vi, year, week_number, month_number, filepath),
+            **get_report_scope(report_template, don_vi_id, year, week_number, month_number)
+        )
+        if not filename:
+            raise ValueError("Không có dữ liệu hoặc đơn vị báo cáo phù hợp để tạo báo cáo.")
+        register_report_file(report_folder, filename, owner_id=owner_id, report_template=report_template, shared=REPORT_CACHE_ENABLED)
+        return {'filename': filename, 'display_name': display_name}
+    finally:
+        db_session.close()
+
+
+def submit_report_job(report_template: str, user_don_vi: DonViHanhChinh, year: int, week_number: int,
+                      month_number: int, report_folder: str, owner_id=None, db_session: Session = None) -> str:
+    """
+    Đưa yêu cầu tạo báo cáo vào hàng đợi và trả về job_id.
+    Nếu có `db_session` và báo cáo cùng phạm vi, cùng phiên bản dữ liệu đã được tạo trước đó,
+    công việc được đánh dấu hoàn thành ngay mà không cần xếp hàng.
+    """
+    if report_template not in REPORT_TEMPLATES:
+        raise ValueError("Không thể tạo báo cáo, vui lòng chọn mẫu báo cáo.")
+    display_name = get_report_display_name(report_template, user_don_vi.ten_don_vi, year, week_number, month_number)
+    meta = {'report_template': report_template, 'display_name': display_name}
+
+    if REPORT_CACHE_ENABLED and db_session is not None:
+        scope = get_report_scope(report_template, user_don_vi.id, year, week_number, month_number)
+        cache_key = get_report_cache_key(db_session, get_all_child_xa_ids(user_don_vi), **scope)
+        cached_filename = get_cached_report(report_folder, cache_key, REPORT_TEMPLATES[report_template]['ext'])
+        if cached_filename:
+            meta['cached'] = True
+            register_report_file(report_folder, cached_filename, report_template=report_template, shared=True)
+            return report_job_manager.add_done({'filename': cached_filename, 'display_name': display_name}, owner_id=owner_id, meta=meta)
+
+    return report_job_manager.submit(
+        _run_report_job, report_template, user_don_vi.id, year, week_number, month_number,
+        report_folder, display_name, owner_id,
+        owner_id=owner_id, meta=meta
+    )
@@ -0,0 +1,211 @@
+# file: webapp/core/report_prerender.py
+
+import os
+import threading
+import time
+import traceback
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+from datetime import date, datetime, timedelta
+from sqlalchemy.orm import Session, joinedload
+
+from .database_setup import DonViHanhChinh, NguoiDung
+from .database_utils import get_db_session
+from .data_version import get_data_version
+from .jobs import JobManager
+from .report_cache import REPORT_CACHE_ENABLED, make_report_cache_key, get_report_cache_key, get_cached_report, render_to_cache
+from .report_jobs import REPORT_TEMPLATES, get_report_scope, load_report_unit, render_report
+from .report_store import register_report_file
+from .utils import get_all_child_xa_ids
+from .week_calendar import WeekCalendar
+
+# ==============================================================================
+# TẠO TRƯỚC BÁO CÁO ĐỊNH KỲ
+# ==============================================================================
+# Sau khi một tuần/tháng kết thúc, luồng nền tạo sẵn các báo cáo chuẩn của kỳ đó cho mọi đơn vị có
+# người dùng, ghi vào bộ nhớ đệm báo cáo (tên file theo phạm vi + phiên bản dữ liệu). Khi người dùng
+# bấm tạo báo cáo, submit_report_job tìm thấy file trong bộ nhớ đệm và trả về ngay.
+# Dữ liệu nhập muộn làm tăng phiên bản dữ liệu của các xã liên quan -> file cũ không còn khớp khóa,
+# lượt kiểm tra kế tiếp thấy thiếu file và xếp hàng tạo lại báo cáo của các đơn vị đó.
+# Với triển khai nhiều tiến trình (gunicorn), mỗi tiến trình đều chạy luồng kiểm tra nhưng chỉ tiến trình giữ
+# được khóa file (PRERENDER_LOCK_FILENAME, cạnh thư mục báo cáo) mới xếp hàng tạo báo cáo; khi tiến trình đó
+# dừng, hệ điều hành nhả khóa và một tiến trình khác nhận việc ở lượt kiểm tra kế tiếp.
+REPORT_PRERENDER_ENABLED = os.getenv("REPORT_PRERENDER_ENABLED", "1") == "1"
+# Chờ sau khi kỳ kết thúc để dữ liệu cuối kỳ kịp được nhập
+REPORT_PRERENDER_DELAY_HOURS = float(os.getenv("REPORT_PRERENDER_DELAY_HOURS", "2"))
+REPORT_PRERENDER_CHECK_SECONDS = int(os.getenv("REPORT_PRERENDER_CHECK_SECONDS", "900"))
+# Tạo lần lượt từng báo cáo, nghỉ giữa hai báo cáo để không chiếm CSDL của người dùng
+REPORT_PRERENDER_WORKERS = int(os.getenv("REPORT_PRERENDER_WORKERS", "1"))
+REPORT_PRERENDER_PAUSE_SECONDS = float(os.getenv("REPORT_PRERENDER_PAUSE_SECONDS", "1"))
+
+# Các mẫu báo cáo đơn lẻ (file zip được ghép lại từ chính các báo cáo này nên không tạo trước)
+PRERENDER_TEMPLATES = [name for name, template in REPORT_TEMPLATES.items() if template['ext'] == '.xlsx']
+
+prerender_job_manager = JobManager(max_workers=REPORT_PRERENDER_WORKERS, name='prerender')
+
+_pending = set()
+_pending_lock = threading.Lock()
+_wake_event = threading.Event()
+_scheduler_lock = threading.Lock()
+_scheduler_started = False
+PRERENDER_LOCK_FILENAME = 'report_prerender.lock'
+# Khóa bộ nhớ đệm của các báo cáo không có dữ liệu: không tạo lại cho đến khi phiên bản dữ liệu (và khóa) thay đổi
+_empty_keys = set()
+
+
+def latest_closed_periods(now: datetime):
+    """
+    Tuần và tháng gần nhất đã kết thúc trước `now` ít nhất REPORT_PRERENDER_DELAY_HOURS.
+    Trả về ((năm, tuần), (năm, tháng)); tuần được đánh số theo WeekCalendar như trang tạo báo cáo.
+    """
+    cutoff = now - timedelta(hours=REPORT_PRERENDER_DELAY_HOURS)
+    closed_week = None
+    for year in (cutoff.year, cutoff.year - 1):
+        weeks = WeekCalendar(year).week_df
+        closed = weeks[weeks['ngay_ket_thuc'] + timedelta(days=1) <= cutoff]
+        if not closed.empty:
+            closed_week = (year, int(closed['tuan'].max()))
+            break
+    last_month_end = date(cutoff.year, cutoff.month, 1) - timedelta(days=1)
+    return closed_week, (last_month_end.year, last_month_end.month)
+
+
+def get_prerender_units(db_session: Session):
+    """Các đơn vị có tài khoản người dùng, cùng cấp Tỉnh (đơn vị báo cáo của quản trị viên)."""
+    unit_ids = {row.don_vi_id for row in db_session.query(NguoiDung.don_vi_id).filter(NguoiDung.don_vi_id.isnot(None)).distinct()}
+    return db_session.query(DonViHanhChinh).options(
+        joinedload(DonViHanhChinh.children).joinedload(DonViHanhChinh.children),
+        joinedload(DonViHanhChinh.parent)
+    ).filter((DonViHanhChinh.id.in_(unit_ids)) | (DonViHanhChinh.cap_don_vi == 'Tỉnh')).order_by(DonViHanhChinh.id).all()
+
+
+def _prerender_report(report_template: str, don_vi_id: int, year: int, week_number: int, month_number: int, report_folder: str):
+    """
+    Tạo một báo cáo vào bộ nhớ đệm (khóa tính theo phiên bản dữ liệu tại thời điểm tạo).
+    Báo cáo không có dữ liệu được ghi nhận theo khóa để các lượt kiểm tra sau không xếp hàng lại.
+    """
+    db_session = get_db_session()
+    try:
+        user_don_vi = load_report_unit(db_session, don_vi_id)
+        if not user_don_vi:
+            return None
+        ext = REPORT_TEMPLATES[report_template]['ext']
+        cache_key = get_report_cache_key(db_session, get_all_child_xa_ids(user_don_vi),
+                                         **get_report_scope(report_template, don_vi_id, year, week_number, month_number))
+        filename = get_cached_report(report_folder, cache_key, ext) or render_to_cache(
+            report_folder, cache_key, ext,
+            lambda filepath: render_report(db_session, report_template, user_don_vi, year, week_number, month_number, filepath)
+        )
+        if filename:
+            register_report_file(report_folder, filename, report_template=report_template, shared=True)
+        else:
+            with _pending_lock:
+                _empty_keys.add(cache_key)
+        return {'filename': filename}
+    finally:
+        db_session.close()
+        with _pending_lock:
+            _pending.discard((report_template, don_vi_id, year, week_number, month_number))
+        time.sleep(REPORT_PRERENDER_PAUSE_SECONDS)
+
+
+def _queue_report(report_template: str, don_vi_id: int, year: int, week_number: int, month_number: int, report_folder: str) -> bool:
+    """Xếp hàng tạo trước một báo cáo, bỏ qua nếu báo cáo đó đang chờ trong hàng đợi."""
+    pending_key = (report_template, don_vi_id, year, week_number, month_number)
+    with _pending_lock:
+        if pending_key in _pending:
+            return False
+        _pending.add(pending_key)
+    prerender_job_manager.submit(
+        _prerender_report, report_template, don_vi_id, year, week_number, month_number, report_folder,
+        meta={'report_template': report_template, 'don_vi_id': don_vi_id}
+    )
+    return True
+
+
+def queue_stale_reports(report_folder: str, now: datetime = None) -> int:
+    """
+    Xếp hàng tạo các báo cáo của tuần/tháng vừa kết thúc chưa có file ứng với phiên bản dữ liệu hiện tại
+    (chưa tạo lần nào, hoặc dữ liệu đã thay đổi sau lần tạo trước). Trả về số báo cáo được xếp hàng.
+    """
+    closed_week, (month_year, month_number) = latest_closed_periods(now or datetime.now())
+    db_session = get_db_session()
+    try:
+        queued = 0
+        current_keys = set()
+        for user_don_vi in get_prerender_units(db_session):
+            data_version = get_data_version(db_session, get_all_child_xa_ids(user_don_vi))
+            for report_template in PRERENDER_TEMPLATES:
+                template = REPORT_TEMPLATES[report_template]
+                if template['period'] == 'week':
+                    if closed_week is None:
+                        continue
+                    year, week_number = closed_week
+                else:
+                    year, week_number = month_year, 0
+                scope = get_report_scope(report_template, user_don_vi.id, year, week_number, month_number)
+                cache_key = make_report_cache_key(data_version, **scope)
+                current_keys.add(cache_key)
+                with _pending_lock:
+                    known_empty = cache_key in _empty_keys
+                if known_empty or get_cached_report(report_folder, cache_key, template['ext']):
+                    continue
+                queued += _queue_report(report_template, user_don_vi.id, year, week_number, month_number, report_folder)
+        # Chỉ giữ các đánh dấu "không có dữ liệu" của kỳ và phiên bản dữ liệu hiện tại
+        with _pending_lock:
+            _empty_keys.intersection_update(current_keys)
+        return queued
+    finally:
+        db_session.close()
+
+
+def notify_data_changed():
+    """Báo cho luồng tạo trước kiểm tra lại ngay (vd. sau khi import dữ liệu muộn) thay vì chờ lượt định kỳ."""
+    _wake_event.set()
+
+
+def _try_lock_file(path: str):
+    """Khóa độc quyền (không chờ) file `path`, giữ đến khi đóng file hoặc tiến trình dừng. Trả về file đã mở, hoặc None."""
+    handle = open(path, 'a+')
+    try:
+        if os.name == 'nt':
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return handle
+    except OSError:
+        handle.close()
+        return None
+
+
+def _prerender_loop(report_folder: str, stop_event: threading.Event):
+    # File khóa đặt ngoài thư mục báo cáo để không bị coi là file báo cáo và bị dọn dẹp
+    lock_path = os.path.join(os.path.dirname(os.path.abspath(report_folder)), PRERENDER_LOCK_FILENAME)
+    lock_handle = None
+    while not stop_event.is_set():
+        if lock_handle is None:
+            lock_handle = _try_lock_file(lock_path)
+        if lock_handle is not None:
+            try:
+                queued = queue_stale_reports(report_folder)
+                if queued:
+                    print(f"Tạo trước báo cáo: đã xếp hàng {queued} báo cáo.")
+            except Exception as e:
+                print(f"Lỗi khi xếp hàng tạo trước báo cáo: {e}\n{traceback.format_exc()}")
+        _wake_event.wait(REPORT_PRERENDER_CHECK_SECONDS)
+        _wake_event.clear()
+
+
+def start_report_prerender(report_folder: str):
+    """Khởi động luồng tạo trước báo cáo (chỉ một luồng cho mỗi tiến trình). Trả về Event để dừng luồng."""
+    global _scheduler_started
+    with _scheduler_lock:
+        if _scheduler_started or not REPORT_PRERENDER_ENABLED or not REPORT_CACHE_ENABLED or REPORT_PRERENDER_CHECK_SECONDS <= 0:
+            return None
+        _scheduler_started = True
+    stop_event = threading.Event()
+    threading.Thread(target=_prerender_loop, args=(report_folder, stop_event), name='report-prerender', daemon=True).start()
+    return stop_event
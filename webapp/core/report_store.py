@@ -0,0 +1,208 @@
+# file: webapp/core/report_store.py
+
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .database_setup import TepBaoCao
+from .database_utils import get_db_session, session_scope
+
+# ==============================================================================
+# QUẢN LÝ DUNG LƯỢNG THƯ MỤC BÁO CÁO (REPORT_FOLDER)
+# ==============================================================================
+# Mỗi file báo cáo được ghi vào bảng tep_bao_cao (người tạo, mẫu, kích thước, thời điểm tạo/truy cập).
+# File trong bộ nhớ đệm báo cáo được dùng chung cho mọi người dùng cùng phạm vi nên không có người tạo
+# (nguoi_tao_id NULL) và không tính vào giới hạn của ai; chúng có giới hạn số file chung riêng.
+# Luồng dọn dẹp chạy định kỳ, xóa file theo thứ tự: lâu không được truy cập -> vượt giới hạn mỗi người dùng
+# -> vượt giới hạn file dùng chung -> vượt tổng dung lượng (file lâu không được tải nhất bị xóa trước).
+REPORT_STORE_MAX_MB = float(os.getenv("REPORT_STORE_MAX_MB", "500"))
+REPORT_STORE_MAX_AGE_DAYS = float(os.getenv("REPORT_STORE_MAX_AGE_DAYS", "7"))
+REPORT_STORE_MAX_FILES_PER_USER = int(os.getenv("REPORT_STORE_MAX_FILES_PER_USER", "50"))
+REPORT_STORE_MAX_SHARED_FILES = int(os.getenv("REPORT_STORE_MAX_SHARED_FILES", "1000"))
+REPORT_STORE_SWEEP_SECONDS = int(os.getenv("REPORT_STORE_SWEEP_SECONDS", "3600"))
+# File vừa được tạo/tải trong khoảng này không bị xóa do vượt hạn mức (người dùng có thể đang tải)
+REPORT_STORE_MIN_KEEP_SECONDS = int(os.getenv("REPORT_STORE_MIN_KEEP_SECONDS", "600"))
+
+_sweeper_lock = threading.Lock()
+_sweeper_started = False
+
+
+def register_report_file(report_folder: str, filename: str, owner_id=None, report_template: str = None,
+                         shared: bool = False, db_session: Session = None):
+    """
+    Ghi nhận (hoặc cập nhật thời điểm truy cập) một file báo cáo vừa được tạo/dùng lại.
+    `shared`: file trong bộ nhớ đệm dùng chung, được ghi nhận không có người tạo (không tính vào giới hạn của `owner_id`).
+    """
+    filepath = os.path.join(report_folder, filename)
+    if not os.path.exists(filepath):
+        return
+    if shared:
+        owner_id = None
+    with session_scope(db_session) as db:
+        try:
+            now = datetime.now()
+            entry = db.query(TepBaoCao).get(filename)
+            if entry:
+                entry.truy_cap_luc = now
+                if shared:
+                    # File được ghi nhận trước đây với người tạo đầu tiên
+                    entry.nguoi_tao_id = None
+            else:
+                db.add(TepBaoCao(
+                    ten_file=filename, nguoi_tao_id=owner_id, mau_bao_cao=report_template,
+                    kich_thuoc=os.path.getsize(filepath), tao_luc=now, truy_cap_luc=now
+                ))
+            db.commit()
+        except IntegrityError:
+            # Một luồng khác vừa ghi nhận cùng file (báo cáo dùng chung từ bộ nhớ đệm)
+            db.rollback()
+
+
+def touch_report_file(filename: str, db_session: Session = None):
+    """Cập nhật thời điểm truy cập khi file được tải về."""
+    with session_scope(db_session) as db:
+        db.query(TepBaoCao).filter(TepBaoCao.ten_file == filename).update({"truy_cap_luc": datetime.now()}, synchronize_session=False)
+        db.commit()
+
+
+def _remove_entries(db, report_folder: str, entries) -> int:
+    freed = 0
+    for entry in entries:
+        filepath = os.path.join(report_folder, entry.ten_file)
+        try:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        except OSError as e:
+            print(f"Không thể xóa file báo cáo '{entry.ten_file}': {e}")
+            continue
+        freed += entry.kich_thuoc or 0
+        db.delete(entry)
+    return freed
+
+
+def adopt_untracked_files(report_folder: str) -> int:
+    """
+    Đưa các file có sẵn trong thư mục nhưng chưa có trong chỉ mục (từ phiên bản cũ) vào chỉ mục,
+    lấy thời điểm sửa đổi làm thời điểm tạo. Chỉ cần chạy một lần khi khởi động.
+    """
+    db = get_db_session()
+    try:
+        known = {row.ten_file for row in db.query(TepBaoCao.ten_file).all()}
+        added = 0
+        for entry in os.scandir(report_folder):
+            if not entry.is_file() or entry.name in known or '.tmp' in entry.name:
+                continue
+            stat = entry.stat()
+            modified = datetime.fromtimestamp(stat.st_mtime)
+            db.add(TepBaoCao(ten_file=entry.name, kich_thuoc=stat.st_size, tao_luc=modified, truy_cap_luc=modified))
+            added += 1
+        db.commit()
+        return added
+    finally:
+        db.close()
+
+
+def sweep_report_store(report_folder: str) -> dict:
+    """Một lượt dọn dẹp theo tuổi, giới hạn mỗi người dùng và tổng dung lượng. Trả về thống kê."""
+    db = get_db_session()
+    try:
+        now = datetime.now()
+        keep_after = now - timedelta(seconds=REPORT_STORE_MIN_KEEP_SECONDS)
+        stats = {'expired': 0, 'over_user_quota': 0, 'over_shared_quota': 0, 'over_size': 0, 'missing': 0, 'freed_bytes': 0}
+
+        # 1. Bỏ khỏi chỉ mục các file đã bị xóa bằng tay
+        missing = [e for e in db.query(TepBaoCao).all() if not os.path.exists(os.path.join(report_folder, e.ten_file))]
+        for entry in missing:
+            db.delete(entry)
+        stats['missing'] = len(missing)
+
+        # 2. Không được truy cập trong REPORT_STORE_MAX_AGE_DAYS (file dùng chung còn được tải thì được giữ)
+        expired = db.query(TepBaoCao).filter(TepBaoCao.truy_cap_luc < now - timedelta(days=REPORT_STORE_MAX_AGE_DAYS)).all()
+        stats['freed_bytes'] += _remove_entries(db, report_folder, expired)
+        stats['expired'] = len(expired)
+        db.flush()
+
+        # 3. Vượt số file tối đa của mỗi người dùng: giữ lại các file được truy cập gần nhất
+        over_users = (
+            db.query(TepBaoCao.nguoi_tao_id)
+            .filter(TepBaoCao.nguoi_tao_id.isnot(None))
+            .group_by(TepBaoCao.nguoi_tao_id)
+            .having(func.count(TepBaoCao.ten_file) > REPORT_STORE_MAX_FILES_PER_USER)
+            .all()
+        )
+        for (owner_id,) in over_users:
+            surplus = (
+                db.query(TepBaoCao)
+                .filter(TepBaoCao.nguoi_tao_id == owner_id)
+                .order_by(TepBaoCao.truy_cap_luc.desc())
+                .offset(REPORT_STORE_MAX_FILES_PER_USER)
+                .all()
+            )
+            surplus = [e for e in surplus if e.truy_cap_luc < keep_after]
+            stats['freed_bytes'] += _remove_entries(db, report_folder, surplus)
+            stats['over_user_quota'] += len(surplus)
+        db.flush()
+
+        # 4. Vượt số file dùng chung tối đa (bộ nhớ đệm báo cáo): giữ lại các file được truy cập gần nhất
+        surplus = (
+            db.query(TepBaoCao)
+            .filter(TepBaoCao.nguoi_tao_id.is_(None))
+            .order_by(TepBaoCao.truy_cap_luc.desc())
+            .offset(REPORT_STORE_MAX_SHARED_FILES)
+            .all()
+        )
+        surplus = [e for e in surplus if e.truy_cap_luc < keep_after]
+        stats['freed_bytes'] += _remove_entries(db, report_folder, surplus)
+        stats['over_shared_quota'] = len(surplus)
+        db.flush()
+
+        # 5. Vượt tổng dung lượng: xóa file lâu không được truy cập nhất cho đến khi đủ chỗ
+        max_bytes = int(REPORT_STORE_MAX_MB * 1024 * 1024)
+        total_bytes = db.query(func.coalesce(func.sum(TepBaoCao.kich_thuoc), 0)).scalar()
+        if total_bytes > max_bytes:
+            for entry in db.query(TepBaoCao).filter(TepBaoCao.truy_cap_luc < keep_after).order_by(TepBaoCao.truy_cap_luc).yield_per(200):
+                if total_bytes <= max_bytes:
+                    break
+                freed = _remove_entries(db, report_folder, [entry])
+                total_bytes -= freed
+                stats['freed_bytes'] += freed
+                stats['over_size'] += 1
+
+        db.commit()
+        return stats
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _sweep_loop(report_folder: str, stop_event: threading.Event):
+    try:
+        adopt_untracked_files(report_folder)
+    except Exception as e:
+        print(f"Lỗi khi lập chỉ mục thư mục báo cáo: {e}\n{traceback.format_exc()}")
+    while not stop_event.is_set():
+        try:
+            stats = sweep_report_store(report_folder)
+            if any(stats[k] for k in ('expired', 'over_user_quota', 'over_shared_quota', 'over_size')):
+                print(f"Dọn dẹp thư mục báo cáo: {stats}")
+        except Exception as e:
+            print(f"Lỗi khi dọn dẹp thư mục báo cáo: {e}\n{traceback.format_exc()}")
+        stop_event.wait(REPORT_STORE_SWEEP_SECONDS)
+
+
+def start_report_store_sweeper(report_folder: str):
+    """Khởi động luồng dọn dẹp định kỳ (chỉ một luồng cho mỗi tiến trình). Trả về Event để dừng luồng."""
+    global _sweeper_started
+    with _sweeper_lock:
+        if _sweeper_started or REPORT_STORE_SWEEP_SECONDS <= 0:
+            return None
+        _sweeper_started = True
+    stop_event = threading.Event()
+    threading.Thread(target=_sweep_loop, args=(report_folder, stop_event), name='report-store-sweeper', daemon=True).start()
+    return stop_event
@@ -0,0 +1,56 @@
+# file: webapp/core/sql_compat.py
+
+from sqlalchemy import Integer, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
+
+# ==============================================================================
+# CÁC CẤU TRÚC SQL KHÁC NHAU GIỮA POSTGRESQL VÀ SQLITE
+# ==============================================================================
+# Truy vấn báo cáo được viết bằng SQLAlchemy Core để chạy được trên cả PostgreSQL (máy chủ)
+# và SQLite (bản desktop/offline). Những chỗ mỗi CSDL viết một kiểu được gom vào đây.
+
+
+class age_years(FunctionElement):
+    """
+    Số năm tròn từ ngày `earlier` đến ngày `later` (tuổi tại thời điểm `later`).
+    PostgreSQL: EXTRACT(YEAR FROM age(later, earlier)); SQLite: hiệu số năm, trừ 1 nếu chưa tới ngày sinh nhật.
+    """
+    type = Integer()
+    name = 'age_years'
+    inherit_cache = True
+
+
+@compiles(age_years)
+def _compile_age_years(element, compiler, **kw):
+    later, earlier = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f"EXTRACT(YEAR FROM age({later}, {earlier}))"
+
+
+@compiles(age_years, 'sqlite')
+def _compile_age_years_sqlite(element, compiler, **kw):
+    later, earlier = (compiler.process(clause, **kw) for clause in element.clauses)
+    return (
+        f"(CAST(strftime('%Y', {later}) AS INTEGER) - CAST(strftime('%Y', {earlier}) AS INTEGER)"
+        f" - (strftime('%m-%d', {later}) < strftime('%m-%d', {earlier})))"
+    )
+
+
+def dialect_name(db_session: Session) -> str:
+    return db_session.get_bind().dialect.name
+
+
+def upsert(db_session: Session, table):
+    """Câu lệnh INSERT có `on_conflict_do_update`/`on_conflict_do_nothing` theo CSDL đang dùng."""
+    return (sqlite.insert if dialect_name(db_session) == 'sqlite' else postgresql.insert)(table)
+
+
+def advisory_xact_lock(db_session: Session, lock_id: int):
+    """
+    Khóa theo transaction để các tiến trình ghi cùng một dữ liệu tổng hợp lần lượt từng bên.
+    SQLite đã khóa cả CSDL khi ghi nên không cần khóa thêm.
+    """
+    if dialect_name(db_session) == 'postgresql':
+        db_session.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": lock_id})
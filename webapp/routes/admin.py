@@ -1,10 +1,10 @@
 import io
 from math import ceil
 
-from flask import Blueprint, render_template, session, redirect, url_for, request, flash, send_file
+from flask import Blueprint, render_template, session, redirect, url_for, request, flash, send_file, g, jsonify
 
 from webapp.core.database_setup import DonViHanhChinh
-from webapp.core.database_utils import get_db_session
+from webapp.core.database_utils import get_db_session, get_pool_status
 from webapp.core.admin_utils import (
     get_all_don_vi, add_new_don_vi, get_don_vi_by_id, update_don_vi, delete_don_vi,
     get_users_list, add_new_user, get_user_by_id, update_user, reset_user_password,
@@ -23,6 +23,17 @@ def require_admin_login():
         flash({'message': 'Bạn không có quyền truy cập khu vực quản trị.'}, 'danger')
         return redirect(url_for('main.report_page'))
 
+    # Mở session DB cho request và lưu vào `g.db`, các hàm trong admin_utils dùng lại session này
+    g.db = get_db_session()
+
+
+@admin_bp.teardown_request
+def close_admin_db(exception=None):
+    """Đóng session DB của request (nếu đã mở)."""
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
 
 @admin_bp.route('/')
 def dashboard():
@@ -41,7 +52,7 @@ def manage_don_vi():
         parent_id = request.form.get('parent_id')
         parent_id = int(parent_id) if parent_id and parent_id.isdigit() else None
 
-        result = add_new_don_vi(ten_don_vi, cap_don_vi, parent_id)
+        result = add_new_don_vi(ten_don_vi, cap_don_vi, parent_id, db_session=g.db)
         flash({'message': result['message']}, 'success' if result['success'] else 'danger')
         return redirect(url_for('admin.manage_don_vi'))
 
@@ -50,7 +61,7 @@ def manage_don_vi():
     filters = {'cap_don_vi': cap_don_vi_filter}
     PER_PAGE = 20
 
-    don_vi_paginated, total_items = get_all_don_vi(page=page, per_page=PER_PAGE, filters=filters)
+    don_vi_paginated, total_items = get_all_don_vi(page=page, per_page=PER_PAGE, filters=filters, db_session=g.db)
     pagination = {
         'page': page,
         'per_page': PER_PAGE,
@@ -58,7 +69,7 @@ def manage_don_vi():
         'total_pages': ceil(total_items / PER_PAGE)
     }
 
-    full_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000)
+    full_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000, db_session=g.db)
     don_vi_data_for_js = [dv.to_dict() for dv in full_don_vi_list]
 
     return render_template(
@@ -75,7 +86,7 @@ def manage_don_vi():
 @admin_bp.route('/don_vi/edit/<int:don_vi_id>', methods=['GET', 'POST'])
 def edit_don_vi(don_vi_id):
     """Trang sửa thông tin một đơn vị."""
-    unit = get_don_vi_by_id(don_vi_id)
+    unit = get_don_vi_by_id(don_vi_id, db_session=g.db)
     if not unit:
         # SỬA LỖI: Flash một dictionary
         flash({'message': "Không tìm thấy đơn vị."}, "danger")
@@ -86,12 +97,12 @@ def edit_don_vi(don_vi_id):
             'ten_don_vi': request.form.get('ten_don_vi'),
             'parent_id': int(request.form.get('parent_id')) if request.form.get('parent_id') else None
         }
-        result = update_don_vi(don_vi_id, data)
+        result = update_don_vi(don_vi_id, data, db_session=g.db)
         # SỬA LỖI: Flash một dictionary
         flash({'message': result['message']}, 'success' if result['success'] else 'danger')
         return redirect(url_for('admin.manage_don_vi'))
 
-    full_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000)
+    full_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000, db_session=g.db)
     don_vi_data_for_js = [dv.to_dict() for dv in full_don_vi_list]
 
     return render_template(
@@ -105,7 +116,7 @@ def edit_don_vi(don_vi_id):
 @admin_bp.route('/don_vi/delete/<int:don_vi_id>', methods=['POST'])
 def delete_don_vi_action(don_vi_id):
     """Xử lý hành động xóa một đơn vị."""
-    result = delete_don_vi(don_vi_id)
+    result = delete_don_vi(don_vi_id, db_session=g.db)
     # SỬA LỖI: Flash một dictionary
     flash({'message': result['message']}, 'success' if result['success'] else 'danger')
     return redirect(url_for('admin.manage_don_vi'))
@@ -121,21 +132,19 @@ def manage_users():
         mat_khau = request.form.get('mat_khau')
         don_vi_id = int(request.form.get('don_vi_id'))
 
-        db = get_db_session()
-        don_vi = db.query(DonViHanhChinh).get(don_vi_id)
-        db.close()
+        don_vi = g.db.get(DonViHanhChinh, don_vi_id)
 
         quyen_han_map = {'Tỉnh': 'tinh', 'Khu vực': 'khuvuc', 'Xã': 'xa'}
         quyen_han = quyen_han_map.get(don_vi.cap_don_vi, 'xa') if don_vi else 'xa'
 
-        result = add_new_user(ten_dang_nhap, mat_khau, quyen_han, don_vi_id)
+        result = add_new_user(ten_dang_nhap, mat_khau, quyen_han, don_vi_id, db_session=g.db)
         flash({'message': result['message']}, 'success' if result['success'] else 'danger')
         return redirect(url_for('admin.manage_users'))
 
     page = request.args.get('page', 1, type=int)
     PER_PAGE = 20
 
-    users_paginated, total_items = get_users_list(page=page, per_page=PER_PAGE)
+    users_paginated, total_items = get_users_list(page=page, per_page=PER_PAGE, db_session=g.db)
     pagination = {
         'page': page,
         'per_page': PER_PAGE,
@@ -143,7 +152,7 @@ def manage_users():
         'total_pages': ceil(total_items / PER_PAGE)
     }
 
-    don_vi_list_for_dropdown, _ = get_all_don_vi(page=1, per_page=10000)
+    don_vi_list_for_dropdown, _ = get_all_don_vi(page=1, per_page=10000, db_session=g.db)
 
     return render_template(
         'admin/users.html',
@@ -158,7 +167,7 @@ def manage_users():
 @admin_bp.route('/users/edit/<int:user_id>', methods=['GET', 'POST'])
 def edit_user(user_id):
     """Trang sửa thông tin người dùng và đặt lại mật khẩu."""
-    user = get_user_by_id(user_id)
+    user = get_user_by_id(user_id, db_session=g.db)
     if not user:
         # SỬA LỖI: Flash một dictionary
         flash({'message': "Không tìm thấy người dùng."}, "danger")
@@ -167,24 +176,22 @@ def edit_user(user_id):
     if request.method == 'POST':
         if 'reset_password' in request.form:
             new_password = request.form.get('new_password')
-            result = reset_user_password(user_id, new_password)
+            result = reset_user_password(user_id, new_password, db_session=g.db)
         else:
             don_vi_id = int(request.form.get('don_vi_id'))
-            db = get_db_session()
-            don_vi = db.query(DonViHanhChinh).get(don_vi_id)
-            db.close()
+            don_vi = g.db.get(DonViHanhChinh, don_vi_id)
 
             quyen_han_map = {'Tỉnh': 'tinh', 'Khu vực': 'khuvuc', 'Xã': 'xa'}
             quyen_han = quyen_han_map.get(don_vi.cap_don_vi, 'xa') if don_vi else 'xa'
 
             data = {'don_vi_id': don_vi_id, 'quyen_han': quyen_han}
-            result = update_user(user_id, data)
+            result = update_user(user_id, data, db_session=g.db)
 
         # SỬA LỖI: Flash một dictionary
         flash({'message': result['message']}, 'success' if result['success'] else 'danger')
         return redirect(url_for('admin.manage_users'))
 
-    don_vi_list, _ = get_all_don_vi(page=1, per_page=10000)
+    don_vi_list, _ = get_all_don_vi(page=1, per_page=10000, db_session=g.db)
     return render_template('admin/edit_user.html', title='Sửa Người dùng', user=user, don_vi_list=don_vi_list)
 
 
@@ -196,7 +203,7 @@ def delete_user_action(user_id):
         flash({'message': "Bạn không thể tự xóa chính mình."}, "warning")
         return redirect(url_for('admin.manage_users'))
 
-    result = delete_user(user_id)
+    result = delete_user(user_id, db_session=g.db)
     # SỬA LỖI: Flash một dictionary
     flash({'message': result['message']}, 'success' if result['success'] else 'danger')
     return redirect(url_for('admin.manage_users'))
@@ -206,7 +213,7 @@ def delete_user_action(user_id):
 def export_users():
     """Tạo và gửi file Excel chứa danh sách người dùng."""
     try:
-        excel_bytes = export_users_to_excel_bytes()
+        excel_bytes = export_users_to_excel_bytes(db_session=g.db)
 
         if excel_bytes:
             return send_file(
@@ -222,4 +229,10 @@ def export_users():
     except Exception as e:
         # SỬA LỖI: Flash một dictionary
         flash({'message': f"Có lỗi xảy ra khi xuất file: {e}"}, "danger")
-        return redirect(url_for('admin.manage_users'))
\ No newline at end of file
+        return redirect(url_for('admin.manage_users'))
+
+
+@admin_bp.route('/db_pool')
+def db_pool_status():
+    """Thống kê connection pool (số kết nối đang dùng, overflow, số lần mở/lấy kết nối) để theo dõi tải."""
+    return jsonify(get_pool_status())
@@ -2,9 +2,10 @@
 
 # --- Các import gốc của bạn ---
 from flask import (Blueprint, render_template, session, redirect, url_for, 
-                   request, flash, send_file, current_app, g)
+                   request, flash, send_file, current_app, g, Response)
 from datetime import datetime, timedelta, date
 import os
+import tempfile
 import traceback
 import uuid
 from functools import wraps
@@ -17,15 +18,20 @@ from sqlalchemy import func
 from dateutil.relativedelta import relativedelta # <<< THÊM IMPORT NÀY VÀO ĐẦU FILE
 # --- Imports từ project của bạn ---
 from webapp.core.database_utils import get_db_session
-from webapp.core.database_setup import DonViHanhChinh, CaBenh, O_Dich, NguoiDung
-from webapp.core.week_calendar import WeekCalendar
+from webapp.core.database_setup import DonViHanhChinh, CaBenh, O_Dich, NguoiDung, LoImport
+from webapp.core.case_options import CASE_OPTIONS
 from webapp.core.report_generator import (
-    generate_benh_truyen_nhiem_report, generate_sxh_report, 
-    generate_odich_sxh_report, generate_odich_tcm_report,
-    generate_benh_truyen_nhiem_report_monthly, generate_sxh_report_monthly, generate_all_reports_zip, generate_custom_btn_report, generate_cases_export 
+    generate_custom_btn_report, generate_odich_sxh_report_custom, generate_odich_tcm_report_custom, generate_cases_export,
+    stream_cases_export_csv, stream_cases_export_ndjson
 )
-# === THAY ĐỔI: Import trực tiếp hàm logic, không qua task nữa ===
-from webapp.core.data_importer import import_data_from_excel
+from webapp.core.report_jobs import submit_report_job, report_job_manager
+from webapp.core.report_cache import REPORT_CACHE_ENABLED, get_or_render_report
+from webapp.core.report_store import register_report_file, touch_report_file
+from webapp.core.report_prerender import notify_data_changed
+from webapp.core.import_jobs import (
+    submit_import_job, submit_preview_job, submit_preview_confirm_job, take_preview, import_job_manager
+)
+from webapp.core.import_batches import get_recent_import_batches, rollback_import_batch
 	
 from webapp.core.dashboard_utils import (
     create_cases_by_week_chart, get_top_diseases, 
@@ -34,7 +40,8 @@ from webapp.core.dashboard_utils import (
 from webapp.core.admin_utils import (
     get_cases_by_user_scope, update_case, delete_case, add_new_case,
     get_odich_by_user_scope, add_new_odich, delete_odich, get_odich_by_id, update_odich,
-    get_all_don_vi, get_unassigned_cases, link_cases_to_odich, unlink_case_from_odich
+    get_all_don_vi, get_unassigned_cases, link_cases_to_odich, unlink_case_from_odich,
+    iter_cases_for_export
 )
 from webapp.core.utils import get_all_child_xa_ids
 from webapp.core.forms import ChangePasswordForm
@@ -56,87 +63,6 @@ main_bp = Blueprint('main', __name__)
 # ==============================================================================
 # DECORATORS VÀ HÀM TRỢ GIÚP (CẢI TIẾN CHÍNH)
 # ==============================================================================
-# ĐỊNH NGHĨA CÁC LỰA CHỌN Ở BÊN NGOÀI ĐỂ DỄ QUẢN LÝ
-CASE_OPTIONS = {
-    'chan_doan_chinh': [
-    'Dịch hạch',
-    'Cúm A(H5N1)',
-    'Cúm A(H7N9)',
-    'Viêm đường hô hấp Trung đông (MERS-CoV)',
-    'Ê-bô-la (Ebolla)',
-    'Lát-sa (Lassa)',
-    'Mác-bớt (Marburg)',
-    'Sốt Tây sông Nin',
-    'Sốt Vàng',
-    'Than',
-    'Bệnh truyền nhiễm nguy hiểm và Bệnh chưa rõ tác nhân gây bệnh',
-
-    # Nhóm B
-    'Bạch hầu',
-    'Bệnh do liên cầu lợn ở người',
-    'COVID-19',
-    'Dại',
-    'Ho gà',
-    'Lao phổi',
-    'Liệt mềm cấp nghi bại liệt',
-    'Rubella (Rubeon)',
-    'Sởi',
-    'Sốt rét',
-    'Sốt xuất huyết Dengue',
-    'Tả',
-    'Tay - chân - miệng',
-    'Thương hàn',
-    'Thủy đậu',
-    'Uốn ván sơ sinh',
-    'Uốn ván khác',
-    'Viêm gan vi rút A',
-    'Viêm gan vi rút B',
-    'Viêm gan vi rút C',
-    'Viêm gan vi rút khác',
-    'Viêm màng não do não mô cầu',
-    'Viêm não Nhật bản',
-    'Viêm não vi rút khác',
-    'Xoắn khuẩn vàng da (Leptospira)',
-    'Zika',
-    'Chikungunya',
-    
-    # Nhóm C
-    'Bệnh do vi rút Adeno',
-    'Cúm',
-    'Lỵ amíp',
-    'Lỵ trực trùng',
-    'Quai bị',
-    'Tiêu chảy',
-    
-    # Các mục khác
-    'Thay đổi chẩn đoán- Bệnh không thuộc danh mục',
-    'Đã điều tra nhưng không có ca bệnh trên địa bàn'
-    ],
-    'phan_do_benh': {
-        'Sốt xuất huyết Dengue': [
-            'Sốt xuất huyết Dengue',
-            'Sốt xuất huyết Dengue có dấu hiệu cảnh báo',
-            'Sốt xuất huyết Dengue nặng'
-        ],
-        'Tay - chân - miệng': [
-            'Độ 1',
-            'Độ 2a',
-            'Độ 2b',
-            'Độ 3',
-            'Độ 4'
-        ]
-        # Thêm các bệnh khác nếu cần
-    },
-    'tinh_trang_hien_nay': [
-        'Điều trị ngoại trú',
-        'Điều trị nội trú',
-        'Ra viện',
-        'Tử vong',
-        'Chuyển viện',
-        'Tình trạng khác'
-    ]
-}
-
 @main_bp.before_request
 def before_request_handler():
     """
@@ -212,7 +138,7 @@ def dashboard_page():
         start_date = end_date - timedelta(days=29)
         time_range_text = "30 ngày qua"
 
-    top_diseases_df = get_top_diseases(user_don_vi, start_date, end_date, khu_vuc_id=khu_vuc_id, xa_id=xa_id)
+    top_diseases_df = get_top_diseases(user_don_vi, start_date, end_date, khu_vuc_id=khu_vuc_id, xa_id=xa_id, db_session=g.db)
     
     # --- LẤY DỮ LIỆU CHO DROPDOWN LỌC ---
     xa_ids_to_query = get_all_child_xa_ids(user_don_vi)
@@ -228,7 +154,7 @@ def dashboard_page():
     filter_data = {'khu_vuc_list': khu_vuc_list, 'xa_list': xa_list}
 
     # --- TẠO CÁC BIỂU ĐỒ ---
-    cases_by_week_chart_json = create_cases_by_week_chart(user_don_vi, disease_filter, khu_vuc_id=khu_vuc_id, xa_id=xa_id)
+    cases_by_week_chart_json = create_cases_by_week_chart(user_don_vi, disease_filter, khu_vuc_id=khu_vuc_id, xa_id=xa_id, db_session=g.db)
     top_diseases_chart_json = create_top_diseases_chart(top_diseases_df, time_range_text)
     disease_pie_chart_json = create_disease_pie_chart(top_diseases_df, time_range_text)
 
@@ -256,72 +182,31 @@ def report_page():
         month_number = int(request.form.get('month_number'))
         report_template = request.form.get('report_template')
 
-        # Cập nhật report_handlers với các lựa chọn mới
-        report_handlers = {
-            "Báo cáo Bệnh truyền nhiễm tổng hợp": {
-                "func": generate_benh_truyen_nhiem_report,
-                "args": (db, WeekCalendar(year), week_number, user_don_vi),
-                "name": f"BaoCao_BTN_{user_don_vi.ten_don_vi}_{year}_Tuan{week_number}.xlsx"
-            },
-            "Báo cáo Sốt Xuất Huyết": {
-                "func": generate_sxh_report,
-                "args": (db, WeekCalendar(year), week_number, user_don_vi),
-                "name": f"BaoCao_SXH_{user_don_vi.ten_don_vi}_{year}_Tuan{week_number}.xlsx"
-            },
-            "Báo cáo Ổ dịch SXH": {
-                "func": generate_odich_sxh_report,
-                "args": (db, WeekCalendar(year), week_number, user_don_vi),
-                "name": f"BaoCao_ODich_SXH_{user_don_vi.ten_don_vi}_{year}_Tuan{week_number}.xlsx"
-            },
-            "Báo cáo Ổ dịch TCM": {
-                "func": generate_odich_tcm_report,
-                "args": (db, WeekCalendar(year), week_number, user_don_vi),
-                "name": f"BaoCao_ODich_TCM_{user_don_vi.ten_don_vi}_{year}_Tuan{week_number}.xlsx"
-            },
-            "Báo cáo BTN theo tháng": {
-                "func": generate_benh_truyen_nhiem_report_monthly,
-                "args": (db, year, month_number, user_don_vi),
-                "name": f"BaoCao_BTN_Thang_{user_don_vi.ten_don_vi}_{year}_Thang{month_number}.xlsx"
-            },
-            "Báo cáo SXH theo tháng": {
-                "func": generate_sxh_report_monthly,
-                "args": (db, year, month_number, user_don_vi),
-                "name": f"BaoCao_SXH_Thang_{user_don_vi.ten_don_vi}_{year}_Thang{month_number}.xlsx"
-            },
-            # --- TÍNH NĂNG MỚI ---
-            "Tất cả báo cáo (Tuần)": {
-                "func": generate_all_reports_zip,
-                "args": (db, user_don_vi, year, 'week', week_number),
-                "name": f"TatCaBaoCao_{user_don_vi.ten_don_vi}_{year}_Tuan{week_number}.zip"
-            },
-            "Tất cả báo cáo (Tháng)": {
-                "func": generate_all_reports_zip,
-                "args": (db, user_don_vi, year, 'month', month_number),
-                "name": f"TatCaBaoCao_{user_don_vi.ten_don_vi}_{year}_Thang{month_number}.zip"
-            }
-        }
+        # Không tạo báo cáo trong request: đưa vào hàng đợi và trả về job_id ngay
+        try:
+            job_id = submit_report_job(
+                report_template, user_don_vi, year, week_number, month_number,
+                report_folder=current_app.config['REPORT_FOLDER'],
+                owner_id=session.get('user_id'),
+                db_session=db
+            )
+        except ValueError as e:
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'error': str(e)}), 400
+            flash({'message': str(e)}, 'warning')
+            return redirect(url_for('main.report_page'))
 
-        handler = report_handlers.get(report_template)
-        if handler:
-            # Thay đổi tên file từ .xlsx thành .zip nếu cần
-            file_extension = ".zip" if "zip" in handler["name"] else ".xlsx"
-            random_filename = f"{uuid.uuid4()}{file_extension}"
-            filepath = os.path.join(current_app.config['REPORT_FOLDER'], random_filename)
-            
-            try:
-                handler["func"](*handler["args"], filepath)
-                session['last_report'] = {'filename': random_filename, 'display_name': handler["name"]}
-                flash({'message': "Tạo báo cáo thành công!"}, "success")
-            except Exception as e:
-                current_app.logger.error(f"Lỗi tạo báo cáo: {e}\n{traceback.format_exc()}")
-                flash({'message': f'Đã có lỗi xảy ra khi tạo báo cáo: {e}'}, 'danger')
-        else:
-            flash({'message': 'Không thể tạo báo cáo, vui lòng chọn mẫu báo cáo.'}, 'warning')
+        status_url = url_for('main.report_job_status', job_id=job_id)
+        if request.accept_mimetypes.best == 'application/json':
+            return jsonify({'job_id': job_id, 'status_url': status_url}), 202
 
+        session['last_report_job'] = job_id
+        flash({'message': "Đã đưa yêu cầu vào hàng đợi, báo cáo đang được tạo..."}, "info")
         return redirect(url_for('main.report_page'))
 
     # Logic cho GET request
     report_info = session.pop('last_report', None)
+    report_job_id = session.pop('last_report_job', None)
     now = datetime.now()
 
     # Bổ sung: Lấy dữ liệu cho form Báo cáo Tùy chỉnh
@@ -349,14 +234,31 @@ def report_page():
         selected_month=now.month,
         selected_week=now.isocalendar()[1],
         report_info=report_info,
+        report_job_status_url=url_for('main.report_job_status', job_id=report_job_id) if report_job_id else None,
         custom_report_donvi_options=custom_report_donvi_options # <-- Truyền dữ liệu mới
     )
 
+@main_bp.route('/report/status/<job_id>')
+def report_job_status(job_id):
+    """Trả về trạng thái (queued/running/done/failed) và thời gian xử lý của một yêu cầu tạo báo cáo."""
+    job = report_job_manager.get(job_id)
+    if not job or job['owner_id'] != session.get('user_id'):
+        return jsonify({'error': 'Không tìm thấy yêu cầu tạo báo cáo.'}), 404
+
+    job = report_job_manager.status_dict(job)
+    result = job.pop('result') or {}
+    job['display_name'] = job['meta'].get('display_name')
+    if job['status'] == 'done':
+        job['download_url'] = url_for('main.download_report', filename=result['filename'], display_name=result['display_name'])
+    return jsonify(job)
+
 @main_bp.route('/download_report/<filename>/<display_name>')
 def download_report(filename, display_name):
     filepath = os.path.join(current_app.config['REPORT_FOLDER'], filename)
     try:
-        return send_file(filepath, as_attachment=True, download_name=display_name)
+        response = send_file(filepath, as_attachment=True, download_name=display_name)
+        touch_report_file(filename, db_session=g.db)
+        return response
     except FileNotFoundError:
         flash("Không tìm thấy file báo cáo hoặc file đã quá hạn. Vui lòng tạo lại.", "danger")
         return redirect(url_for('main.report_page'))
@@ -384,23 +286,30 @@ def custom_btn_report_action():
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
         selected_don_vi_ids = [int(id_str) for id_str in selected_ids_str]
 
-        # 2. Chuẩn bị file để lưu
+        # 2. Chuẩn bị tên file tải về
         display_name = f"BaoCao_BTN_TuyChinh_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx"
-        random_filename = f"{uuid.uuid4()}.xlsx"
-        filepath = os.path.join(current_app.config['REPORT_FOLDER'], random_filename)
-
-        # 3. Gọi hàm xử lý chính
-        generate_custom_btn_report(
-            db_session=db,
-            user_don_vi=user_don_vi,
-            start_date=start_date,
-            end_date=end_date,
-            selected_don_vi_ids=selected_don_vi_ids,
-            filepath=filepath
+        selected_units = db.query(DonViHanhChinh).filter(DonViHanhChinh.id.in_(selected_don_vi_ids)).all()
+        xa_ids_in_scope = {xa_id for unit in selected_units for xa_id in get_all_child_xa_ids(unit)}
+
+        # 3. Gọi hàm xử lý chính (dùng lại file đã tạo nếu phạm vi và dữ liệu không đổi)
+        filename = get_or_render_report(
+            db, current_app.config['REPORT_FOLDER'], xa_ids_in_scope, '.xlsx',
+            lambda filepath: generate_custom_btn_report(
+                db_session=db,
+                user_don_vi=user_don_vi,
+                start_date=start_date,
+                end_date=end_date,
+                selected_don_vi_ids=selected_don_vi_ids,
+                filepath=filepath
+            ),
+            report_template='custom_btn', don_vi_id=user_don_vi.id,
+            start_date=start_date, end_date=end_date, don_vi_ids=sorted(selected_don_vi_ids)
         )
+        if filename:
+            register_report_file(current_app.config['REPORT_FOLDER'], filename, owner_id=session.get('user_id'), report_template='custom_btn', shared=REPORT_CACHE_ENABLED, db_session=g.db)
 
         # 4. Trả kết quả về cho người dùng (theo pattern đã có)
-        session['last_report'] = {'filename': random_filename, 'display_name': display_name}
+        session['last_report'] = {'filename': filename, 'display_name': display_name}
         flash({'message': "Tạo báo cáo tùy chỉnh thành công!"}, "success")
 
     except (ValueError, PermissionError) as e:
@@ -414,6 +323,53 @@ def custom_btn_report_action():
 
     return redirect(url_for('main.report_page'))
 
+@main_bp.route('/report/custom-odich', methods=['POST'])
+def custom_odich_report_action():
+    """Báo cáo ổ dịch SXH/TCM của đơn vị người dùng cho một khoảng ngày bất kỳ."""
+    user_don_vi = g.user_don_vi
+    db = g.db
+    custom_odich_reports = {
+        'SXH': ('BaoCao_ODich_SXH_TuyChinh', generate_odich_sxh_report_custom),
+        'TCM': ('BaoCao_ODich_TCM_TuyChinh', generate_odich_tcm_report_custom),
+    }
+
+    try:
+        start_date_str = request.form.get('start_date')
+        end_date_str = request.form.get('end_date')
+        loai_benh = request.form.get('loai_benh')
+
+        if not all([start_date_str, end_date_str]) or loai_benh not in custom_odich_reports:
+            flash({'message': 'Vui lòng điền đầy đủ thông tin: loại ổ dịch, ngày bắt đầu và ngày kết thúc.'}, 'warning')
+            return redirect(url_for('main.report_page'))
+
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+        name_prefix, generate_func = custom_odich_reports[loai_benh]
+        display_name = f"{name_prefix}_{user_don_vi.ten_don_vi}_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx"
+
+        filename = get_or_render_report(
+            db, current_app.config['REPORT_FOLDER'], get_all_child_xa_ids(user_don_vi), '.xlsx',
+            lambda filepath: generate_func(db, user_don_vi, start_date, end_date, filepath),
+            report_template=f'custom_odich_{loai_benh}', don_vi_id=user_don_vi.id,
+            start_date=start_date, end_date=end_date
+        )
+        if not filename:
+            flash({'message': 'Không có dữ liệu để tạo báo cáo cho đơn vị này.'}, 'warning')
+            return redirect(url_for('main.report_page'))
+        register_report_file(current_app.config['REPORT_FOLDER'], filename, owner_id=session.get('user_id'), report_template=f'custom_odich_{loai_benh}', shared=REPORT_CACHE_ENABLED, db_session=g.db)
+
+        session['last_report'] = {'filename': filename, 'display_name': display_name}
+        flash({'message': "Tạo báo cáo ổ dịch tùy chỉnh thành công!"}, "success")
+
+    except ValueError as e:
+        current_app.logger.warning(f"Lỗi tạo báo cáo ổ dịch tùy chỉnh: {e}")
+        flash({'message': f'Lỗi: {e}'}, 'danger')
+    except Exception as e:
+        current_app.logger.error(f"Lỗi không xác định khi tạo báo cáo ổ dịch tùy chỉnh: {e}\n{traceback.format_exc()}")
+        flash({'message': 'Đã có lỗi không xác định xảy ra khi tạo báo cáo.'}, 'danger')
+
+    return redirect(url_for('main.report_page'))
+
 # ==============================================================================
 # ROUTE IMPORT ĐÃ ĐƯỢC CẬP NHẬT
 # ==============================================================================
@@ -431,42 +387,120 @@ def import_page():
 
         file = request.files['excel_file']
         
-        if file and file.filename.endswith('.xlsx'):
-            # Vẫn cần lưu file tạm thời để hàm import có thể đọc
+        if file and file.filename.lower().endswith(('.xlsx', '.zip')):
+            # Lưu file tạm (tên duy nhất để các lượt import đồng thời không ghi đè nhau);
+            # công việc nền đọc file và xóa file khi xong
             filename = secure_filename(file.filename)
             temp_dir = os.path.join(os.path.dirname(current_app.root_path), 'tmp')
             os.makedirs(temp_dir, exist_ok=True)
-            filepath = os.path.join(temp_dir, filename)
-            
+            filepath = os.path.join(temp_dir, f"{uuid.uuid4().hex}_{filename}")
+
             try:
                 file.save(filepath)
-                
                 # Tham số user_xa_id không còn phù hợp khi Khu vực import
                 # Hàm import_data_from_excel sẽ cần tự xác định xã từ file Excel
-                result = import_data_from_excel(filepath=filepath, user_xa_id=None)
-
-                # Hiển thị thông báo dựa trên kết quả trả về
-                if result.get('success'):
-                    # Flash một dictionary chứa thông báo và danh sách lỗi
-                    flash({'message': result.get('message'), 'errors': result.get('errors', [])}, 'success')
+                # force: import lại cả khi file có cùng nội dung đã được import thành công trước đó
+                # update_existing: cập nhật diễn biến bệnh (tình trạng, ngày ra viện, phân độ...) của các ca đã có
+                # action=preview: chỉ xem trước (không ghi), xác nhận sau tại trang trạng thái
+                if request.form.get('action') == 'preview':
+                    job_id = submit_preview_job(filepath, user_xa_id=None, owner_id=session.get('user_id'), display_name=file.filename,
+                                                update_existing=request.form.get('update_existing') == '1',
+                                                report_folder=current_app.config['REPORT_FOLDER'])
                 else:
-                    flash({'message': result.get('message')}, 'danger')
-
+                    job_id = submit_import_job(filepath, user_xa_id=None, owner_id=session.get('user_id'), display_name=file.filename,
+                                               force=request.form.get('force') == '1',
+                                               update_existing=request.form.get('update_existing') == '1',
+                                               report_folder=current_app.config['REPORT_FOLDER'])
             except Exception as e:
                 current_app.logger.error(f"Lỗi không xác định khi import: {e}\n{traceback.format_exc()}")
-                flash({'message': f'Đã có lỗi không xác định xảy ra: {e}'}, 'danger')
-            finally:
-                # Rất QUAN TRỌNG: Luôn xóa file tạm sau khi xử lý xong
                 if os.path.exists(filepath):
                     os.remove(filepath)
+                flash({'message': f'Đã có lỗi không xác định xảy ra: {e}'}, 'danger')
+                return redirect(url_for('main.import_page'))
+
+            status_url = url_for('main.import_job_status', job_id=job_id)
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'job_id': job_id, 'status_url': status_url}), 202
+            return redirect(url_for('main.import_job_page', job_id=job_id))
         else:
-            flash({'message': 'Chỉ chấp nhận file định dạng .xlsx'}, 'warning')
+            flash({'message': 'Chỉ chấp nhận file định dạng .xlsx hoặc file .zip chứa nhiều file .xlsx'}, 'warning')
         
         # Sau khi xử lý xong, redirect lại chính trang import để hiển thị thông báo
         return redirect(url_for('main.import_page'))
 
-    # Nếu là GET request, chỉ hiển thị trang
-    return render_template('import.html', title='Import Dữ liệu')
+    # Nếu là GET request, hiển thị trang cùng lịch sử các lượt import (admin thấy tất cả, khu vực thấy lượt của mình)
+    import_batches = get_recent_import_batches(
+        g.db, nguoi_import_id=None if session.get('role') == 'admin' else session.get('user_id')
+    )
+    return render_template('import.html', title='Import Dữ liệu', import_batches=import_batches)
+
+@main_bp.route('/import/preview/<token>/confirm', methods=['POST'])
+def confirm_import_preview(token):
+    """Xác nhận bản xem trước: import dữ liệu đã đọc và kiểm tra khi xem trước, không đọc lại file."""
+    if session.get('role') not in ['admin', 'khuvuc']:
+        flash('Bạn không có quyền truy cập chức năng này.', 'warning')
+        return redirect(url_for('main.report_page'))
+
+    entry = take_preview(token, owner_id=session.get('user_id'))
+    if not entry:
+        flash({'message': 'Bản xem trước không còn (đã hết hạn hoặc đã được import). Vui lòng tải file lên lại.'}, 'warning')
+        return redirect(url_for('main.import_page'))
+    job_id = submit_preview_confirm_job(entry, report_folder=current_app.config['REPORT_FOLDER'])
+
+    status_url = url_for('main.import_job_status', job_id=job_id)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job_id, 'status_url': status_url}), 202
+    return redirect(url_for('main.import_job_page', job_id=job_id))
+
+@main_bp.route('/import/batches/<int:lo_import_id>/rollback', methods=['POST'])
+def rollback_import_batch_action(lo_import_id):
+    """Hoàn tác một lượt import: xóa toàn bộ ca bệnh do lượt đó thêm vào."""
+    batch = g.db.get(LoImport, lo_import_id)
+    is_admin = session.get('role') == 'admin'
+    if not batch or not (is_admin or (session.get('role') == 'khuvuc' and batch.nguoi_import_id == session.get('user_id'))):
+        flash({'message': 'Không tìm thấy lượt import hoặc bạn không có quyền hoàn tác.'}, 'danger')
+        return redirect(url_for('main.import_page'))
+
+    result = rollback_import_batch(g.db, lo_import_id)
+    if result['success']:
+        notify_data_changed()
+    flash({'message': result['message']}, 'success' if result['success'] else 'danger')
+    return redirect(url_for('main.import_page'))
+
+def _get_own_import_job(job_id):
+    job = import_job_manager.get(job_id)
+    if not job or job['owner_id'] != session.get('user_id'):
+        return None
+    return job
+
+@main_bp.route('/import/job/<job_id>')
+def import_job_page(job_id):
+    """Trang theo dõi tiến độ một lượt import đang chạy nền."""
+    job = _get_own_import_job(job_id)
+    if not job:
+        flash({'message': 'Không tìm thấy lượt import (có thể đã hết hạn lưu trạng thái).'}, 'warning')
+        return redirect(url_for('main.import_page'))
+    return render_template(
+        'import_status.html', title='Xem trước Import' if job['meta'].get('preview') else 'Trạng thái Import',
+        display_name=job['meta'].get('display_name'),
+        status_url=url_for('main.import_job_status', job_id=job_id)
+    )
+
+@main_bp.route('/import/status/<job_id>')
+def import_job_status(job_id):
+    """Trạng thái (queued/running/done/failed), tiến độ từng bước và kết quả của một lượt import."""
+    job = _get_own_import_job(job_id)
+    if not job:
+        return jsonify({'error': 'Không tìm thấy lượt import.'}), 404
+    job = import_job_manager.status_dict(job)
+    result = job.get('result') or {}
+    if result.get('error_workbook'):
+        # File Excel các dòng bị loại (ô lỗi được tô màu), tải qua đường dẫn tải báo cáo
+        job['error_workbook_url'] = url_for('main.download_report', filename=result['error_workbook'],
+                                            display_name=f"dong_loi_import_{result.get('lo_import_id') or 'xem_truoc'}.xlsx")
+    if result.get('preview_token'):
+        job['confirm_url'] = url_for('main.confirm_import_preview', token=result['preview_token'])
+    return jsonify(job)
 
 # --- CÁC ROUTE QUẢN LÝ CA BỆNH ---
 
@@ -546,7 +580,7 @@ def cases_page():
         filter_data['chan_doan_list'] = [item[0] for item in chan_doan_query]
 
     # Thực hiện truy vấn chính
-    cases_paginated, total_cases = get_cases_by_user_scope(user_don_vi, filters, page=page, per_page=PER_PAGE)
+    cases_paginated, total_cases = get_cases_by_user_scope(user_don_vi, filters, page=page, per_page=PER_PAGE, db_session=g.db)
 
     pagination = {
         'page': page, 'per_page': PER_PAGE, 'total_items': total_cases,
@@ -575,10 +609,19 @@ def cases_page():
         current_query_string=current_query_string # <-- TRUYỀN BIẾN MỚI NÀY VÀO TEMPLATE
     )
 
+def _stream_and_remove_file(filepath: str, chunk_size: int = 64 * 1024):
+    """Trả về nội dung file theo từng đoạn rồi xóa file khi đã gửi xong (hoặc khi người dùng ngắt kết nối)."""
+    try:
+        with open(filepath, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        if os.path.exists(filepath): os.remove(filepath)
+
 @main_bp.route('/cases/export', methods=['GET'])
 def export_cases():
     """
-    Xuất danh sách ca bệnh ra file Excel.
+    Xuất danh sách ca bệnh ra file Excel (mặc định), CSV (?format=csv) hoặc NDJSON (?format=ndjson).
     Chỉ cho phép admin và user cấp khu vực truy cập.
     """
     if session.get('role') not in ['admin', 'khuvuc']:
@@ -611,19 +654,37 @@ def export_cases():
         filters.pop('start_date', None)
         filters.pop('end_date', None)
 
-    # Lấy danh sách ca bệnh theo quyền của người dùng
-    cases, _ = get_cases_by_user_scope(user_don_vi, filters, page=1, per_page=10000)
+    # Duyệt toàn bộ ca bệnh theo quyền của người dùng (theo từng lượt, không giới hạn số dòng)
+    cases = iter_cases_for_export(user_don_vi, filters)
+    export_format = request.args.get('format', 'xlsx')
+    download_name = f'danh_sach_ca_benh_{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+
+    # CSV/NDJSON: ghi thẳng từng đoạn vào response, người dùng nhận dữ liệu ngay khi lượt đọc đầu tiên xong
+    if export_format in ('csv', 'ndjson'):
+        stream, mimetype = {
+            'csv': (stream_cases_export_csv, 'text/csv'),
+            'ndjson': (stream_cases_export_ndjson, 'application/x-ndjson'),
+        }[export_format]
+        return Response(
+            stream(cases), mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={download_name}.{export_format}'}
+        )
 
-    # Tạo file Excel và gửi về cho người dùng
+    # Excel: ghi ra file tạm ở chế độ constant_memory rồi gửi file, xóa file sau khi gửi xong
+    temp_fd, temp_path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(temp_fd)
     try:
-        output = generate_cases_export(cases)
-        response = send_file(
-            output,
-            as_attachment=True,
-            download_name=f'danh_sach_ca_benh_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+        generate_cases_export(cases, temp_path)
+        return Response(
+            _stream_and_remove_file(temp_path),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            headers={
+                'Content-Disposition': f'attachment; filename={download_name}.xlsx',
+                'Content-Length': str(os.path.getsize(temp_path)),
+            }
         )
-        return response
     except Exception as e:
+        if os.path.exists(temp_path): os.remove(temp_path)
         current_app.logger.error(f"Lỗi xuất Excel: {e}")
         return jsonify({'error': 'Đã có lỗi xảy ra khi xuất file Excel.'}), 500
 
@@ -661,7 +722,7 @@ def new_case_page():
             "o_dich_id": int(o_dich_id_str) if o_dich_id_str and o_dich_id_str.isdigit() else None
         }
 
-        result = add_new_case(case_data)
+        result = add_new_case(case_data, db_session=g.db)
         if result['success']:
             flash({'message': result['message']}, 'success')
             # THAY ĐỔI QUAN TRỌNG: Chuyển hướng về trang danh sách với bộ lọc được giữ lại
@@ -672,7 +733,7 @@ def new_case_page():
 
     # --- Logic cho GET request ---
     # Lấy danh sách cần thiết cho các dropdown trong form
-    all_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000)
+    all_don_vi_list, _ = get_all_don_vi(page=1, per_page=10000, db_session=g.db)
 
     # Chuẩn bị dữ liệu cho JavaScript
     xa_list_js = [dv.to_dict() for dv in all_don_vi_list if dv.cap_don_vi == 'Xã']
@@ -728,7 +789,7 @@ def edit_case_page(case_id):
             'tinh_trang_hien_nay': request.form.get('tinh_trang_hien_nay'),
             'o_dich_id': int(o_dich_id) if o_dich_id and o_dich_id.isdigit() else None
         }
-        result = update_case(case_id, new_data)
+        result = update_case(case_id, new_data, db_session=g.db)
         if result['success']:
             flash({'message': result['message']}, 'success')
         else:
@@ -779,7 +840,7 @@ def delete_case_action(case_id):
         flash({'message': 'Không tìm thấy ca bệnh hoặc bạn không có quyền truy cập.'}, 'danger')
         return redirect(url_for('main.cases_page'))
 
-    result = delete_case(case_id)
+    result = delete_case(case_id, db_session=g.db)
     if result['success']:
         flash({'message': 'Đã xóa ca bệnh thành công.'}, 'success')
     else:
@@ -969,7 +1030,7 @@ def new_odich_page():
                 data['so_ca_mac_trong_od'] = 1 # Đặt số ca ban đầu là 1
         
 
-        result = add_new_odich(data)
+        result = add_new_odich(data, db_session=g.db)
 
         if result.get('success'):
             flash({'message': result['message']}, 'success')
@@ -977,7 +1038,7 @@ def new_odich_page():
             
             # Liên kết ca bệnh chỉ điểm SAU KHI đã tạo ổ dịch thành công
             if new_odich_id and case_id_from_form:
-                link_cases_to_odich(new_odich_id, [case_id_from_form])
+                link_cases_to_odich(new_odich_id, [case_id_from_form], db_session=g.db)
                 flash({'message': "Đã tự động liên kết ca bệnh chỉ điểm vào ổ dịch."}, "info")
             
             if new_odich_id:
@@ -1013,7 +1074,7 @@ def new_odich_page():
 def view_odich_page(odich_id):
     db = g.db
     
-    odich = get_odich_by_id(odich_id)
+    odich = get_odich_by_id(odich_id, db_session=g.db)
     if not odich:
         flash({'message': "Không tìm thấy ổ dịch."}, "warning")
         return redirect(url_for('main.manage_odich_page'))
@@ -1049,7 +1110,7 @@ def view_odich_page(odich_id):
             data['loai_xet_nghiem_sxh'] = request.form.get('loai_xet_nghiem_sxh')
         if is_admin and request.form.get('xa_id'):
             data['xa_id'] = int(request.form.get('xa_id'))
-        result = update_odich(odich_id, data)
+        result = update_odich(odich_id, data, db_session=g.db)
         if result['success']:
             flash({'message': 'Cập nhật ổ dịch thành công.'}, 'success')
         else:
@@ -1081,12 +1142,13 @@ def view_odich_page(odich_id):
         xa_id=odich.xa_id, 
         loai_benh=odich.loai_benh, 
         start_date=ngay_bat_dau_goi_y, 
-        end_date=ngay_ket_thuc_goi_y
+        end_date=ngay_ket_thuc_goi_y,
+        db_session=g.db
     )
     
     all_xa_list = None
     if is_admin:
-        all_xa_list, _ = get_all_don_vi(page=1, per_page=1000, filters={'cap_don_vi': 'Xã'})
+        all_xa_list, _ = get_all_don_vi(page=1, per_page=1000, filters={'cap_don_vi': 'Xã'}, db_session=g.db)
 
     return render_template(
         'view_odich.html', 
@@ -1104,7 +1166,7 @@ def link_cases_to_odich_action(odich_id):
         flash({'message': "Chưa chọn ca bệnh nào để thêm."}, "warning")
     else:
         case_ids_int = [int(cid) for cid in case_ids]
-        result = link_cases_to_odich(odich_id, case_ids_int)
+        result = link_cases_to_odich(odich_id, case_ids_int, db_session=g.db)
         if result['success']:
             flash({'message': result['message']}, 'success')
         else:
@@ -1119,7 +1181,7 @@ def unlink_case_from_odich_action(case_id):
     case = db.query(CaBenh).get(case_id)
     odich_id = case.o_dich_id if case else None
 
-    result = unlink_case_from_odich(case_id)
+    result = unlink_case_from_odich(case_id, db_session=g.db)
     if result['success']:
         flash({'message': 'Đã gỡ ca bệnh khỏi ổ dịch.'}, 'success')
     else:
@@ -1132,7 +1194,7 @@ def unlink_case_from_odich_action(case_id):
 
 @main_bp.route('/odich/delete/<int:odich_id>', methods=['POST'])
 def delete_odich_action(odich_id):
-    result = delete_odich(odich_id, session.get('role'), session.get('don_vi_id'))
+    result = delete_odich(odich_id, session.get('role'), session.get('don_vi_id'), db_session=g.db)
     if result['success']:
         flash({'message': 'Đã xóa ổ dịch thành công.'}, 'success')
     else: